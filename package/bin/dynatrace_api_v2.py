@@ -39,7 +39,8 @@ from dynatrace_types_37 import *
 class ModInputdynatrace_api_v2(base_mi.BaseModInput):
 
     def __init__(self):
-        use_single_instance = False
+        # Daemon mode runs every stanza in one long-lived process, see util.run_daemon
+        use_single_instance = util.is_daemon_mode_enabled()
         self.correlation_id = uuid.uuid4()
         super(ModInputdynatrace_api_v2, self).__init__("splunk_ta_dynatrace", "dynatrace_api_v2", use_single_instance)
         self.global_checkbox_fields = None
@@ -81,6 +82,31 @@ class ModInputdynatrace_api_v2(base_mi.BaseModInput):
                                          required_on_create=False,
                                          required_on_edit=False))
 
+        scheme.add_argument(smi.Argument("dynatrace_detail_workers", title="Detail Request Workers",
+                                         description="Number of detail requests issued in parallel for detail endpoints.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+
+        scheme.add_argument(smi.Argument("dynatrace_backfill_start", title="Backfill Start",
+                                         description="Start of a historical range to load once, ISO 8601 or epoch milliseconds.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+
+        scheme.add_argument(smi.Argument("dynatrace_backfill_end", title="Backfill End",
+                                         description="End of the historical range to load, ISO 8601 or epoch milliseconds.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+
+        scheme.add_argument(smi.Argument("dynatrace_backfill_workers", title="Backfill Workers",
+                                         description="Number of backfill chunks fetched in parallel.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+
+        scheme.add_argument(smi.Argument("dynatrace_entity_detail_batch_size", title="Entity Detail Batch Size",
+                                         description="Number of entities requested per entity details call, 0 requests each entity separately.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+
         return scheme
 
     def get_app_name(self):
@@ -89,6 +115,7 @@ class ModInputdynatrace_api_v2(base_mi.BaseModInput):
     def validate_input(helper, definition):
         pass
 
+    @util.guard_run
     def collect_events(helper, ew):
         dynatrace_account_input = helper.get_arg("dynatrace_account")
         dynatrace_tenant_input = dynatrace_account_input["username"]
@@ -129,6 +156,8 @@ class ModInputdynatrace_api_v2(base_mi.BaseModInput):
             (Endpoint.ENTITIES, Endpoint.ENTITY),
         )
         extra_params = selected_entity_types if is_entity_endpoint and selected_entity_types else None
+        detail_workers = util.parse_detail_workers(helper.get_arg("dynatrace_detail_workers"))
+        detail_batch_size = util.parse_entity_detail_batch_size(helper.get_arg("dynatrace_entity_detail_batch_size"))
 
         # TODO - Change synthetic_tests_on_demand to synthetic_executions_on_demand
         # Will also need to change strings in the apiv2.py file and the util.py selectors and enpoints
@@ -149,34 +178,103 @@ class ModInputdynatrace_api_v2(base_mi.BaseModInput):
         sourcetype = sourcetype_mapping.get(endpoint, None)
         helper.log_debug('sourcetype: {}'.format(sourcetype))
 
-        params = {'time': time_start}
-        helper.log_info(f"correlation_id: {helper.correlation_id}, executing session for endpoint: {endpoint}")
-        dynatrace_data = util.execute_session(
-            endpoint,
-            opt_dynatrace_tenant,
-            opt_dynatrace_api_token,
-            params,
-            extra_params=extra_params,
-            verify=opt_ssl_certificate_verification,
-            opt_helper=helper,
-        )
-
         helper.log_debug('dynatrace_tenant: {}'.format(opt_dynatrace_tenant))
         helper.log_debug('dynatrace_collection_interval: {}'.format(opt_dynatrace_collection_interval_minutes))
 
+        main_endpoint = endpoint[0] if isinstance(endpoint, tuple) else endpoint
         counter = 0
-        if dynatrace_data:
+        # Each record is serialized once, the event payload is also what event_bytes measures
+        event_bytes = 0
+        # Requests stop once the run has used up most of the input interval, unfinished windows resume next run
+        deadline = util.start_run_deadline(helper)
+
+        def write_records(dynatrace_data):
+            nonlocal counter, event_bytes
             for record in dynatrace_data:
                 helper.log_debug('record: {}'.format(record))
                 serialized = json.dumps(record, sort_keys=True)
+                event_bytes += len(serialized)
                 event = helper.new_event(data=serialized, host=None, index=index, source=None,
                                          sourcetype=sourcetype, done=True, unbroken=True)
                 ew.write_event(event)
                 counter += 1
-        else:
+
+        def run_session(params, selectors, resume=None):
+            helper.log_info(f"correlation_id: {helper.correlation_id}, executing session for endpoint: {endpoint}, "
+                            f"params: {params}")
+            return util.execute_session(
+                endpoint,
+                opt_dynatrace_tenant,
+                opt_dynatrace_api_token,
+                params,
+                extra_params=selectors,
+                verify=opt_ssl_certificate_verification,
+                opt_helper=helper,
+                max_workers=detail_workers,
+                detail_batch_size=detail_batch_size,
+                resume=resume,
+            )
+
+        try:
+            if not util.is_windowed_endpoint(main_endpoint):
+                try:
+                    write_records(run_session({'time': time_start}, extra_params))
+                except util.DynatraceCollectionError as e:
+                    helper.log_error(f"correlation_id: {helper.correlation_id}, collection failed: {e}")
+            else:
+                # One watermark per input, endpoint and entity type so each window is collected exactly once
+                input_name = helper.get_input_stanza_names()
+                selectors = extra_params or main_endpoint.extra_params or [None]
+
+                # Entities are snapshots, catching up in several windows would only duplicate them
+                window_minutes = None if is_entity_endpoint else opt_dynatrace_collection_interval_minutes
+                for selector in selectors:
+                    checkpoint_key = util.get_checkpoint_key(input_name, endpoint_string, selector)
+                    watermark, pending_end = util.get_window_state(helper, checkpoint_key)
+                    windows = util.plan_time_windows(watermark,
+                                                     opt_dynatrace_collection_interval_minutes,
+                                                     window_minutes=window_minutes,
+                                                     pending_end=pending_end)
+                    util.collect_windows(
+                        helper,
+                        [checkpoint_key],
+                        windows,
+                        lambda window_start, window_end, resume, checkpoint: write_records(
+                            run_session({'time': window_start, 'end_time': window_end}, [selector] if selector else None,
+                                        resume=resume)),
+                        pending_end=pending_end,
+                    )
+
+                # A configured historical range is loaded with the time regular collection left, its progress survives
+                # restarts. Live windows come first so a long backfill never delays them.
+                backfill_range = util.get_backfill_range(helper)
+                if backfill_range and is_entity_endpoint:
+                    helper.log_warning(f"correlation_id: {helper.correlation_id}, entities are snapshots, skipping backfill")
+                elif backfill_range:
+                    backfill_start, backfill_end = backfill_range
+                    backfill_workers = util.parse_backfill_workers(helper.get_arg("dynatrace_backfill_workers"))
+                    for selector in selectors:
+                        try:
+                            util.run_backfill(
+                                helper,
+                                util.get_checkpoint_key(input_name, "backfill", endpoint_string, selector, backfill_start, backfill_end),
+                                backfill_start,
+                                backfill_end,
+                                lambda chunk_start, chunk_end: run_session({'time': chunk_start, 'end_time': chunk_end},
+                                                                           [selector] if selector else None),
+                                write_records,
+                                max_workers=backfill_workers,
+                            )
+                        except util.DynatraceCollectionError as e:
+                            helper.log_error(f"correlation_id: {helper.correlation_id}, backfill failed, it resumes next run: {e}")
+        except util.RunDeadlineExceeded as e:
+            util.log_run_cut_short(helper, e)
+
+        if not counter:
             helper.log_warning(f'No data returned from Dynatrace API for endpoint: {endpoint}')
 
-        helper.log_info(f"correlation_id: {helper.correlation_id}, {counter} events written to index: {index}")
+        helper.log_info(f"correlation_id: {helper.correlation_id}, {counter} events ({event_bytes} bytes) written to index: {index}, "
+                        f"cut short: {bool(deadline and deadline.cut_short)}")
 
 
     def get_account_fields(self):
@@ -78,6 +78,7 @@ class ModInputdynatrace_entity(base_mi.BaseModInput):
     def validate_input(helper, definition):
         pass
 
+    @util.guard_run
     def collect_events(helper, ew):
 
         '''
@@ -119,9 +120,16 @@ class ModInputdynatrace_entity(base_mi.BaseModInput):
                       'endTimestamp': str(current_time)
                       }
 
+        # Endpoints left when most of the input interval has passed are skipped
+        util.start_run_deadline(helper)
         for endpoint in opt_dynatrace_entity_endpoints:
+            try:
+                timeout = util.get_send_timeout(helper)
+            except util.RunDeadlineExceeded as e:
+                util.log_run_cut_short(helper, e)
+                break
             response = helper.send_http_request(api_url + endpoint, "GET", headers=headers, parameters=parameters,
-                                                payload=None, cookies=None, verify=opt_ssl_certificate_verification, cert=None, timeout=None,
+                                                payload=None, cookies=None, verify=opt_ssl_certificate_verification, cert=None, timeout=timeout,
                                                 use_proxy=True)
             try:
                 response.raise_for_status()
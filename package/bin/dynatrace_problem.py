@@ -84,6 +84,7 @@ class ModInputdynatrace_problem(base_mi.BaseModInput):
         # dynatrace_collection_interval = definition.parameters.get('dynatrace_collection_interval', None)
         pass
 
+    @util.guard_run
     def collect_events(helper, ew):
 
         '''
@@ -119,9 +120,11 @@ class ModInputdynatrace_problem(base_mi.BaseModInput):
 
         # helper.log_debug("url: " + url)
 
+        # A single request, its read timeout is capped at the run deadline
+        util.start_run_deadline(helper)
         response = helper.send_http_request(api_url, "GET", headers=headers, parameters=None, payload=None,
                                             cookies=None, verify=opt_ssl_certificate_verification, cert=None,
-                                            timeout=None, use_proxy=True)
+                                            timeout=util.get_send_timeout(helper), use_proxy=True)
         try:
             response.raise_for_status()
         except:
@@ -92,6 +92,7 @@ class ModInputdynatrace_timeseries_metrics(base_mi.BaseModInput):
         # dynatrace_collection_interval = definition.parameters.get('dynatrace_collection_interval', None)
         pass
 
+    @util.guard_run
     def collect_events(helper, ew):
         ''' Updated for Splunk 8 '''
         '''SSL Verification'''
@@ -178,10 +179,20 @@ class ModInputdynatrace_timeseries_metrics(base_mi.BaseModInput):
          Make an API Call and format the results into a Splunk Event
         '''
 
+        # Metrics left when most of the input interval has passed are skipped, the next run queries them again
+        deadline = util.start_run_deadline(helper)
+
         def send_data(contains_aggregate=None):
+            if deadline and deadline.cut_short:
+                return
+            try:
+                timeout = util.get_send_timeout(helper)
+            except util.RunDeadlineExceeded as e:
+                util.log_run_cut_short(helper, e)
+                return
             response = helper.send_http_request(api_url, "GET", headers=headers, parameters=parameters, payload=None,
                                                 cookies=None, verify=opt_ssl_certificate_verification, cert=None,
-                                                timeout=None, use_proxy=True)
+                                                timeout=timeout, use_proxy=True)
             try:
                 response.raise_for_status()
             except:
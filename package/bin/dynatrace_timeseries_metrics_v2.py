@@ -25,6 +25,7 @@ from solnlib.modular_input import checkpointer
 from splunktaucclib.modinput_wrapper import base_modinput  as base_mi 
 import util
 from util import Endpoint
+import metrics_util
 from metrics_util import parse_metric_selectors_text_area
 from dynatrace_types_37 import *
 
@@ -55,7 +56,8 @@ def use_single_instance_mode():
 class ModInputdynatrace_timeseries_metrics_v2(base_mi.BaseModInput):
 
     def __init__(self):
-        use_single_instance = False
+        # Daemon mode runs every stanza in one long-lived process, see util.run_daemon
+        use_single_instance = util.is_daemon_mode_enabled()
         self.correlation_id = uuid.uuid4()
         super(ModInputdynatrace_timeseries_metrics_v2, self).__init__("splunk_ta_dynatrace", "dynatrace_timeseries_metrics_v2", use_single_instance)
         self.global_checkbox_fields = None
@@ -89,6 +91,30 @@ class ModInputdynatrace_timeseries_metrics_v2(base_mi.BaseModInput):
                                          description="",
                                          required_on_create=True,
                                          required_on_edit=False))
+        scheme.add_argument(smi.Argument("dynatrace_backfill_start", title="Backfill Start",
+                                         description="Start of a historical range to load once, ISO 8601 or epoch milliseconds.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("dynatrace_backfill_end", title="Backfill End",
+                                         description="End of the historical range to load, ISO 8601 or epoch milliseconds.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("dynatrace_backfill_workers", title="Backfill Workers",
+                                         description="Number of backfill chunks fetched in parallel.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("dynatrace_resolution", title="Resolution",
+                                         description="Resolution of the queried datapoints, auto picks the finest one available.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("dynatrace_drop_null_values", title="Drop Null Values",
+                                         description="Drop null and NaN datapoints before they are written.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
+        scheme.add_argument(smi.Argument("dynatrace_output_mode", title="Output Mode",
+                                         description="Write one event per datapoint, one event per series, or multi-metric measurements to a metrics index.",
+                                         required_on_create=False,
+                                         required_on_edit=False))
 
         return scheme
 
@@ -103,6 +129,7 @@ class ModInputdynatrace_timeseries_metrics_v2(base_mi.BaseModInput):
         # dynatrace_collection_interval = definition.parameters.get('dynatrace_collection_interval', None)
         pass
 
+    @util.guard_run
     def collect_events(helper, ew):
         helper.log_debug('Beginning collect_events')
 
@@ -115,54 +142,129 @@ class ModInputdynatrace_timeseries_metrics_v2(base_mi.BaseModInput):
         opt_dynatrace_collection_interval_minutes = int(helper.get_arg("dynatrace_collection_interval"))
 
         metric_selectors = parse_metric_selectors_text_area(helper.get_arg('dynatrace_metric_selectors_v2_textarea'))
+        output_mode = metrics_util.parse_output_mode(helper.get_arg('dynatrace_output_mode'))
+        drop_null = metrics_util.parse_drop_null_values(helper.get_arg('dynatrace_drop_null_values'))
+        opt_resolution = helper.get_arg('dynatrace_resolution')
         opt_ssl_certificate_verification = True
 
         helper.log_debug(f'verify_ssl: {opt_ssl_certificate_verification}')
         helper.log_debug(f'dynatrace_tenant: {tenant}')
         helper.log_debug(f'dynatrace_collection_interval_minutes: {opt_dynatrace_collection_interval_minutes}')
         helper.log_debug(f'metric_selectors: {metric_selectors}')
-
-        metric_descriptor_list: List[MetricDescriptorCollection] = util.execute_session(Endpoint.METRICS, tenant, api_token, Params({}), metric_selectors, opt_helper=helper)
-
-        metric_descriptor_mapping = {}
-        for metric_descriptor in metric_descriptor_list:
-            metrics = metric_descriptor.get('metrics')
-            for metric in metrics:
-                metric_id = metric.get('metricId')
-                unit = metric.get('unit')
-                aggregation_types = metric.get('aggregationTypes')
-                metric_descriptor_mapping[metric_id] = (unit, aggregation_types)
-
-        params = {'time': util.get_from_time(opt_dynatrace_collection_interval_minutes)}
-
-        metric_data_list = list(
-            util.execute_session(Endpoint.METRICS_QUERY, tenant, api_token, params, extra_params=metric_selectors, opt_helper=helper))
-
-        for metric_data in metric_data_list:
-            result = metric_data.get('result')
-            resolution = metric_data.get('resolution')
-            for metric_series_collection in result:
-                metric_id = metric_series_collection.get('metricId')
-                data = metric_series_collection.get('data')
-                unit, aggregation_types = metric_descriptor_mapping.get(metric_id, (None, None))
-                for metric_series in data:
-                    dimensions = metric_series.get('dimensions')
-                    dimension_map = metric_series.get('dimensionMap')
-                    for timestamp, value in zip(metric_series.get('timestamps'), metric_series.get('values')):
-                        event_data = {
-                            'timestamp': timestamp,
-                            'value': value,
-                            'metric_id': metric_id,
-                            'unit': unit,
-                            'aggregation_types': aggregation_types,
-                            'dynatraceTenant': tenant,
-                            'resolution': resolution,
-                            'dimensions': dimensions,
-                            'dimension_map': dimension_map
-                        }
-                        serialized = json.dumps(event_data)
-                        event = helper.new_event(data=serialized, time=timestamp, index=index)
-                        ew.write_event(event)
+        helper.log_debug(f'output_mode: {output_mode}')
+        helper.log_debug(f'drop_null: {drop_null}')
+        helper.log_debug(f'resolution: {opt_resolution}')
+
+        metric_descriptor_catalog = metrics_util.refresh_metric_descriptor_catalog(tenant, api_token, metric_selectors, opt_helper=helper)
+        metric_descriptor_mapping = metrics_util.get_metric_descriptor_mapping(metric_descriptor_catalog)
+        metric_entity_types = metrics_util.get_metric_entity_types(metric_descriptor_catalog)
+
+        input_name = helper.get_input_stanza_names()
+        event_count = 0
+        event_bytes = 0
+        datapoint_counter = {'dropped_count': 0}
+
+        def write_metric_data(metric_data):
+            nonlocal event_count, event_bytes
+            if output_mode == metrics_util.OUTPUT_MODE_METRICS:
+                for measurement in metrics_util.build_metric_measurements([metric_data], metric_descriptor_mapping, tenant,
+                                                                         counter=datapoint_counter):
+                    serialized = json.dumps(measurement)
+                    event = helper.new_event(data=serialized, time=measurement['timestamp'] / 1000, index=index,
+                                             sourcetype=metrics_util.METRICS_INDEX_SOURCETYPE)
+                    ew.write_event(event)
+                    event_count += 1
+                    event_bytes += len(serialized)
+            elif output_mode == metrics_util.OUTPUT_MODE_SERIES:
+                for series_event in metrics_util.build_series_events(metric_data, metric_descriptor_mapping, tenant,
+                                                                    drop_null=drop_null, counter=datapoint_counter):
+                    serialized = json.dumps(series_event)
+                    event = helper.new_event(data=serialized, time=series_event['timestamp'] / 1000, index=index,
+                                             sourcetype=metrics_util.SERIES_SOURCETYPE)
+                    ew.write_event(event)
+                    event_count += 1
+                    event_bytes += len(serialized)
+            else:
+                for event_data in metrics_util.build_datapoint_events(metric_data, metric_descriptor_mapping, tenant,
+                                                                     drop_null=drop_null, counter=datapoint_counter):
+                    serialized = json.dumps(event_data)
+                    event = helper.new_event(data=serialized, time=event_data['timestamp'] / 1000, index=index)
+                    ew.write_event(event)
+                    event_count += 1
+                    event_bytes += len(serialized)
+
+        def write_metric_data_pages(metric_data_pages):
+            for metric_data in metric_data_pages:
+                write_metric_data(metric_data)
+
+        def query_chunk(selector_group, chunk_start, chunk_end):
+            resolution, sub_windows = metrics_util.plan_metric_query_windows(chunk_start, chunk_end, opt_resolution)
+            return metrics_util.query_metric_selector_windows(tenant, api_token, sub_windows, resolution, selector_group,
+                                                              opt_helper=helper, metric_entity_types=metric_entity_types,
+                                                              max_workers=1)
+
+        # Requests stop once the run has used up most of the input interval, unfinished windows resume next run
+        deadline = util.start_run_deadline(helper)
+        try:
+            # One watermark per input and selector, windows are [from, to) so no datapoint is fetched twice.
+            # Selectors at the same watermark share their windows and are packed into multi-selector queries.
+            checkpoint_keys = {metric_selector: util.get_checkpoint_key(input_name, Endpoint.METRICS_QUERY.name, metric_selector)
+                               for metric_selector in metric_selectors}
+            selectors_by_window_state = {}
+            for metric_selector, checkpoint_key in checkpoint_keys.items():
+                selectors_by_window_state.setdefault(util.get_window_state(helper, checkpoint_key), []).append(metric_selector)
+
+            for (watermark, pending_end), watermark_selectors in selectors_by_window_state.items():
+                windows = util.plan_time_windows(watermark,
+                                                 opt_dynatrace_collection_interval_minutes,
+                                                 window_minutes=opt_dynatrace_collection_interval_minutes,
+                                                 settle_minutes=metrics_util.METRICS_QUERY_SETTLE_MINUTES,
+                                                 pending_end=pending_end,
+                                                 align_minutes=metrics_util.get_resolution_minutes(opt_resolution) or 1)
+                for selector_group in metrics_util.pack_metric_selectors(watermark_selectors):
+                    def collect_window(window_start, window_end, resume, checkpoint, selector_group=selector_group):
+                        # An explicit resolution, long windows are split into sub-windows under the datapoint budget
+                        resolution, sub_windows = metrics_util.plan_metric_query_windows(window_start, window_end, opt_resolution)
+
+                        # Pages are written as they arrive, only a bounded number of them is held in memory.
+                        # Written sub-windows are checkpointed, a failed window is replayed from the one that failed.
+                        write_metric_data_pages(metrics_util.query_metric_selector_windows(
+                            tenant, api_token, sub_windows, resolution, selector_group,
+                            opt_helper=helper, metric_entity_types=metric_entity_types, resume=resume,
+                            sub_window_done=checkpoint))
+
+                    util.collect_windows(helper,
+                                         [checkpoint_keys[metric_selector] for metric_selector in selector_group],
+                                         windows,
+                                         collect_window,
+                                         pending_end=pending_end)
+
+            # A configured historical range is loaded with the time regular collection left, its progress survives
+            # restarts. Live windows come first so a long backfill never delays them.
+            backfill_range = util.get_backfill_range(helper)
+            if backfill_range:
+                backfill_start, backfill_end = backfill_range
+                backfill_workers = util.parse_backfill_workers(helper.get_arg('dynatrace_backfill_workers'))
+                # Chunks hold one datapoint budget per series at the resolution of the start of the range
+                _, resolution_minutes = metrics_util.select_resolution(backfill_start, resolution=opt_resolution)
+                for selector_group in metrics_util.pack_metric_selectors(metric_selectors):
+                    try:
+                        util.run_backfill(helper,
+                                          util.get_checkpoint_key(input_name, 'backfill', Endpoint.METRICS_QUERY.name, *selector_group,
+                                                                  backfill_start, backfill_end),
+                                          backfill_start,
+                                          backfill_end,
+                                          lambda chunk_start, chunk_end: query_chunk(selector_group, chunk_start, chunk_end),
+                                          write_metric_data_pages,
+                                          chunk_minutes=resolution_minutes * metrics_util.METRICS_QUERY_MAX_DATAPOINTS,
+                                          max_workers=backfill_workers)
+                    except util.DynatraceCollectionError as e:
+                        helper.log_error(f"correlation_id: {helper.correlation_id}, backfill failed, it resumes next run: {e}")
+        except util.RunDeadlineExceeded as e:
+            util.log_run_cut_short(helper, e)
+
+        helper.log_info(f"correlation_id: {helper.correlation_id}, {event_count} events ({event_bytes} bytes) written to index: {index}, "
+                        f"{datapoint_counter['dropped_count']} null datapoints dropped, cut short: {bool(deadline and deadline.cut_short)}")
 
     def get_account_fields(self):
         account_fields= []
@@ -172,6 +274,7 @@ class ModInputdynatrace_timeseries_metrics_v2(base_mi.BaseModInput):
     def get_checkbox_fields(self):
         checkbox_fields= []
         checkbox_fields.append("ssl_certificate_verification")
+        checkbox_fields.append("dynatrace_drop_null_values")
         return checkbox_fields
 
     def get_global_checkbox_fields(self):
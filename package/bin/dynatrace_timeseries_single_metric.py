@@ -84,6 +84,7 @@ class ModInputdynatrace_timeseries_single_metric(base_mi.BaseModInput):
     def validate_input(self, definition):
         pass
 
+    @util.guard_run
     def collect_events(helper, ew):
         '''
         Verify SSL Certificate
@@ -124,9 +125,11 @@ class ModInputdynatrace_timeseries_single_metric(base_mi.BaseModInput):
                       }
         hecTime = 0
 
+        # A single request, its read timeout is capped at the run deadline
+        util.start_run_deadline(helper)
         response = helper.send_http_request(api_url, "GET", headers=headers, parameters=parameters, payload=None,
                                             cookies=None, verify=opt_ssl_certificate_verification, cert=None,
-                                            timeout=None, use_proxy=True)
+                                            timeout=util.get_send_timeout(helper), use_proxy=True)
         try:
             response.raise_for_status()
         except:
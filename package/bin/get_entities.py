@@ -22,6 +22,7 @@ LOGGER = logging.getLogger(__name__)
 class ConfigHandler(admin.MConfigHandler):
     def setup(self):
         self.supportedArgs.addReqArg("dynatrace_account")
+        self.supportedArgs.addOptArg("refresh")
 
     def _make_api_call(self, url, session_key):
         try:
@@ -122,6 +123,9 @@ class ConfigHandler(admin.MConfigHandler):
         if not tenant or not api_token:
             raise ValueError(f"Account '{stanza_name}' is missing tenant or API token.")
 
+        if util.is_truthy(self.callerArgs.get("refresh", ["0"])[0]):
+            util.invalidate_entity_type_cache(tenant)
+
         proxy_settings = self._get_proxy_settings(session_key)
         certificate_settings = self._get_certificate_settings(session_key)
         proxy_uri = rest_handler_util.get_proxy_uri(proxy_settings)
@@ -0,0 +1,77 @@
+"""metrics_dry_run.py: Estimate what a dynatrace_timeseries_metrics_v2 input collects per run, without writing events.
+
+Resolves the descriptor and dimension cardinalities of every selector and reports the expected series, requests,
+events and bytes per run, so heavy forwarders can be sized and runaway selectors caught before an input is enabled.
+
+    Usage (from the add-on's bin directory):
+        $SPLUNK_HOME/bin/splunk cmd python3 metrics_dry_run.py --tenant https://abc12345.live.dynatrace.com \\
+            --selectors-file selectors.txt --interval 5
+
+    The API token is read from the DYNATRACE_API_TOKEN environment variable, or from secrets.env when running
+    locally. It needs the metrics.read scope.
+"""
+import import_declare_test
+
+import argparse
+import json
+import os
+import sys
+
+import util
+import metrics_util
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Dry run a Dynatrace Timeseries Metrics API v2 input.')
+    parser.add_argument('--tenant', help='Dynatrace tenant URL, defaults to dynatrace_tenant from secrets.env')
+    parser.add_argument('--selectors-file', required=True,
+                        help="File with the metric selectors, as entered in the input's text area")
+    parser.add_argument('--interval', type=int, default=5, help='Dynatrace collection interval in minutes')
+    parser.add_argument('--output-mode', choices=metrics_util.OUTPUT_MODES, default=metrics_util.OUTPUT_MODE_EVENTS)
+    parser.add_argument('--json', action='store_true', help='Print the estimate as JSON')
+    return parser.parse_args(argv)
+
+
+def print_estimate(estimate):
+    print(f"{'series':>10} {'events':>12} {'bytes':>14}  metric selector")
+    for selector_estimate in estimate['selectors']:
+        notes = []
+        if selector_estimate['truncation_expected']:
+            notes.append('truncation expected, will be sharded')
+        if selector_estimate['unresolved']:
+            notes.append(f"no descriptor for {', '.join(selector_estimate['unresolved'])}")
+        print(f"{selector_estimate['series']:>10} {selector_estimate['events']:>12} {selector_estimate['bytes']:>14}  "
+              f"{selector_estimate['metric_selector']}{'  (' + '; '.join(notes) + ')' if notes else ''}")
+    print()
+    print(f"Per run of {estimate['interval_minutes']} minutes, output mode {estimate['output_mode']}:")
+    print(f"  requests: {estimate['requests']}")
+    print(f"  series:   {estimate['series']}")
+    print(f"  events:   {estimate['events']}")
+    print(f"  bytes:    {estimate['bytes']} ({estimate['bytes'] / 1024 / 1024:.1f} MiB)")
+
+
+def main(argv):
+    args = parse_args(argv)
+    secrets = util.parse_secrets_env() if not (args.tenant and os.environ.get('DYNATRACE_API_TOKEN')) else {}
+    tenant = args.tenant or secrets.get('dynatrace_tenant')
+    api_token = os.environ.get('DYNATRACE_API_TOKEN') or secrets.get('dynatrace_api_token')
+    if not tenant or not api_token:
+        print('A tenant and an API token are required, see --help', file=sys.stderr)
+        return 2
+    tenant = util.parse_url(tenant)
+
+    with open(args.selectors_file, 'r') as f:
+        metric_selectors = metrics_util.parse_metric_selectors_text_area(f.read())
+
+    descriptors = metrics_util.get_metric_cardinality_descriptors(tenant, api_token, metric_selectors)
+    estimate = metrics_util.estimate_metric_selectors(metric_selectors, descriptors, args.interval, tenant,
+                                                      args.output_mode)
+    if args.json:
+        print(json.dumps(estimate, indent=4))
+    else:
+        print_estimate(estimate)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,66 @@
 import datetime
 import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
 import time
 from pathlib import Path
-from typing import Dict, Union, List
+from typing import Dict, Optional, Tuple, Union, List
 
 import util
+from util import Endpoint
+import hashlib
 import requests
 import itertools
 import re
 from dynatrace_types_37 import *
 # from dynatrace_types import *
 
+# Metric datapoints arrive with some latency, the most recent minutes are collected on the next run
+METRICS_QUERY_SETTLE_MINUTES = 2
+
+# /api/v2/metrics/query accepts up to 10 comma separated selectors per request
+METRICS_QUERY_MAX_SELECTORS = 10
+# Warnings Dynatrace adds to a query result when series or datapoints were cut off
+METRICS_QUERY_TRUNCATION_PATTERN = re.compile(r'truncat|limited|exceed', re.IGNORECASE)
+# A truncated selector is queried again per shard of the entities of its descriptor's entity type
+METRICS_QUERY_SHARD_SIZE = 100
+METRICS_QUERY_SHARD_WORKERS = 4
+ENTITY_LIST_PAGE_SIZE = 500
+
+# Queries ask for an explicit resolution, the finest one Dynatrace still keeps for the age of the window:
+# (resolution, minutes per datapoint, retention in days)
+METRICS_QUERY_RESOLUTIONS = [
+    ('1m', 1, 14),
+    ('5m', 5, 28),
+    ('1h', 60, 400),
+    ('1d', 24 * 60, 5 * 365),
+]
+# Windows with more datapoints per series than this are split into sub-windows, fetched concurrently
+METRICS_QUERY_MAX_DATAPOINTS = 120
+METRICS_QUERY_WINDOW_WORKERS = 4
+# Series returned per metric before Dynatrace truncates the result
+METRICS_QUERY_MAX_SERIES = 1000
+METRIC_SELECTOR_LIMIT_PATTERN = re.compile(r':limit\((\d+)\)')
+METRIC_SELECTOR_DIMENSION_PATTERN = re.compile(r':(merge|splitBy)\(([^)]*)\)')
+
+# The v2 metrics input writes one event per datapoint, or multi-metric measurements for a metrics index
+OUTPUT_MODE_EVENTS = "events"
+OUTPUT_MODE_SERIES = "series"
+OUTPUT_MODE_METRICS = "metrics"
+OUTPUT_MODES = (OUTPUT_MODE_EVENTS, OUTPUT_MODE_SERIES, OUTPUT_MODE_METRICS)
+# Series events carry parallel timestamps/values arrays, the dynatrace_expand_series macro expands them at search time
+SERIES_SOURCETYPE = "dynatrace:metrics_v2:series"
+METRICS_INDEX_SOURCETYPE = "dynatrace:metrics_v2:metrics"
+METRIC_NAME_PREFIX = "metric_name:"
+
+# Metric descriptors are kept per tenant and refreshed with writtenSince between full refreshes
+METRIC_DESCRIPTOR_CATALOG_DIR = "metric_descriptor_catalog"
+METRIC_DESCRIPTOR_CATALOG_MAX_AGE_SECONDS = 24 * 60 * 60
+# Re-read descriptors written slightly before the last refresh to cover ingest latency
+METRIC_DESCRIPTOR_CATALOG_OVERLAP_MS = 5 * 60 * 1000
+
 
 def prepare_and_get_data(api_type, tenant, token, params, session, helper):
     request_info = util.prepare_dynatrace_params(api_type, token, tenant)
@@ -50,7 +98,22 @@ def parse_series(series: MetricSeries) -> List[DataPoint]:
     return series['data']
 
 
-def flatten_and_zip_timeseries(timeseries_data: MetricData):
+def is_null_value(value) -> bool:
+    """Return True for datapoints Dynatrace has no value for, null or NaN."""
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def count_dropped(counter: Optional[dict], dropped: int = 1):
+    if counter is not None:
+        counter['dropped_count'] = counter.get('dropped_count', 0) + dropped
+
+
+def parse_drop_null_values(value) -> bool:
+    """Null and NaN datapoints are dropped at the collector unless an input turns it off."""
+    return True if value is None or str(value).strip() == '' else util.is_truthy(value)
+
+
+def flatten_and_zip_timeseries(timeseries_data: MetricData, drop_null: bool = False, counter: Optional[dict] = None):
     series_collection: MetricSeriesCollection
     series: MetricSeries
     dimension_map_dict: DimensionMap
@@ -65,6 +128,9 @@ def flatten_and_zip_timeseries(timeseries_data: MetricData):
 
             # Iterate over each timestamp-value pair
             for timestamp, value in zip(timestamps_list, values_list):
+                if drop_null and is_null_value(value):
+                    count_dropped(counter)
+                    continue
                 # Create a new dictionary merging the 'dimension_map', 'timestamp', and 'value'
                 data_point = {
                     **dimension_map_dict,
@@ -87,6 +153,116 @@ def build_event_data(item: DataPoint, metric_descriptor: MetricDescriptor, opt_d
     return event_data
 
 
+def build_datapoint_events(metric_data: MetricData, metric_descriptor_mapping: Dict[MetricId, tuple], tenant: Tenant,
+                           drop_null: bool = False, counter: Optional[dict] = None):
+    """Yield one v2 metrics event per datapoint of a METRICS_QUERY response page.
+
+    With drop_null, null and NaN datapoints are counted in counter['dropped_count'] instead of being written.
+    """
+    resolution = metric_data.get('resolution')
+    for metric_series_collection in metric_data.get('result'):
+        metric_id = metric_series_collection.get('metricId')
+        unit, aggregation_types = metric_descriptor_mapping.get(metric_id, (None, None))
+        for metric_series in metric_series_collection.get('data'):
+            dimensions = metric_series.get('dimensions')
+            dimension_map = metric_series.get('dimensionMap')
+            for timestamp, value in zip(metric_series.get('timestamps'), metric_series.get('values')):
+                if drop_null and is_null_value(value):
+                    count_dropped(counter)
+                    continue
+                yield {
+                    'timestamp': timestamp,
+                    'value': value,
+                    'metric_id': metric_id,
+                    'unit': unit,
+                    'aggregation_types': aggregation_types,
+                    'dynatraceTenant': tenant,
+                    'resolution': resolution,
+                    'dimensions': dimensions,
+                    'dimension_map': dimension_map
+                }
+
+
+def build_series_events(metric_data: MetricData, metric_descriptor_mapping: Dict[MetricId, tuple], tenant: Tenant,
+                        drop_null: bool = False, counter: Optional[dict] = None):
+    """Yield one v2 metrics event per series of a METRICS_QUERY response page.
+
+    The dimensions are written once, the datapoints as parallel timestamps and values arrays. The event is
+    timestamped with the series' first datapoint. With drop_null, null and NaN datapoints are removed from both
+    arrays and counted in counter['dropped_count'].
+    """
+    resolution = metric_data.get('resolution')
+    for metric_series_collection in metric_data.get('result'):
+        metric_id = metric_series_collection.get('metricId')
+        unit, aggregation_types = metric_descriptor_mapping.get(metric_id, (None, None))
+        for metric_series in metric_series_collection.get('data'):
+            timestamps = metric_series.get('timestamps') or []
+            values = metric_series.get('values') or []
+            if drop_null:
+                datapoints = [(timestamp, value) for timestamp, value in zip(timestamps, values)
+                              if not is_null_value(value)]
+                count_dropped(counter, len(timestamps) - len(datapoints))
+                timestamps = [timestamp for timestamp, _ in datapoints]
+                values = [value for _, value in datapoints]
+            if not timestamps:
+                continue
+            yield {
+                'timestamp': timestamps[0],
+                'metric_id': metric_id,
+                'unit': unit,
+                'aggregation_types': aggregation_types,
+                'dynatraceTenant': tenant,
+                'resolution': resolution,
+                'dimensions': metric_series.get('dimensions'),
+                'dimension_map': metric_series.get('dimensionMap'),
+                'timestamps': timestamps,
+                'values': values,
+            }
+
+
+def parse_output_mode(value) -> str:
+    """Return the configured output mode, falling back to one event per datapoint."""
+    output_mode = str(value).strip().lower() if value else OUTPUT_MODE_EVENTS
+    return output_mode if output_mode in OUTPUT_MODES else OUTPUT_MODE_EVENTS
+
+
+def build_metric_measurements(metric_data_list: List[MetricData], metric_descriptor_mapping: Dict[MetricId, tuple],
+                              tenant: Tenant, counter: Optional[dict] = None):
+    """Yield Splunk multi-metric measurements for METRICS_QUERY response pages.
+
+    Datapoints sharing a timestamp, dimensions, unit and aggregation types are written as one measurement with a
+    metric_name:<metricId> field per metric, the dimensions become the measurement's dimension fields. Null and NaN
+    values are always dropped, a metrics index cannot store them, and counted in counter['dropped_count'].
+    """
+    measurements = {}
+    for metric_data in metric_data_list:
+        resolution = metric_data.get('resolution')
+        for metric_series_collection in metric_data.get('result'):
+            metric_id = metric_series_collection.get('metricId')
+            unit, aggregation_types = metric_descriptor_mapping.get(metric_id, (None, None))
+            aggregation_types = ','.join(aggregation_types) if aggregation_types else None
+            for metric_series in metric_series_collection.get('data'):
+                dimension_map = metric_series.get('dimensionMap') or {}
+                dimension_key = tuple(sorted(dimension_map.items()))
+                for timestamp, value in zip(metric_series.get('timestamps'), metric_series.get('values')):
+                    if is_null_value(value):
+                        count_dropped(counter)
+                        continue
+                    key = (timestamp, dimension_key, unit, aggregation_types, resolution)
+                    measurement = measurements.get(key)
+                    if measurement is None:
+                        measurement = measurements[key] = {
+                            **dimension_map,
+                            'timestamp': timestamp,
+                            'dynatraceTenant': tenant,
+                            'resolution': resolution,
+                            **({'unit': unit} if unit else {}),
+                            **({'aggregation_types': aggregation_types} if aggregation_types else {}),
+                        }
+                    measurement[METRIC_NAME_PREFIX + metric_id] = value
+    yield from measurements.values()
+
+
 def get_dynatrace_metrics_descriptors(tenant, api_token, metric_selector, time=None, page_size=100, verify=True):
     """Get Dynatrace metrics descriptors from the API v2.
 
@@ -168,3 +344,520 @@ def parse_metric_selectors_text_area(textarea_input: str) -> List[MetricSelector
 
     return parsed_metric_selectors
 
+
+
+def get_resolution_minutes(resolution: str) -> Optional[int]:
+    for name, minutes, _ in METRICS_QUERY_RESOLUTIONS:
+        if name == resolution:
+            return minutes
+    return None
+
+
+def select_resolution(window_start: int, now: Optional[int] = None, resolution: Optional[str] = None) -> Tuple[str, int]:
+    """Return the resolution to query a window with and its length in minutes.
+
+    A configured resolution is kept unless Dynatrace no longer stores it for data as old as window_start.
+    """
+    now = now if now is not None else util.get_from_time(0)
+    age_days = (now - window_start) / (24 * 60 * 60 * 1000)
+    configured_minutes = get_resolution_minutes(resolution) or 0
+    for name, minutes, retention_days in METRICS_QUERY_RESOLUTIONS:
+        if minutes >= configured_minutes and age_days <= retention_days:
+            return name, minutes
+    name, minutes, _ = METRICS_QUERY_RESOLUTIONS[-1]
+    return name, minutes
+
+
+def plan_metric_query_windows(window_start: int, window_end: int, resolution: Optional[str] = None,
+                              max_datapoints: int = METRICS_QUERY_MAX_DATAPOINTS,
+                              now: Optional[int] = None) -> Tuple[str, List[Tuple[int, int]]]:
+    """Pick an explicit resolution for a collection window and split it so no series exceeds max_datapoints.
+
+    The window is floored to whole buckets of the resolution and sub-window boundaries are aligned to the resolution,
+    so every datapoint falls into exactly one sub-window, and into exactly one of two consecutive windows queried at
+    the same resolution. A window within a single bucket has no sub-windows, the next window starts in that bucket.
+    """
+    resolution, resolution_minutes = select_resolution(window_start, now, resolution)
+    bucket = resolution_minutes * 60000
+    window_start, window_end = window_start // bucket * bucket, window_end // bucket * bucket
+    if window_start >= window_end:
+        return resolution, []
+    step = bucket * max(1, max_datapoints)
+    if window_end - window_start <= step:
+        return resolution, [(window_start, window_end)]
+
+    sub_windows = []
+    start_time = window_start
+    while start_time < window_end:
+        sub_window_end = min((start_time // step + 1) * step, window_end)
+        sub_windows.append((start_time, sub_window_end))
+        start_time = sub_window_end
+    return resolution, sub_windows
+
+
+def split_metric_selector(metric_selector: MetricSelector) -> List[str]:
+    """Split a selector on its top level commas, commas inside brackets or quotes belong to the selector."""
+    parts = []
+    depth = 0
+    quoted = False
+    escaped = False
+    start = 0
+    for index, char in enumerate(metric_selector):
+        if escaped:
+            escaped = False
+        elif char == '~':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(metric_selector[start:index].strip())
+            start = index + 1
+    parts.append(metric_selector[start:].strip())
+    return [part for part in parts if part]
+
+
+def pack_metric_selectors(metric_selectors: List[MetricSelector],
+                          max_selectors: int = METRICS_QUERY_MAX_SELECTORS) -> List[List[MetricSelector]]:
+    """Pack selectors into groups whose combined selector stays within the per-query selector limit.
+
+    Selectors keep their order, a selector that is already a list of max_selectors or more is queried on its own.
+    """
+    groups = []
+    group = []
+    group_size = 0
+    for metric_selector in metric_selectors:
+        size = len(split_metric_selector(metric_selector))
+        if group and group_size + size > max_selectors:
+            groups.append(group)
+            group = []
+            group_size = 0
+        group.append(metric_selector)
+        group_size += size
+    if group:
+        groups.append(group)
+    return groups
+
+
+def join_metric_selectors(metric_selectors: List[MetricSelector]) -> MetricSelector:
+    return MetricSelector(','.join(metric_selectors))
+
+
+def get_truncation_warnings(metric_data: MetricData) -> List[str]:
+    """Return the warnings of a query result, and of its series collections, that report truncated data."""
+    warnings = list(metric_data.get('warnings') or [])
+    for metric_series_collection in metric_data.get('result') or []:
+        warnings.extend(metric_series_collection.get('warnings') or [])
+    return [warning for warning in warnings if METRICS_QUERY_TRUNCATION_PATTERN.search(warning)]
+
+
+def get_entity_selector(entity_ids: List[str]) -> str:
+    return 'entityId({})'.format(','.join(json.dumps(entity_id) for entity_id in entity_ids))
+
+
+def get_metric_data_entity_type(metric_data_list: List[MetricData], metric_entity_types: Dict[MetricId, str]) -> Optional[str]:
+    """Return the entity type of the first metric in a query result whose descriptor has one."""
+    for metric_data in metric_data_list:
+        for metric_series_collection in metric_data.get('result') or []:
+            entity_type = metric_entity_types.get(metric_series_collection.get('metricId'))
+            if entity_type:
+                return entity_type
+    return None
+
+
+def keeps_entity_dimension(metric_data: MetricData, entity_type: str) -> bool:
+    """True when every series of a query result is split by the entities of entity_type.
+
+    Only such a selector can be queried in shards of entities, a selector aggregating across entities with :merge,
+    :splitBy or :fold would return a partial aggregate per shard.
+    """
+    dimension = 'dt.entity.' + entity_type.lower()
+    series = [metric_series for metric_series_collection in metric_data.get('result') or []
+              for metric_series in metric_series_collection.get('data') or []]
+    return bool(series) and all(dimension in (metric_series.get('dimensionMap') or {}) for metric_series in series)
+
+
+def list_entity_ids(tenant: Tenant, api_token: APIToken, params, entity_type: str, opt_helper=None,
+                    verify=None) -> List[str]:
+    """List the IDs of the entities of a type seen in the query window."""
+    entity_params = Params({'time': params['time'], 'pageSize': ENTITY_LIST_PAGE_SIZE})
+    if 'end_time' in params:
+        entity_params['end_time'] = params['end_time']
+    entities = util.execute_session(Endpoint.ENTITIES, tenant, api_token, entity_params, extra_params=[entity_type],
+                                    verify=verify, opt_helper=opt_helper)
+    return [entity['entityId'] for entity in entities if isinstance(entity, dict) and entity.get('entityId')]
+
+
+def query_metric_selector_shards(tenant: Tenant, api_token: APIToken, params, metric_selector: MetricSelector,
+                                 entity_ids: List[str], opt_helper=None, verify=None,
+                                 shard_size: int = METRICS_QUERY_SHARD_SIZE,
+                                 max_workers: int = METRICS_QUERY_SHARD_WORKERS):
+    """Query a selector once per shard of entity IDs, in parallel, and yield the results in shard order.
+
+    A shard that is still truncated is split in halves until it fits. At most max_workers shards are held in
+    memory at a time.
+    """
+    log = util.get_helper_log(opt_helper)
+
+    def query_shard(shard: List[str]) -> List[MetricData]:
+        shard_params = Params({**params, 'entitySelector': get_entity_selector(shard)})
+        metric_data_list = list(util.execute_session(Endpoint.METRICS_QUERY, tenant, api_token, shard_params,
+                                                     extra_params=[metric_selector], verify=verify,
+                                                     opt_helper=opt_helper))
+        truncated = any(get_truncation_warnings(metric_data) for metric_data in metric_data_list)
+        if truncated and len(shard) > 1:
+            middle = len(shard) // 2
+            return query_shard(shard[:middle]) + query_shard(shard[middle:])
+        if truncated:
+            log.warning('correlation_id: %s, metric selector %s is still truncated for entity %s',
+                        log.correlation_id, metric_selector, shard[0])
+        return metric_data_list
+
+    shards = [entity_ids[index:index + shard_size] for index in range(0, len(entity_ids), shard_size)]
+    if len(shards) > 1 and max_workers > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(shards))) as executor:
+            for index in range(0, len(shards), max_workers):
+                for result in executor.map(query_shard, shards[index:index + max_workers]):
+                    yield from result
+    else:
+        for shard in shards:
+            yield from query_shard(shard)
+
+
+def query_metric_selector_group(tenant: Tenant, api_token: APIToken, params, metric_selectors: List[MetricSelector],
+                                opt_helper=None, verify=None,
+                                metric_entity_types: Optional[Dict[MetricId, str]] = None,
+                                prefetch_pages: int = util.DEFAULT_PREFETCH_PAGES, resume=None):
+    """Query a packed group of selectors with one METRICS_QUERY call and yield its pages as they arrive.
+
+    Pages are prefetched at most prefetch_pages ahead, so memory does not grow with the size of the result. With resume
+    set the pages are not prefetched, their page keys are saved as they are fetched and must not get ahead of the pages
+    that were written. A group
+    whose first page is truncated, empty or rejected by Dynatrace is split in halves and queried again, so a single
+    selector never costs the rest of its group their data, a rejected single selector is skipped. Any other failure
+    is raised. A single truncated selector is sharded by the entities of its descriptor's entity type when that is
+    known and its series keep the entity dimension, otherwise the truncation is logged.
+    """
+    log = util.get_helper_log(opt_helper)
+    pages = util.execute_session(Endpoint.METRICS_QUERY, tenant, api_token, params,
+                                 extra_params=[join_metric_selectors(metric_selectors)],
+                                 verify=verify, opt_helper=opt_helper, resume=resume)
+    if resume is None:
+        pages = util.prefetch(pages, prefetch_pages)
+    try:
+        try:
+            first_page = next(pages, None)
+        except util.DynatraceCollectionError as e:
+            if not e.client_error:
+                raise
+            if len(metric_selectors) == 1:
+                log.error('correlation_id: %s, metric selector %s rejected, skipping it: %s',
+                          log.correlation_id, metric_selectors[0], e)
+                return
+            first_page = None
+        warnings = get_truncation_warnings(first_page) if first_page is not None else []
+
+        if len(metric_selectors) > 1 and (warnings or first_page is None):
+            pages.close()
+            log.warning('correlation_id: %s, splitting %s packed metric selectors, truncated: %s, warnings: %s',
+                        log.correlation_id, len(metric_selectors), bool(warnings), warnings)
+            middle = len(metric_selectors) // 2
+            for half in (metric_selectors[:middle], metric_selectors[middle:]):
+                yield from query_metric_selector_group(tenant, api_token, params, half, opt_helper, verify,
+                                                       metric_entity_types, prefetch_pages, resume)
+            return
+
+        if warnings:
+            entity_type = get_metric_data_entity_type([first_page], metric_entity_types or {})
+            if entity_type and not keeps_entity_dimension(first_page, entity_type):
+                entity_type = None
+            entity_ids = list_entity_ids(tenant, api_token, params, entity_type, opt_helper, verify) if entity_type else []
+            if entity_ids:
+                pages.close()
+                log.warning('correlation_id: %s, metric selector %s returned truncated data, querying %s %s entities '
+                            'in shards: %s', log.correlation_id, metric_selectors[0], len(entity_ids), entity_type,
+                            warnings)
+                yield from query_metric_selector_shards(tenant, api_token, params, metric_selectors[0], entity_ids,
+                                                        opt_helper, verify)
+                return
+            log.warning('correlation_id: %s, metric selector %s returned truncated data: %s',
+                        log.correlation_id, metric_selectors[0], warnings)
+
+        if first_page is not None:
+            yield first_page
+        for metric_data in pages:
+            warnings = get_truncation_warnings(metric_data)
+            if warnings:
+                log.warning('correlation_id: %s, metric selectors %s returned a truncated page: %s',
+                            log.correlation_id, join_metric_selectors(metric_selectors), warnings)
+            yield metric_data
+    finally:
+        pages.close()
+
+
+def query_metric_selector_windows(tenant: Tenant, api_token: APIToken, sub_windows: List[Tuple[int, int]],
+                                  resolution: str, metric_selectors: List[MetricSelector], opt_helper=None, verify=None,
+                                  metric_entity_types: Optional[Dict[MetricId, str]] = None,
+                                  max_workers: int = METRICS_QUERY_WINDOW_WORKERS, resume=None,
+                                  sub_window_done=None):
+    """Query a selector group over planned sub-windows and yield the pages in time order.
+
+    A single sub-window is streamed page by page. Several are fetched concurrently, at most max_workers at a time,
+    each bounded by the datapoint budget the planner split them by. sub_window_done(sub_window_end) is called once
+    the pages of a sub-window have all been taken, so a failed window is replayed from the sub-window that failed.
+    resume is passed to execute_session when streaming. Concurrent sub-windows are read whole before any of their
+    pages is yielded, they keep no page keys, a saved key would skip pages that were never written.
+    """
+    def query_window(sub_window, resume):
+        params = {'time': sub_window[0], 'end_time': sub_window[1], 'resolution': resolution}
+        return query_metric_selector_group(tenant, api_token, params, metric_selectors, opt_helper, verify,
+                                           metric_entity_types, resume=resume)
+
+    if len(sub_windows) <= 1 or max_workers <= 1:
+        for sub_window in sub_windows:
+            yield from query_window(sub_window, resume)
+            if sub_window_done:
+                sub_window_done(sub_window[1])
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(sub_windows))) as executor:
+        for index in range(0, len(sub_windows), max_workers):
+            batch = sub_windows[index:index + max_workers]
+            for sub_window, pages in zip(batch, executor.map(lambda sub_window: list(query_window(sub_window, None)),
+                                                             batch)):
+                yield from pages
+                if sub_window_done:
+                    sub_window_done(sub_window[1])
+
+
+def get_metric_cardinality_descriptors(tenant: Tenant, api_token: APIToken, metric_selectors: List[MetricSelector],
+                                       opt_helper=None, verify=None) -> Dict[MetricId, MetricDescriptor]:
+    """Fetch the descriptors of the selectors' metrics with their dimension definitions and cardinality estimates."""
+    descriptors = util.execute_session(Endpoint.METRIC_CARDINALITIES, tenant, api_token, Params({}), metric_selectors,
+                                       verify=verify, opt_helper=opt_helper)
+    return {descriptor['metricId']: descriptor for descriptor in descriptors
+            if isinstance(descriptor, dict) and descriptor.get('metricId')}
+
+
+def find_metric_descriptor(metric_selector: str, descriptors: Dict[MetricId, MetricDescriptor]) -> Optional[MetricDescriptor]:
+    """Return the descriptor of a single selector, by its full expression or else by its longest metric key prefix."""
+    if metric_selector in descriptors:
+        return descriptors[metric_selector]
+    metric_ids = [metric_id for metric_id in descriptors if metric_selector.startswith(metric_id + ':')]
+    return descriptors[max(metric_ids, key=len)] if metric_ids else None
+
+
+def get_selector_dimensions(metric_selector: str, descriptor: Optional[MetricDescriptor]) -> List[str]:
+    """Return the dimensions the series of a single selector are split by.
+
+    The descriptor's dimensions are narrowed in order by :merge, which drops the dimensions it names by key or by
+    position, and :splitBy, which keeps only the ones it names.
+    """
+    descriptor = descriptor or {}
+    dimensions = [definition.get('key') for definition in descriptor.get('dimensionDefinitions') or []]
+    if not dimensions:
+        dimensions = [cardinality.get('key') for cardinality in descriptor.get('dimensionCardinalities') or []]
+    for transformation, arguments in METRIC_SELECTOR_DIMENSION_PATTERN.findall(metric_selector):
+        names = [argument.strip().strip('"') for argument in arguments.split(',') if argument.strip()]
+        if transformation == 'splitBy':
+            dimensions = names
+            continue
+        merged = {dimensions[int(name)] if name.isdigit() and int(name) < len(dimensions) else name for name in names}
+        dimensions = [dimension for dimension in dimensions if dimension not in merged]
+    return dimensions
+
+
+def estimate_selector_series(metric_selector: str, descriptor: Optional[MetricDescriptor]) -> int:
+    """Estimate the series a single selector returns.
+
+    Series are split by every dimension left after :merge and :splitBy, so there are at least as many as the most
+    selective remaining dimension's estimate, and a single series when none is left. :limit(n) caps the estimate.
+    """
+    cardinalities: List[MetricDimensionCardinality] = (descriptor or {}).get('dimensionCardinalities') or []
+    estimates = {cardinality.get('key'): cardinality.get('estimate') or 0 for cardinality in cardinalities}
+    dimensions = get_selector_dimensions(metric_selector, descriptor)
+    series = max([estimates.get(dimension, 0) for dimension in dimensions] + [1])
+    limits = [int(limit) for limit in METRIC_SELECTOR_LIMIT_PATTERN.findall(metric_selector)]
+    return min([series] + limits)
+
+
+def get_sample_datapoint_event(metric_selector: str, descriptor: Optional[MetricDescriptor], tenant: Tenant,
+                               output_mode: str = OUTPUT_MODE_EVENTS, datapoints: int = 1) -> dict:
+    """Build an event shaped like the ones the input writes for a selector, to estimate event sizes."""
+    descriptor = descriptor or {}
+    dimension_map = {definition.get('key') or definition.get('name'): 'X' * 24
+                     for definition in descriptor.get('dimensionDefinitions') or []}
+    now = util.get_from_time(0)
+    metric_data = {
+        'resolution': '1m',
+        'result': [{'metricId': metric_selector,
+                    'data': [{'dimensions': list(dimension_map.values()), 'dimensionMap': dimension_map,
+                              'timestamps': [now + index * 60000 for index in range(datapoints)],
+                              'values': [0.123456789] * datapoints}]}],
+    }
+    mapping = {metric_selector: (descriptor.get('unit'), descriptor.get('aggregationTypes'))}
+    if output_mode == OUTPUT_MODE_METRICS:
+        return next(build_metric_measurements([metric_data], mapping, tenant))
+    if output_mode == OUTPUT_MODE_SERIES:
+        return next(build_series_events(metric_data, mapping, tenant))
+    return next(build_datapoint_events(metric_data, mapping, tenant))
+
+
+def estimate_metric_selectors(metric_selectors: List[MetricSelector], descriptors: Dict[MetricId, MetricDescriptor],
+                              interval_minutes: int, tenant: Tenant = '',
+                              output_mode: str = OUTPUT_MODE_EVENTS) -> dict:
+    """Estimate the requests, events and bytes one run of a v2 metrics input produces.
+
+    Returns a dict with one estimate per selector line and the per-run totals. Events are counted as one per
+    datapoint, or one per series in the series output mode. Measurements in the metrics output mode combine metrics
+    and are fewer.
+    """
+    now = util.get_from_time(0)
+    resolution, sub_windows = plan_metric_query_windows(now - interval_minutes * 60000, now, now=now)
+    datapoints_per_series = max(1, interval_minutes // get_resolution_minutes(resolution))
+    series_events = output_mode == OUTPUT_MODE_SERIES
+    selector_estimates = []
+    for metric_selector in metric_selectors:
+        series = 0
+        event_size = 0
+        unresolved = []
+        truncated = False
+        for part in split_metric_selector(metric_selector):
+            descriptor = find_metric_descriptor(part, descriptors)
+            if descriptor is None:
+                unresolved.append(part)
+            part_series = estimate_selector_series(part, descriptor)
+            truncated = truncated or part_series > METRICS_QUERY_MAX_SERIES
+            series += part_series
+            sample_event = get_sample_datapoint_event(part, descriptor, tenant, output_mode,
+                                                      datapoints_per_series if series_events else 1)
+            event_size = max(event_size, len(json.dumps(sample_event)))
+        datapoints = series * datapoints_per_series
+        events = series if series_events else datapoints
+        selector_estimates.append({
+            'metric_selector': metric_selector,
+            'series': series,
+            'datapoints': datapoints,
+            'events': events,
+            'bytes': events * event_size,
+            'truncation_expected': truncated,
+            'unresolved': unresolved,
+        })
+
+    return {
+        'interval_minutes': interval_minutes,
+        'output_mode': output_mode,
+        'selectors': selector_estimates,
+        'resolution': resolution,
+        # One descriptor catalog refresh plus one query per packed group and sub-window,
+        # truncated selectors add shard queries
+        'requests': 1 + len(pack_metric_selectors(metric_selectors)) * len(sub_windows),
+        'series': sum(estimate['series'] for estimate in selector_estimates),
+        'events': sum(estimate['events'] for estimate in selector_estimates),
+        'bytes': sum(estimate['bytes'] for estimate in selector_estimates),
+    }
+
+
+def get_metric_selectors_key(metric_selectors: List[MetricSelector]) -> str:
+    """Stable key of a selector list, used to keep one writtenSince watermark per input selector set."""
+    return hashlib.sha1("\n".join(sorted(metric_selectors)).encode("utf-8")).hexdigest()
+
+
+def load_metric_descriptor_catalog(tenant: Tenant) -> dict:
+    """Load the persisted descriptor catalog of a tenant with a single file read."""
+    with util.locked_json_state(util.get_state_file(METRIC_DESCRIPTOR_CATALOG_DIR, tenant)) as state:
+        catalog = dict(state)
+    if catalog.get('tenant') != tenant:
+        return {'tenant': tenant, 'descriptors': {}, 'watermarks': {}}
+    return catalog
+
+
+def save_metric_descriptor_catalog(catalog: dict) -> dict:
+    """Merge descriptors and watermarks into the persisted catalog of their tenant and return the merged catalog.
+
+    Every metrics input of a tenant shares the catalog, the read-modify-write holds its file lock so entries saved by
+    the other inputs in the meantime are kept.
+    """
+    with util.locked_json_state(util.get_state_file(METRIC_DESCRIPTOR_CATALOG_DIR, catalog['tenant'])) as state:
+        persisted = state if state.get('tenant') == catalog['tenant'] else {}
+        state.update({
+            'tenant': catalog['tenant'],
+            'descriptors': {**persisted.get('descriptors', {}), **catalog['descriptors']},
+            'watermarks': {**persisted.get('watermarks', {}), **catalog['watermarks']},
+        })
+        return dict(state)
+
+
+def merge_metric_descriptors(catalog: dict, metric_descriptor_list: List[MetricDescriptorCollection]) -> int:
+    """Merge pages of Endpoint.METRICS into the catalog. Returns the number of descriptors merged."""
+    merged = 0
+    for metric_descriptor in metric_descriptor_list:
+        for metric in metric_descriptor.get('metrics') or []:
+            catalog['descriptors'][metric.get('metricId')] = {
+                'unit': metric.get('unit'),
+                'aggregationTypes': metric.get('aggregationTypes'),
+                'entityType': metric.get('entityType'),
+            }
+            merged += 1
+    return merged
+
+
+def refresh_metric_descriptor_catalog(tenant: Tenant, api_token: APIToken, metric_selectors: List[MetricSelector],
+                                      opt_helper=None, verify=None) -> dict:
+    """Refresh the descriptor catalog of a tenant for the given selectors and return it.
+
+    The first run for a selector set (and every METRIC_DESCRIPTOR_CATALOG_MAX_AGE_SECONDS) fetches every descriptor,
+    later runs only ask for metrics written since the previous refresh.
+    """
+    catalog = load_metric_descriptor_catalog(tenant)
+    selectors_key = get_metric_selectors_key(metric_selectors)
+    watermark = catalog['watermarks'].get(selectors_key)
+    now_ms = util.get_from_time(0)
+
+    params = Params({})
+    if watermark and now_ms - watermark.get('full_refresh', 0) < METRIC_DESCRIPTOR_CATALOG_MAX_AGE_SECONDS * 1000:
+        params = Params({'time': watermark['refreshed'] - METRIC_DESCRIPTOR_CATALOG_OVERLAP_MS})
+
+    metric_descriptor_list = util.execute_session(Endpoint.METRICS, tenant, api_token, params, metric_selectors,
+                                                  verify=verify, opt_helper=opt_helper)
+    refreshed = {'tenant': tenant, 'descriptors': {}, 'watermarks': {}}
+    try:
+        merged = merge_metric_descriptors(refreshed, metric_descriptor_list)
+    except util.DynatraceCollectionError as e:
+        # Descriptors merged before the failure are kept in memory, the watermark stays for the next refresh
+        merged = 0
+        if opt_helper:
+            opt_helper.log_warning(f'correlation_id: {opt_helper.correlation_id}, '
+                                   f'metric descriptor refresh failed, using the cached catalog: {e}')
+
+    # An empty refresh keeps the old watermark, only what was refreshed is saved over the other inputs' entries
+    catalog['descriptors'].update(refreshed['descriptors'])
+    if merged:
+        refreshed['watermarks'][selectors_key] = {
+            'refreshed': now_ms,
+            'full_refresh': now_ms if 'time' not in params else watermark['full_refresh'],
+        }
+        catalog = save_metric_descriptor_catalog(refreshed)
+
+    if opt_helper:
+        opt_helper.log_info(f'correlation_id: {opt_helper.correlation_id}, '
+                            f'metric_descriptor_catalog: {len(catalog["descriptors"])} descriptors, '
+                            f'{merged} refreshed, incremental: {"time" in params}')
+    return catalog
+
+
+def get_metric_descriptor_mapping(catalog: dict) -> Dict[MetricId, tuple]:
+    """Return the catalog as the metric_id -> (unit, aggregation_types) mapping used by the metrics input."""
+    return {metric_id: (descriptor.get('unit'), descriptor.get('aggregationTypes'))
+            for metric_id, descriptor in catalog['descriptors'].items()}
+
+
+def get_metric_entity_types(catalog: dict) -> Dict[MetricId, str]:
+    """Return the primary entity type of every catalogued metric that has one."""
+    return {metric_id: descriptor['entityType'][0]
+            for metric_id, descriptor in catalog['descriptors'].items() if descriptor.get('entityType')}
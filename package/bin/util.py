@@ -1,17 +1,31 @@
 import os
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import logging
+import functools
+import weakref
+from datetime import datetime, timedelta, timezone
 from typing import Any, List, Optional, Tuple, Union
 import pickle
-from uuid import UUID
+from uuid import UUID, uuid4
+import configparser
 import urllib3
 from pathlib import Path
 import shutil
 import filecmp
 import math
+import hashlib
+from email.utils import parsedate_to_datetime
+import tempfile
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from enum import Enum
 from dataclasses import dataclass
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, urlsplit
+from contextlib import contextmanager
 from requests import Response, Request, PreparedRequest, Session
 import re
 import string
@@ -22,6 +36,15 @@ import json
 import certifi
 from string import Formatter
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
 # urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 """util.py: This module contains utility functions for the package. These functions are used by the package's scripts.
@@ -42,6 +65,8 @@ __license__ = "Splunk General Terms"
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 package_dir = os.path.dirname(script_dir)
+# State written by the add-on at runtime (certificates, caches, checkpoints) lives under local/
+local_dir = os.path.join(package_dir, "local")
 
 dynatrace_managed_uri_v2 = "https://{your-domain}/e/{your-environment-id}/api/v2"
 dynatrace_saas_uri_v2 = "https://{your-enviroment-id}.live.dynatrace.com/api/v2"
@@ -49,6 +74,95 @@ dynatrace_environment_active_gate_v2 = (
     "https://{your-domain}/e/{your-environment-id}/api/v2"
 )
 
+# Detail requests are issued serially unless an input asks for more workers
+DEFAULT_DETAIL_WORKERS = 1
+MAX_DETAIL_WORKERS = 32
+
+# Pages fetched ahead of the consumer when a response stream is prefetched on a background thread
+DEFAULT_PREFETCH_PAGES = 2
+
+# Checkpointed inputs catch up after downtime in windows of at most one collection interval,
+# but never further back than this
+MAX_CATCH_UP_MINUTES = 24 * 60
+
+# Backfills load a historical range in chunks, fetched in parallel and written in order. The semaphore bounds the
+# chunks in flight across every backfill running in the process.
+DEFAULT_BACKFILL_CHUNK_MINUTES = 60
+DEFAULT_BACKFILL_WORKERS = 4
+MAX_BACKFILL_WORKERS = 8
+backfill_semaphore = threading.BoundedSemaphore(MAX_BACKFILL_WORKERS)
+
+# Requests to a tenant are paced by a token bucket, 0 requests per minute only honors Dynatrace's rate limit headers.
+# Throttled (429) requests are retried in place, waits are capped so a run never sleeps for the whole interval.
+DEFAULT_REQUESTS_PER_MINUTE = 0
+MAX_RATE_LIMIT_RETRIES = 5
+MAX_RATE_LIMIT_WAIT_SECONDS = 60
+DEFAULT_RATE_LIMIT_BACKOFF_SECONDS = 1
+# Sessions and rate limiters outlive a run in daemon mode, the proxy, certificate and rate settings they were built
+# with are read again after this long so changes made in the UI take effect without a restart.
+RUNTIME_SETTINGS_TTL_SECONDS = 5 * 60
+
+# Transient failures (connection errors, timeouts, gateway errors) are retried in place with an exponential backoff.
+# The nextPageKey of the last delivered page is kept on disk so a failed or killed run resumes the page chain.
+RETRYABLE_STATUS_CODES = (408, 500, 502, 503, 504)
+MAX_PAGE_RETRIES = 3
+DEFAULT_PAGE_RETRY_BACKOFF_SECONDS = 1
+PAGE_CURSOR_DIR = "page_cursors"
+# Dynatrace page keys expire, older cursors are ignored and the chain starts over
+PAGE_CURSOR_TTL_SECONDS = 60 * 60
+
+# Every request has a connect and a read timeout, endpoints returning large pages may set a longer read timeout.
+# A run stops before the next request once RUN_DEADLINE_FRACTION of the input interval has passed, so a slow tenant
+# never overlaps the next scheduled run.
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10
+DEFAULT_READ_TIMEOUT_SECONDS = 60
+MIN_READ_TIMEOUT_SECONDS = 1
+RUN_DEADLINE_FRACTION = 0.9
+
+# A run takes a per-input lock, a run that finds its predecessor still going skips, waits for it or, once the
+# predecessor has held the lock for RUN_LOCK_STALE_INTERVALS intervals, runs alongside it
+RUN_LOCK_DIR = "run_locks"
+RUN_OVERLAP_SKIP = "skip"
+RUN_OVERLAP_WAIT = "wait"
+RUN_OVERLAP_TAKEOVER = "takeover"
+RUN_OVERLAP_POLICIES = (RUN_OVERLAP_SKIP, RUN_OVERLAP_WAIT, RUN_OVERLAP_TAKEOVER)
+DEFAULT_RUN_OVERLAP_POLICY = RUN_OVERLAP_SKIP
+RUN_LOCK_POLL_SECONDS = 1
+RUN_LOCK_STALE_INTERVALS = 2
+DEFAULT_RUN_LOCK_STALE_SECONDS = 60 * 60
+
+# In daemon mode one long-lived process per input type runs every stanza on its own interval, reusing sessions and
+# caches between runs. The setting is read from disk, splunkd asks for the input scheme before any session exists.
+SETTINGS_CONF_FILE = "splunk_ta_dynatrace_settings.conf"
+DAEMON_MODE_SETTING = "daemon_mode"
+DEFAULT_DAEMON_WORKERS = 8
+DEFAULT_DAEMON_INTERVAL_SECONDS = 300
+DAEMON_TICK_SECONDS = 1
+MAX_IDLE_SESSIONS = 4
+# A daemon serving many tenants bounds the connections and concurrent runs of each tenant, free workers go to the
+# tenant served least recently so one slow tenant cannot starve the others
+MAX_TENANT_CONNECTIONS = 10
+MAX_TENANT_RUNS = 2
+
+# Entity type property schemas rarely change, they are cached on disk per tenant
+ENTITY_TYPE_CACHE_DIR = "entity_type_cache"
+ENTITY_TYPE_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# 0 keeps one /entities/{entityId} request per entity, anything else batches entityId(...) lists
+DEFAULT_ENTITY_DETAIL_BATCH_SIZE = 0
+MAX_ENTITY_DETAIL_BATCH_SIZE = 100
+
+# Fields returned by /entities/{entityId} that the list endpoint only returns on request
+ENTITY_DETAIL_FIELDS = [
+    "+firstSeenTms",
+    "+lastSeenTms",
+    "+managementZones",
+    "+tags",
+    "+icon",
+    "+toRelationships",
+    "+fromRelationships",
+]
+
 
 @dataclass
 class EndpointInfo:
@@ -57,20 +171,30 @@ class EndpointInfo:
     params: Optional[Params]
     url_path_param: Optional[PathParam]
     extra_params: Optional[List[str]] = None
+    read_timeout: Optional[int] = None
 
 
 class Endpoint(Enum):
     METRICS = EndpointInfo(
         URL("/api/v2/metrics"),
         ResponseSelector("metrics"),
-        Params({"writtenSince": "{time}", "fields": "unit,aggregationTypes"}),
+        Params({"writtenSince": "{time}", "fields": "unit,aggregationTypes,entityType"}),
+        None,
+    )
+    METRIC_CARDINALITIES = EndpointInfo(
+        URL("/api/v2/metrics"),
+        ResponseSelector("metrics"),
+        Params({"fields": "unit,aggregationTypes,entityType,dimensionDefinitions,dimensionCardinalities"}),
         None,
     )
     METRICS_QUERY = EndpointInfo(
         URL("/api/v2/metrics/query"),
         ResponseSelector("result"),
-        Params({"from": "{time}", "metricSelector": "{metricSelector}"}),
+        Params(
+            {"from": "{time}", "to": "{end_time}", "metricSelector": "{metricSelector}"}
+        ),
         None,
+        read_timeout=120,
     )
     METRIC_DESCRIPTORS = EndpointInfo(
         URL("/api/v2/metrics/{metricKey}"),
@@ -81,7 +205,13 @@ class Endpoint(Enum):
     ENTITIES = EndpointInfo(
         URL("/api/v2/entities"),
         ResponseSelector("entities"),
-        Params({"entitySelector": 'type("{entitySelector}")', "from": "{time}"}),
+        Params(
+            {
+                "entitySelector": 'type("{entitySelector}")',
+                "from": "{time}",
+                "to": "{end_time}",
+            }
+        ),
         None,
         [
             "HOST",
@@ -98,6 +228,7 @@ class Endpoint(Enum):
             "CLOUD_APPLICATION_INSTANCE",
             "CONTAINER_GROUP_INSTANCE",
         ],
+        read_timeout=120,
     )
     ENTITY = EndpointInfo(
         URL("/api/v2/entities/{entityId}"),
@@ -105,6 +236,13 @@ class Endpoint(Enum):
         Params({"from": "{time}"}),
         PathParam("entityId"),
     )
+    # Same list endpoint as ENTITIES, selecting a batch of known entity IDs for entity details
+    ENTITIES_BY_ID = EndpointInfo(
+        URL("/api/v2/entities"),
+        ResponseSelector("entities"),
+        Params({"entitySelector": "entityId({entityIds})", "from": "{time}"}),
+        None,
+    )
     ENTITY_TYPES = EndpointInfo(
         URL("/api/v2/entityTypes/{entityType}"), None, None, PathParam("entityType")
     )
@@ -123,13 +261,13 @@ class Endpoint(Enum):
     PROBLEMS = EndpointInfo(
         URL("/api/v2/problems"),
         ResponseSelector("problems"),
-        Params({"from": "{time}"}),
+        Params({"from": "{time}", "to": "{end_time}"}),
         None,
     )
     EVENTS = EndpointInfo(
         URL("/api/v2/events"),
         ResponseSelector("events"),
-        Params({"from": "{time}"}),
+        Params({"from": "{time}", "to": "{end_time}"}),
         None,
     )
     SYNTHETIC_LOCATIONS = EndpointInfo(
@@ -138,7 +276,7 @@ class Endpoint(Enum):
     SYNTHETIC_TESTS_ON_DEMAND = EndpointInfo(
         URL("/api/v2/synthetic/executions"),
         ResponseSelector("executions"),
-        Params({"schedulingFrom": "{time}"}),
+        Params({"schedulingFrom": "{time}", "schedulingTo": "{end_time}"}),
         None,
     )
     SYNTHETIC_TEST_ON_DEMAND = EndpointInfo(
@@ -197,6 +335,12 @@ class Endpoint(Enum):
     def extra_params(self):
         return self.value.extra_params
 
+    @property
+    def read_timeout(self):
+        return (
+            self.value.read_timeout if isinstance(self.value, EndpointInfo) else None
+        )
+
     @classmethod
     def get_endpoint(cls, endpoint_value):
         try:
@@ -205,6 +349,91 @@ class Endpoint(Enum):
             return None
 
 
+class HelperLog:
+    """Logging facade over a modular input helper.
+
+    The debug level is checked once when the facade is created, debug messages use %-style arguments
+    that are only formatted when debug is enabled. With response_log_bytes > 0 the first bytes of every
+    response body are logged at INFO for troubleshooting, without enabling debug for the whole input.
+    """
+
+    def __init__(self, helper=None, response_log_bytes=0):
+        self.helper = helper
+        self.debug_enabled = is_debug_enabled(helper)
+        self.response_log_bytes = response_log_bytes
+
+    @property
+    def correlation_id(self):
+        return getattr(self.helper, "correlation_id", None)
+
+    def debug(self, msg, *args):
+        if self.debug_enabled:
+            self.helper.log_debug(msg % args if args else msg)
+
+    def info(self, msg, *args):
+        if self.helper:
+            self.helper.log_info(msg % args if args else msg)
+
+    def warning(self, msg, *args):
+        if self.helper:
+            self.helper.log_warning(msg % args if args else msg)
+
+    def error(self, msg, *args):
+        if self.helper:
+            self.helper.log_error(msg % args if args else msg)
+
+    def response_sample(self, response: Response):
+        if self.helper and self.response_log_bytes > 0:
+            sample = response.content[: self.response_log_bytes]
+            self.helper.log_info(
+                f"correlation_id: {self.correlation_id}, response sample "
+                f"({len(sample)} of {len(response.content)} bytes) {response.url}: "
+                f"{sample.decode('utf-8', errors='replace')}"
+            )
+
+
+def is_debug_enabled(helper) -> bool:
+    """Check whether a helper logs at DEBUG, without formatting anything."""
+    if helper is None:
+        return False
+    logger = getattr(helper, "logger", None)
+    if isinstance(logger, logging.Logger):
+        return logger.isEnabledFor(logging.DEBUG)
+    get_log_level = getattr(helper, "get_log_level", None)
+    level = get_log_level() if callable(get_log_level) else None
+    if isinstance(level, str):
+        return level.upper() == "DEBUG"
+    if isinstance(level, int):
+        return level <= logging.DEBUG
+    # Unknown helpers keep logging everything, as before
+    return True
+
+
+def parse_response_log_bytes(value) -> int:
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+# One facade per helper, the level and troubleshooting settings are resolved once per process
+helper_logs = weakref.WeakKeyDictionary()
+
+
+def get_helper_log(helper) -> HelperLog:
+    if helper is None:
+        return HelperLog()
+    log = helper_logs.get(helper)
+    if log is None:
+        get_global_setting = getattr(helper, "get_global_setting", None)
+        response_log_bytes = parse_response_log_bytes(
+            get_global_setting("response_log_bytes") if callable(get_global_setting) else None
+        )
+        log = HelperLog(helper, response_log_bytes)
+        helper_logs[helper] = log
+    return log
+
+
 def get_current_working_directory():
     """Get the current working directory.
 
@@ -276,6 +505,13 @@ def parse_url(url):
     return url
 
 
+def is_truthy(value) -> bool:
+    """Interpret checkbox and conf values ("1", "true", "yes", True) as a boolean."""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "t", "yes", "y", "on")
+
+
 # Parse secrets.env file
 def parse_secrets_env():
     """Parse the secrets.env file. Only used for testing, and running the scripts locally.
@@ -342,6 +578,218 @@ def get_from_time_utc(minutes: Optional[int] = 60) -> int:
     return from_time
 
 
+def is_windowed_endpoint(endpoint: Endpoint) -> bool:
+    """True if the endpoint takes a {time} start parameter, i.e. it can be collected in time windows."""
+    return bool(endpoint.params) and any(
+        "{time}" in value for value in endpoint.params.values()
+    )
+
+
+def plan_time_windows(
+    watermark: Optional[int],
+    interval_minutes: int,
+    window_minutes: Optional[int] = None,
+    now: Optional[int] = None,
+    settle_minutes: int = 0,
+    max_catch_up_minutes: int = MAX_CATCH_UP_MINUTES,
+    pending_end: Optional[int] = None,
+    align_minutes: Optional[int] = None,
+) -> List[Tuple[StartTime, EndTime]]:
+    """Split the time since the last watermark into consecutive [from, to) windows in milliseconds.
+
+    Without a watermark the first window starts interval_minutes ago, like get_from_time.
+    window_minutes bounds the size of each window, None returns a single window.
+    settle_minutes keeps the end of the last window away from now for data that is ingested late.
+    pending_end replays the window a cut short run left unfinished, so its saved page key still applies.
+    align_minutes floors the window boundaries to whole buckets of that many minutes, for endpoints that round
+    from and to to their resolution, so the bucket at a boundary is returned by exactly one of its windows.
+    """
+    align = (align_minutes or 0) * 60000 or 1
+    end_time = ((now if now is not None else get_from_time(0)) - settle_minutes * 60000) // align * align
+    start_time = watermark if watermark else (end_time - interval_minutes * 60000) // align * align
+    start_time = max(start_time, (end_time - max_catch_up_minutes * 60000) // align * align)
+
+    windows = []
+    if pending_end and watermark and start_time == watermark and start_time < pending_end:
+        windows.append((StartTime(start_time), EndTime(pending_end)))
+        start_time = pending_end
+    while start_time < end_time:
+        window_end = (
+            min((start_time + max(window_minutes * 60000, align)) // align * align, end_time)
+            if window_minutes
+            else end_time
+        )
+        windows.append((StartTime(start_time), EndTime(window_end)))
+        start_time = window_end
+    return windows
+
+
+def parse_backfill_time(value) -> Optional[int]:
+    """Parse an ISO 8601 timestamp (UTC unless it has an offset) or epoch milliseconds into epoch milliseconds."""
+    if value is None or str(value).strip() == "":
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def get_backfill_range(helper) -> Optional[Tuple[int, int]]:
+    """Return the backfill range configured on an input, None when there is none or it is not valid."""
+    try:
+        start_time = parse_backfill_time(helper.get_arg("dynatrace_backfill_start"))
+        end_time = parse_backfill_time(helper.get_arg("dynatrace_backfill_end"))
+    except ValueError as e:
+        helper.log_error(f"correlation_id: {helper.correlation_id}, invalid backfill time, skipping backfill: {e}")
+        return None
+    if start_time and not end_time:
+        helper.log_warning(f"correlation_id: {helper.correlation_id}, backfill start without an end, skipping backfill")
+        return None
+    return (start_time, end_time) if start_time else None
+
+
+def parse_backfill_workers(value, default=DEFAULT_BACKFILL_WORKERS) -> int:
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(workers, MAX_BACKFILL_WORKERS))
+
+
+def plan_backfill_chunks(
+    start_time: int, end_time: int, chunk_minutes: int = DEFAULT_BACKFILL_CHUNK_MINUTES
+) -> List[Tuple[StartTime, EndTime]]:
+    """Split [start_time, end_time) into consecutive chunks of at most chunk_minutes."""
+    chunks = []
+    while start_time < end_time:
+        chunk_end = min(start_time + chunk_minutes * 60000, end_time)
+        chunks.append((StartTime(start_time), EndTime(chunk_end)))
+        start_time = chunk_end
+    return chunks
+
+
+def run_backfill(
+    helper,
+    checkpoint_key,
+    start_time: int,
+    end_time: int,
+    fetch_chunk,
+    write_chunk,
+    chunk_minutes: int = DEFAULT_BACKFILL_CHUNK_MINUTES,
+    max_workers: int = DEFAULT_BACKFILL_WORKERS,
+) -> int:
+    """Load [start_time, end_time) in chunks, fetched in parallel and written in order.
+
+    fetch_chunk(chunk_start, chunk_end) returns the chunk's records and runs on a worker thread, write_chunk(records)
+    runs on the calling thread. Progress is checkpointed after every written chunk, so an interrupted backfill
+    resumes after the last chunk it wrote. A chunk that failed is not checkpointed, its error is raised once the
+    chunks before it are written. Returns the number of chunks written.
+    """
+    progress = get_watermark(helper, checkpoint_key)
+    chunks = plan_backfill_chunks(
+        max(start_time, progress) if progress is not None else start_time, end_time, chunk_minutes
+    )
+    if not chunks:
+        return 0
+
+    def fetch(chunk):
+        with backfill_semaphore:
+            return list(fetch_chunk(*chunk))
+
+    log = get_helper_log(helper)
+    log.info(
+        "correlation_id: %s, backfilling %s chunks from %s to %s, resumed: %s",
+        log.correlation_id,
+        len(chunks),
+        chunks[0][0],
+        end_time,
+        progress is not None,
+    )
+    workers = max(1, min(max_workers, MAX_BACKFILL_WORKERS, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Keep at most `workers` chunks in flight, write them in the order they were planned
+        pending = deque()
+        chunk_iterator = iter(chunks)
+        for chunk in chunk_iterator:
+            pending.append((chunk, executor.submit(fetch, chunk)))
+            if len(pending) >= workers:
+                break
+        while pending:
+            chunk, future = pending.popleft()
+            write_chunk(future.result())
+            save_watermark(helper, checkpoint_key, chunk[1])
+            next_chunk = next(chunk_iterator, None)
+            if next_chunk is not None:
+                pending.append((next_chunk, executor.submit(fetch, next_chunk)))
+    return len(chunks)
+
+
+def get_checkpoint_key(*parts) -> str:
+    """Checkpoint key for an input/endpoint/selector combination, safe for the KV store."""
+    return hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def get_window_state(helper, checkpoint_key) -> Tuple[Optional[int], Optional[int]]:
+    """Return the watermark and the end of the window a cut short run left unfinished, if any."""
+    state = helper.get_check_point(checkpoint_key)
+    if not isinstance(state, dict) or not state.get("end_time"):
+        return None, None
+    return int(state["end_time"]), int(state["pending_end"]) if state.get("pending_end") else None
+
+
+def get_watermark(helper, checkpoint_key) -> Optional[int]:
+    """Return the end time of the last successfully collected window."""
+    return get_window_state(helper, checkpoint_key)[0]
+
+
+def save_watermark(helper, checkpoint_key, end_time: int, pending_end: Optional[int] = None):
+    """Save the end of the last collected window, and the end of a window left unfinished by a cut short run."""
+    state = {"end_time": end_time}
+    if pending_end:
+        state["pending_end"] = pending_end
+    helper.save_check_point(checkpoint_key, state)
+
+
+def collect_windows(helper, checkpoint_keys, windows, collect_window, pending_end=None) -> bool:
+    """Collect consecutive windows in order and advance the watermarks after each window that succeeded.
+
+    collect_window(window_start, window_end, resume, checkpoint) is given the resume argument of execute_session
+    and a checkpoint(end_time) to call once everything before end_time has been written. A window that failed or
+    was cut short by the run deadline is saved as pending from its last checkpoint and stops the collection, the
+    next run replays the rest of it with resume True so its saved page keys continue the pagination.
+    RunDeadlineExceeded is re-raised. Returns whether every window was collected.
+    """
+    for index, (window_start, window_end) in enumerate(windows):
+        resume = index == 0 and pending_end is not None and window_end == pending_end
+        progress = [window_start]
+
+        def checkpoint(end_time, window_end=window_end, progress=progress):
+            progress[0] = end_time
+            for checkpoint_key in checkpoint_keys:
+                save_watermark(helper, checkpoint_key, end_time, pending_end=window_end)
+
+        try:
+            collect_window(window_start, window_end, resume, checkpoint)
+        except RunDeadlineExceeded:
+            for checkpoint_key in checkpoint_keys:
+                save_watermark(helper, checkpoint_key, progress[0], pending_end=window_end)
+            raise
+        except DynatraceCollectionError as e:
+            helper.log_error(
+                f"correlation_id: {helper.correlation_id}, collection of window {window_start} - {window_end} "
+                f"failed, it is replayed next run from {progress[0]}: {e}"
+            )
+            for checkpoint_key in checkpoint_keys:
+                save_watermark(helper, checkpoint_key, progress[0], pending_end=window_end)
+            return False
+        for checkpoint_key in checkpoint_keys:
+            save_watermark(helper, checkpoint_key, window_end)
+    return True
+
+
 def default_time_utc_written_since() -> WrittenSinceParam:
     """Return the current time in UTC minus 1 hour
     in unix epoch time in milliseconds with no decimals with the key written_since.
@@ -402,7 +850,7 @@ def format_params(endpoint: Endpoint, params: Params) -> Params:
     """Format and inject parameters according to the Endpoint Enum.
     Injects default parameters from V2Endpoints Enum,
                 Params Input: {}
-                -> {'fields': 'unit,aggregationTypes'} for METRICS,
+                -> {'fields': 'unit,aggregationTypes,entityType'} for METRICS,
     Formats default parameters from V2Endpoints Enum (if it exists)
                 Params Input: {'entitySelector': 'HOST'}
                 V2Endpoint Input: {'entitySelector': 'type(\"{entitySelector}\")'}
@@ -480,7 +928,7 @@ def prepare_dynatrace_params(base_url, endpoint: Endpoint, params, extra_params=
         for metric_selector in extra_params:
             prepared_params["metricSelector"] = metric_selector
             yield url, format_params(endpoint, prepared_params), endpoint
-    elif endpoint == Endpoint.METRICS and extra_params:
+    elif endpoint in (Endpoint.METRICS, Endpoint.METRIC_CARDINALITIES) and extra_params:
         # {'metricSelector': 'builtin:host.cpu.usage:merge(0):avg, metricselector2, etc...'}
         prepared_params["metricSelector"] = ",".join(extra_params)
         yield url, format_params(endpoint, prepared_params), endpoint
@@ -497,8 +945,7 @@ def prepare_dynatrace_params(base_url, endpoint: Endpoint, params, extra_params=
 
 
 def prepare_dynatrace_request(session: Session, url: URL, params: Params):
-    session.url = url
-    session.params = params
+    # Do not store url/params on the session, it is shared between detail workers
     return session.prepare_request(Request("GET", url, params=params))
 
 
@@ -536,6 +983,155 @@ def prepare_entity_property_params(entity_properties):
     return "fields=" + ",".join(url_entity_property_params)
 
 
+def parse_detail_workers(value, default=DEFAULT_DETAIL_WORKERS) -> int:
+    """Parse the detail worker count of an input, clamped to 1..MAX_DETAIL_WORKERS."""
+    try:
+        workers = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(workers, MAX_DETAIL_WORKERS))
+
+
+def parse_entity_detail_batch_size(
+    value, default=DEFAULT_ENTITY_DETAIL_BATCH_SIZE
+) -> int:
+    """Parse the entity detail batch size of an input, 0 disables batching."""
+    try:
+        batch_size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0, min(batch_size, MAX_ENTITY_DETAIL_BATCH_SIZE))
+
+
+def mount_connection_pool(session: Session, pool_size: int):
+    """Size the session connection pool so that every detail worker can keep a connection alive."""
+    # A reused session keeps a pool that is already large enough, and the connections in it
+    if getattr(session.get_adapter("https://"), "_pool_maxsize", 0) >= pool_size:
+        return
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def prefetch(iterable, buffer_size=DEFAULT_PREFETCH_PAGES):
+    """Iterate iterable on a background thread, at most buffer_size items ahead of the consumer.
+
+    Requests for the next pages overlap with writing the current one while memory stays bounded. Exceptions are
+    re-raised to the consumer, closing the returned generator stops the producer and closes iterable.
+    """
+    buffer = queue.Queue(maxsize=max(1, buffer_size))
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        error = None
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            error = e
+        finally:
+            close = getattr(iterable, "close", None)
+            if stopped.is_set() and callable(close):
+                close()
+        put((done, error))
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+class SessionRegistry:
+    """Idle sessions kept per tenant and token between runs, so runs of a daemon reuse their warm connections."""
+
+    def __init__(self, max_idle=MAX_IDLE_SESSIONS):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def checkout(self, key) -> Session:
+        with self.lock:
+            sessions = self.idle.get(key)
+            if sessions:
+                return sessions.pop()
+        return requests.Session()
+
+    def checkin(self, key, session: Session):
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            if len(sessions) < self.max_idle:
+                sessions.append(session)
+                return
+        # Closing the session must not close the tenant pool other sessions share
+        for prefix, adapter in list(session.adapters.items()):
+            if getattr(adapter, "dynatrace_tenant_pool", False):
+                del session.adapters[prefix]
+        session.close()
+
+
+# Only set in daemon mode, short-lived input processes close their sessions after every call
+session_registry: Optional[SessionRegistry] = None
+tenant_adapters = {}
+tenant_adapters_lock = threading.Lock()
+
+
+def get_tenant_prefix(tenant) -> str:
+    parts = urlsplit(tenant)
+    return f"{parts.scheme}://{parts.netloc}/" if parts.netloc else str(tenant)
+
+
+def get_tenant_adapter(tenant) -> HTTPAdapter:
+    """Bounded connection pool shared by every session to a tenant, requests wait for a free connection."""
+    prefix = get_tenant_prefix(tenant)
+    with tenant_adapters_lock:
+        adapter = tenant_adapters.get(prefix)
+        if adapter is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_TENANT_CONNECTIONS, pool_block=True)
+            adapter.dynatrace_tenant_pool = True
+            tenant_adapters[prefix] = adapter
+    return adapter
+
+
+@contextmanager
+def dynatrace_session(tenant, api_token):
+    """Session for one execute_session call, taken from the session registry when there is one."""
+    registry = session_registry
+    if registry is None:
+        with requests.Session() as session:
+            yield session
+        return
+    key = hashlib.sha1(f"{tenant}\n{api_token}".encode("utf-8")).hexdigest()
+    session = registry.checkout(key)
+    # The tenant prefix is longer than the scheme prefixes mount_connection_pool uses, so its pool always applies
+    prefix = get_tenant_prefix(tenant)
+    adapter = get_tenant_adapter(tenant)
+    if session.adapters.get(prefix) is not adapter:
+        session.mount(prefix, adapter)
+    try:
+        yield session
+    finally:
+        registry.checkin(key, session)
+
+
 def execute_session(
     endpoints: Union[Endpoint, Tuple[Endpoint, Endpoint]],
     tenant,
@@ -545,10 +1141,19 @@ def execute_session(
     proxy_uri=None,
     verify=None,
     opt_helper=None,
+    max_workers=DEFAULT_DETAIL_WORKERS,
+    detail_batch_size=DEFAULT_ENTITY_DETAIL_BATCH_SIZE,
+    resume=None,
 ):
+    """Yield the records of an endpoint, with the details of each one when detail endpoints are given.
+
+    resume is passed to the main request only, see _get_dynatrace_data. Detail requests are always read whole.
+    """
     params = Params(params)
+    if verify is None:
+        verify = get_ssl_certificate_verification(opt_helper)
 
-    with requests.Session() as session:
+    with dynatrace_session(tenant, api_token) as session:
         session.headers.update(prepare_dynatrace_headers(api_token))
 
         main_endpoint, detail_endpoints = parse_endpoints(endpoints)
@@ -561,29 +1166,43 @@ def execute_session(
             tenant, main_endpoint, params, extra_params
         )
 
+        executor = None
+        if detail_endpoints and max_workers > 1:
+            mount_connection_pool(session, max_workers)
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+
         counter = initialize_counter()
-        for result in get_dynatrace_data(
-            session,
-            prepared_params_list,
-            opt_helper,
-            proxy_uri=proxy_uri,
-            verify=verify,
-        ):
-            counter["session_loop_count"] += 1
-            if not detail_endpoints:
-                yield from process_main_results(result, counter)
-            else:
-                yield from process_detail_endpoints(
-                    result,
-                    detail_endpoints,
-                    tenant,
-                    extra_params,
-                    counter,
-                    session,
-                    opt_helper=opt_helper,
-                    proxy_uri=proxy_uri,
-                    verify=verify,
-                )
+        try:
+            for result in get_dynatrace_data(
+                session,
+                prepared_params_list,
+                opt_helper,
+                proxy_uri=proxy_uri,
+                verify=verify,
+                counter=counter,
+                resume=resume,
+            ):
+                counter["session_loop_count"] += 1
+                if not detail_endpoints:
+                    yield from process_main_results(result, counter)
+                else:
+                    yield from process_detail_endpoints(
+                        result,
+                        detail_endpoints,
+                        tenant,
+                        extra_params,
+                        counter,
+                        session,
+                        opt_helper=opt_helper,
+                        proxy_uri=proxy_uri,
+                        verify=verify,
+                        executor=executor,
+                        detail_batch_size=detail_batch_size,
+                        from_time=params.get("time"),
+                    )
+        finally:
+            if executor:
+                executor.shutdown(wait=True)
         log_counters(opt_helper, counter)
 
 
@@ -593,30 +1212,105 @@ def parse_endpoints(endpoints):
     return endpoints, []
 
 
+# Session counters are also updated from detail worker threads
+counter_lock = threading.Lock()
+
+
 def initialize_counter():
     return {
         "session_loop_count": 0,
         "item_count": 0,
         "result_count": 0,
         "detail_count": 0,
-        "item_size": 0,
-        "result_size": 0,
-        "detail_size": 0,
+        "detail_batch_count": 0,
+        "response_count": 0,
+        "response_size": 0,
     }
 
 
+def count_response(counter, response: Response):
+    """Add a response to the session counters, sized by its decoded body.
+
+    The body has already been received, so records are never re-serialized just to be measured. Content-Length is
+    not used, it is the compressed size when the response is gzipped.
+    """
+    if counter is None:
+        return
+    with counter_lock:
+        counter["response_count"] += 1
+        counter["response_size"] += len(response.content)
+
+
 def process_main_results(result, counter):
     if isinstance(result, list):
         for item in result:
             counter["item_count"] += 1
-            counter["item_size"] += len(json.dumps(item))
             yield item
     else:
         counter["result_count"] += 1
-        counter["result_size"] += len(json.dumps(result))
         yield result
 
 
+def fetch_detail_records(
+    session,
+    prepared_params_list,
+    opt_helper=None,
+    proxy_uri=None,
+    verify=None,
+    counter=None,
+):
+    """Fetch every page of a single detail request. Runs on a detail worker thread.
+
+    An object deleted since it was listed is skipped, any other failure is raised.
+    """
+    try:
+        return list(
+            get_dynatrace_data(
+                session,
+                prepared_params_list,
+                opt_helper,
+                proxy_uri=proxy_uri,
+                verify=verify,
+                counter=counter,
+            )
+        )
+    except DynatraceCollectionError as e:
+        if e.status_code != 404:
+            raise
+        log = get_helper_log(opt_helper)
+        log.warning("correlation_id: %s, skipping detail no longer found: %s", log.correlation_id, e)
+        return []
+
+
+def build_entity_fields(entity_properties) -> str:
+    """Build the list endpoint fields projection matching a single entity detail request."""
+    if entity_properties:
+        property_fields = [f'+properties.{prop["id"]}' for prop in entity_properties[0]]
+    else:
+        property_fields = ["+properties"]
+    return ",".join(ENTITY_DETAIL_FIELDS + property_fields)
+
+
+def prepare_entity_batch_params(tenant, entity_ids, entity_fields, from_time=None):
+    """Prepare an ENTITIES_BY_ID request for a batch of entity IDs."""
+    params = Params(
+        {
+            "time": from_time if from_time is not None else get_from_time(),
+            "entityIds": ",".join(json.dumps(entity_id) for entity_id in entity_ids),
+            "fields": entity_fields,
+            "pageSize": len(entity_ids),
+        }
+    )
+    return list(prepare_dynatrace_params(tenant, Endpoint.ENTITIES_BY_ID, params))
+
+
+def order_entity_batch(entity_ids, pages):
+    """Flatten the pages of a batch and return the entities in the requested order."""
+    position = {entity_id: index for index, entity_id in enumerate(entity_ids)}
+    entities = [entity for page in pages for entity in page]
+    return sorted(entities, key=lambda entity: position.get(entity.get("entityId"), len(position)))
+
+
 def process_detail_endpoints(
     result,
     detail_endpoints,
@@ -627,6 +1321,9 @@ def process_detail_endpoints(
     opt_helper=None,
     proxy_uri=None,
     verify=None,
+    executor=None,
+    detail_batch_size=DEFAULT_ENTITY_DETAIL_BATCH_SIZE,
+    from_time=None,
 ):
     if result:
         entity_properties, url_entity_property_params_string = (
@@ -639,64 +1336,162 @@ def process_detail_endpoints(
                 opt_helper=opt_helper,
                 proxy_uri=proxy_uri,
                 verify=verify,
+                counter=counter,
             )
         )
+        if detail_endpoints[0] == Endpoint.ENTITY and detail_batch_size > 0:
+            yield from process_entity_detail_batches(
+                result,
+                entity_properties,
+                tenant,
+                counter,
+                session,
+                detail_batch_size,
+                opt_helper=opt_helper,
+                proxy_uri=proxy_uri,
+                verify=verify,
+                executor=executor,
+                from_time=from_time,
+            )
+            return
+
+        detail_requests = []
         for record in result:
             counter["detail_count"] += 1
-            counter["detail_size"] += len(json.dumps(record))
             id = record[detail_endpoints[0].selector]
             params = Params(
                 {"time": get_from_time(), detail_endpoints[0].url_path_param: id}
             )
             if url_entity_property_params_string:
                 params["url_params"] = url_entity_property_params_string
-            prepared_params_list = prepare_dynatrace_params(
-                tenant, detail_endpoints[0], params, extra_params
+            detail_requests.append(
+                list(
+                    prepare_dynatrace_params(
+                        tenant, detail_endpoints[0], params, extra_params
+                    )
+                )
             )
-            for details in get_dynatrace_data(
-                session,
-                prepared_params_list,
-                opt_helper,
-                proxy_uri=proxy_uri,
-                verify=verify,
+
+        if executor is None:
+            for prepared_params_list in detail_requests:
+                yield from fetch_detail_records(
+                    session,
+                    prepared_params_list,
+                    opt_helper,
+                    proxy_uri=proxy_uri,
+                    verify=verify,
+                    counter=counter,
+                )
+        else:
+            # executor.map yields in submission order, so output order matches the serial path
+            for details in executor.map(
+                lambda prepared_params_list: fetch_detail_records(
+                    session,
+                    prepared_params_list,
+                    opt_helper,
+                    proxy_uri=proxy_uri,
+                    verify=verify,
+                    counter=counter,
+                ),
+                detail_requests,
             ):
-                yield details
+                yield from details
 
 
-def get_entity_properties_if_needed(
-    detail_endpoints,
+def process_entity_detail_batches(
     result,
+    entity_properties,
     tenant,
-    extra_params,
+    counter,
     session,
+    batch_size,
     opt_helper=None,
     proxy_uri=None,
     verify=None,
+    executor=None,
+    from_time=None,
 ):
-    entity_properties = []
-    url_entity_property_params_string = None
-    if detail_endpoints[0] == Endpoint.ENTITY and result[0].get("type"):
-        prepared_params_list = prepare_dynatrace_params(
-            tenant,
-            Endpoint.ENTITY_TYPES,
-            {"entityType": result[0].get("type")},
-            extra_params,
+    """Fetch entity details with one entityId(...) list request per batch of entities."""
+    entity_fields = build_entity_fields(entity_properties)
+    batches = []
+    for start in range(0, len(result), batch_size):
+        records = result[start : start + batch_size]
+        counter["detail_count"] += len(records)
+        entity_ids = [record[Endpoint.ENTITY.selector] for record in records]
+        batches.append(
+            (
+                entity_ids,
+                prepare_entity_batch_params(tenant, entity_ids, entity_fields, from_time),
+            )
         )
-        for details in get_dynatrace_data(
+        counter["detail_batch_count"] += 1
+
+    def fetch_batch(batch):
+        entity_ids, prepared_params_list = batch
+        pages = fetch_detail_records(
             session,
             prepared_params_list,
             opt_helper,
             proxy_uri=proxy_uri,
             verify=verify,
-        ):
-            entity_properties.append(details["properties"])
-        flattened_properties = entity_properties[0]
-        url_entity_property_params = [
-            f'+properties.{prop["id"]}' for prop in flattened_properties
-        ]
-        url_entity_property_params_string = "fields=" + ",".join(
-            url_entity_property_params
+            counter=counter,
         )
+        return entity_ids, order_entity_batch(entity_ids, pages)
+
+    fetched = executor.map(fetch_batch, batches) if executor else map(fetch_batch, batches)
+    for entity_ids, entities in fetched:
+        if opt_helper and len(entities) != len(entity_ids):
+            opt_helper.log_warning(
+                f"correlation_id: {opt_helper.correlation_id}, "
+                f"entity batch returned {len(entities)} of {len(entity_ids)} entities"
+            )
+        yield from entities
+
+
+def get_entity_properties_if_needed(
+    detail_endpoints,
+    result,
+    tenant,
+    extra_params,
+    session,
+    opt_helper=None,
+    proxy_uri=None,
+    verify=None,
+    counter=None,
+):
+    entity_properties = []
+    url_entity_property_params_string = None
+    entity_type = result[0].get("type") if detail_endpoints[0] == Endpoint.ENTITY else None
+    if entity_type:
+        cached_properties = get_cached_entity_type_properties(tenant, entity_type)
+        if cached_properties is not None:
+            entity_properties.append(cached_properties)
+        else:
+            prepared_params_list = prepare_dynatrace_params(
+                tenant,
+                Endpoint.ENTITY_TYPES,
+                {"entityType": entity_type},
+                extra_params,
+            )
+            for details in get_dynatrace_data(
+                session,
+                prepared_params_list,
+                opt_helper,
+                proxy_uri=proxy_uri,
+                verify=verify,
+                counter=counter,
+            ):
+                entity_properties.append(details["properties"])
+            if entity_properties:
+                cache_entity_type_properties(tenant, {entity_type: entity_properties[0]})
+        if entity_properties:
+            flattened_properties = entity_properties[0]
+            url_entity_property_params = [
+                f'+properties.{prop["id"]}' for prop in flattened_properties
+            ]
+            url_entity_property_params_string = "fields=" + ",".join(
+                url_entity_property_params
+            )
     return entity_properties, url_entity_property_params_string
 
 
@@ -714,8 +1509,12 @@ def list_dynatrace_entity_types(
     verify=None,
     opt_helper=None,
 ):
+    cached_entity_types = get_cached_entity_types(tenant)
+    if cached_entity_types is not None:
+        return cached_entity_types
+
     entity_types = []
-    seen_entity_types = set()
+    entity_type_properties = {}
     for item in execute_session(
         Endpoint.ENTITY_TYPES_LIST,
         tenant,
@@ -726,22 +1525,338 @@ def list_dynatrace_entity_types(
         opt_helper=opt_helper,
     ):
         entity_type = item.get("type") if isinstance(item, dict) else None
-        if entity_type and entity_type not in seen_entity_types:
-            seen_entity_types.add(entity_type)
+        if entity_type and entity_type not in entity_type_properties:
+            entity_type_properties[entity_type] = item.get("properties", [])
             entity_types.append(entity_type)
+
+    # The list response carries every type's properties, so it warms the detail pipeline cache too
+    if entity_types:
+        cache_entity_type_properties(tenant, entity_type_properties, complete=True)
     return entity_types
 
 
-def get_dynatrace_data(
-    session: Session,
-    prepared_params_list,
-    opt_helper=None,
-    proxy_uri=None,
-    verify=None,
-):
-    for url, params, endpoint in prepared_params_list:
+def parse_retry_after(value) -> Optional[float]:
+    """Parse a Retry-After header, delay seconds or an HTTP date, into seconds from now."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
-        prepared_request = prepare_dynatrace_request(session, url, params)
+
+def parse_rate_limit_reset(value) -> Optional[float]:
+    """Parse X-RateLimit-Reset into seconds from now.
+
+    Dynatrace sends the reset time in microseconds since the epoch, milliseconds, seconds and relative seconds are
+    accepted as well.
+    """
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return None
+    if reset > 1e14:
+        reset /= 1e6
+    elif reset > 1e11:
+        reset /= 1e3
+    elif reset < 1e9:
+        return max(0.0, reset)
+    return max(0.0, reset - time.time())
+
+
+class SharedRateBudget:
+    """Token bucket kept in a locked state file, shared by every input process and REST handler of the add-on that
+    uses the same tenant and token.
+
+    Pauses are shared as well, so a 429 seen by one input holds the others until the budget resets.
+    """
+
+    def __init__(self, path, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE):
+        self.path = path
+        self.rate = max(0.0, requests_per_minute / 60.0)
+        self.capacity = max(1.0, self.rate * 10)
+
+    def acquire(self) -> float:
+        """Wait for a request slot in the shared budget. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with locked_json_state(self.path) as state:
+                now = time.time()
+                delay = state.get("blocked_until", 0.0) - now
+                if delay <= 0:
+                    if not self.rate:
+                        return waited
+                    updated = min(state.get("updated", now), now)
+                    tokens = min(self.capacity, state.get("tokens", self.capacity) + (now - updated) * self.rate)
+                    state["updated"] = now
+                    if tokens >= 1:
+                        state["tokens"] = tokens - 1
+                        return waited
+                    state["tokens"] = tokens
+                    delay = (1 - tokens) / self.rate
+            # Never trust a far future pause left behind by a clock change
+            delay = min(delay, MAX_RATE_LIMIT_WAIT_SECONDS)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float):
+        with locked_json_state(self.path) as state:
+            state["blocked_until"] = max(state.get("blocked_until", 0.0), time.time() + seconds)
+
+
+class RateLimiter:
+    """Token bucket pacing the requests to one tenant, paused while Dynatrace reports the budget is exhausted.
+
+    Shared by every session and detail worker of the process that talks to the tenant. A shared budget additionally
+    paces the requests of all processes, the local bucket keeps pacing this process if its state file is unusable.
+    """
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, shared_budget: SharedRateBudget = None):
+        self.shared_budget = shared_budget
+        self.rate = max(0.0, requests_per_minute / 60.0)
+        # Allow a burst of ten seconds worth of requests
+        self.capacity = max(1.0, self.rate * 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.settings_loaded = time.monotonic()
+
+    def set_rate(self, requests_per_minute):
+        """Apply a changed requests_per_minute setting, keeping any pause in effect."""
+        rate = max(0.0, requests_per_minute / 60.0)
+        with self.lock:
+            self.rate = rate
+            self.capacity = max(1.0, rate * 10)
+            self.tokens = min(self.tokens, self.capacity)
+            self.settings_loaded = time.monotonic()
+        if self.shared_budget:
+            self.shared_budget.rate = rate
+            self.shared_budget.capacity = self.capacity
+
+    def _acquire_local(self) -> float:
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.blocked_until - now
+                if delay <= 0:
+                    if not self.rate:
+                        return waited
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def acquire(self) -> float:
+        """Wait for a request slot. Returns the seconds waited."""
+        waited = self._acquire_local()
+        if self.shared_budget:
+            try:
+                waited += self.shared_budget.acquire()
+            except OSError:
+                # An unusable state directory must not stop collection, pacing falls back to this process
+                pass
+        return waited
+
+    def pause(self, seconds: float) -> float:
+        """Hold every request for seconds, capped at MAX_RATE_LIMIT_WAIT_SECONDS. Returns the applied pause."""
+        seconds = min(max(0.0, seconds), MAX_RATE_LIMIT_WAIT_SECONDS)
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        if self.shared_budget:
+            try:
+                self.shared_budget.pause(seconds)
+            except OSError:
+                pass
+        return seconds
+
+    def update(self, response: Response):
+        """Pause until the reset time when the response reports no remaining budget."""
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if remaining is not None and remaining.strip().isdigit() and int(remaining) <= 0:
+            reset = parse_rate_limit_reset(response.headers.get("X-RateLimit-Reset"))
+            self.pause(reset if reset is not None else DEFAULT_RATE_LIMIT_BACKOFF_SECONDS)
+
+    def throttled(self, response: Response, attempt: int) -> float:
+        """Pause after a 429 for Retry-After, the rate limit reset or an exponential backoff. Returns the pause."""
+        delay = parse_retry_after(response.headers.get("Retry-After"))
+        if delay is None:
+            delay = parse_rate_limit_reset(response.headers.get("X-RateLimit-Reset"))
+        if delay is None:
+            delay = DEFAULT_RATE_LIMIT_BACKOFF_SECONDS * 2 ** attempt
+        return self.pause(delay)
+
+
+# One rate limiter per tenant host and token, with the requests_per_minute setting read at most
+# RUNTIME_SETTINGS_TTL_SECONDS ago. The budget itself lives in a shared state file so every process of the add-on
+# draws from it.
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+RATE_LIMIT_STATE_DIR = "rate_limits"
+
+
+def parse_requests_per_minute(value) -> int:
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return DEFAULT_REQUESTS_PER_MINUTE
+
+
+def get_rate_limiter(url, opt_helper=None, authorization=None) -> RateLimiter:
+    # Key by a hash so the token never ends up in a file name or the state directory listing
+    key = hashlib.sha1(f"{urlsplit(url).netloc}\n{authorization or ''}".encode("utf-8")).hexdigest()
+    def get_requests_per_minute():
+        get_global_setting = getattr(opt_helper, "get_global_setting", None)
+        return parse_requests_per_minute(
+            get_global_setting("requests_per_minute") if callable(get_global_setting) else None
+        )
+
+    with rate_limiters_lock:
+        rate_limiter = rate_limiters.get(key)
+        if rate_limiter is None:
+            requests_per_minute = get_requests_per_minute()
+            try:
+                shared_budget = SharedRateBudget(get_state_file(RATE_LIMIT_STATE_DIR, key), requests_per_minute)
+            except OSError:
+                shared_budget = None
+            rate_limiter = rate_limiters[key] = RateLimiter(requests_per_minute, shared_budget)
+        elif time.monotonic() - rate_limiter.settings_loaded >= RUNTIME_SETTINGS_TTL_SECONDS:
+            rate_limiter.set_rate(get_requests_per_minute())
+    return rate_limiter
+
+
+class RunDeadlineExceeded(Exception):
+    """Raised before a request when the run has used up its share of the input interval."""
+
+
+class DynatraceCollectionError(Exception):
+    """Raised once a request has failed for good, so a failed collection is never mistaken for an empty one."""
+
+    def __init__(self, message, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+    @property
+    def client_error(self) -> bool:
+        """True when Dynatrace rejected the request itself, sending it again would fail the same way."""
+        return self.status_code is not None and 400 <= self.status_code < 500 and self.status_code not in (408, 429)
+
+
+class RunDeadline:
+    """Time budget of one input run, shared by every request the run makes."""
+
+    def __init__(self, seconds: float, started: Optional[float] = None):
+        self.seconds = seconds
+        self.deadline = (time.monotonic() if started is None else started) + seconds
+        self.cut_short = False
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def check(self, what=None):
+        """Raise RunDeadlineExceeded, and mark the run as cut short, once the deadline has passed."""
+        if self.remaining() <= 0:
+            self.cut_short = True
+            raise RunDeadlineExceeded(
+                f"run deadline of {self.seconds:.0f} seconds reached" + (f" before {what}" if what else "")
+            )
+
+    def limit(self, settings: dict) -> dict:
+        """Cap the read timeout of request settings at the time left, so a stalled response cannot outlive the run."""
+        connect_timeout, read_timeout = settings.get("timeout") or (
+            DEFAULT_CONNECT_TIMEOUT_SECONDS,
+            DEFAULT_READ_TIMEOUT_SECONDS,
+        )
+        read_timeout = max(MIN_READ_TIMEOUT_SECONDS, min(read_timeout, self.remaining()))
+        return dict(settings, timeout=(connect_timeout, read_timeout))
+
+
+helper_run_deadlines = weakref.WeakKeyDictionary()
+# When run_lock started handling a run, time spent waiting for the lock counts against the run's deadline
+helper_run_starts = weakref.WeakKeyDictionary()
+
+
+def get_input_interval_seconds(helper) -> Optional[int]:
+    """The input's scheduling interval, falling back to its collection interval in minutes."""
+    for name, factor in (("interval", 1), ("dynatrace_collection_interval", 60)):
+        try:
+            seconds = int(float(helper.get_arg(name))) * factor
+        except (TypeError, ValueError):
+            continue
+        if seconds > 0:
+            return seconds
+    return None
+
+
+def start_run_deadline(helper, interval_seconds=None) -> Optional[RunDeadline]:
+    """Start the deadline of a run at RUN_DEADLINE_FRACTION of the input interval. None for unscheduled inputs.
+
+    A run that waited for its run lock is timed from the start of the wait, so it still ends before the next one.
+    """
+    interval_seconds = interval_seconds or get_input_interval_seconds(helper)
+    if not interval_seconds:
+        return None
+    deadline = RunDeadline(interval_seconds * RUN_DEADLINE_FRACTION, started=helper_run_starts.get(helper))
+    helper_run_deadlines[helper] = deadline
+    return deadline
+
+
+def get_run_deadline(helper) -> Optional[RunDeadline]:
+    if helper is None:
+        return None
+    return helper_run_deadlines.get(helper)
+
+
+def log_run_cut_short(helper, error: RunDeadlineExceeded):
+    log = get_helper_log(helper)
+    log.warning("correlation_id: %s, run cut short: %s", log.correlation_id, error)
+
+
+def get_request_timeout(endpoint: Optional[Endpoint] = None) -> Tuple[int, int]:
+    """(connect, read) timeout in seconds for requests to an endpoint."""
+    read_timeout = endpoint.read_timeout if endpoint is not None else None
+    return DEFAULT_CONNECT_TIMEOUT_SECONDS, read_timeout or DEFAULT_READ_TIMEOUT_SECONDS
+
+
+def get_send_timeout(helper=None, endpoint: Optional[Endpoint] = None) -> Tuple[int, float]:
+    """Timeout for a request sent with helper.send_http_request, capped at the time left in the run.
+
+    Raises RunDeadlineExceeded once the run deadline has passed.
+    """
+    settings = {"timeout": get_request_timeout(endpoint)}
+    deadline = get_run_deadline(helper)
+    if deadline:
+        deadline.check()
+        settings = deadline.limit(settings)
+    return settings["timeout"]
+
+
+def get_request_settings(
+    session: Session, url, opt_helper=None, proxy_uri=None, verify=None
+) -> dict:
+    """Return the send() settings for url, resolved once per scheme and host and kept on the session.
+
+    Sessions kept by the daemon resolve them again every RUNTIME_SETTINGS_TTL_SECONDS.
+    """
+    request_settings = getattr(session, "dynatrace_request_settings", None)
+    now = time.monotonic()
+    if request_settings is None or now - session.dynatrace_request_settings_loaded >= RUNTIME_SETTINGS_TTL_SECONDS:
+        request_settings = session.dynatrace_request_settings = {}
+        session.dynatrace_request_settings_loaded = now
+
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc, proxy_uri, verify)
+    settings = request_settings.get(key)
+    if settings is None:
         effective_proxy_uri = proxy_uri
         if effective_proxy_uri is None and opt_helper:
             effective_proxy_uri = opt_helper._get_proxy_uri()
@@ -755,94 +1870,240 @@ def get_dynatrace_data(
         )
 
         settings = session.merge_environment_settings(
-            prepared_request.url,
+            url,
             proxies,
             None,
             effective_verify,
             None,
         )
-        # print('prepared_request: {}'.format(prepared_request))
-        # print('prepared_request.url: {}'.format(prepared_request.url))
-        # print('params: {}'.format(params))
-        # print('settings: {}'.format(settings))
-
-        if opt_helper:
-            opt_helper.log_debug(
-                f"Prepared Request: {prepared_request} {prepared_request.url} {prepared_request.body}"
+        # Detail workers share the session, concurrent misses resolve the same settings
+        settings = request_settings.setdefault(key, settings)
+    return settings
+
+
+def get_dynatrace_data(
+    session: Session,
+    prepared_params_list,
+    opt_helper=None,
+    proxy_uri=None,
+    verify=None,
+    counter=None,
+    resume=None,
+):
+    for url, params, endpoint in prepared_params_list:
+
+        prepared_request = prepare_dynatrace_request(session, url, params)
+        settings = dict(
+            get_request_settings(session, prepared_request.url, opt_helper, proxy_uri, verify),
+            timeout=get_request_timeout(endpoint),
+        )
+        log = get_helper_log(opt_helper)
+        if log.debug_enabled:
+            log.debug(
+                "Prepared Request: %s %s %s",
+                prepared_request,
+                prepared_request.url,
+                prepared_request.body,
             )
-            opt_helper.log_debug(f"url: {url}")
-            opt_helper.log_debug(f"headers: {prepared_request.headers}")
-            opt_helper.log_debug(f"params: {params}")
-            opt_helper.log_debug(f"Settings: {settings}")
+            log.debug("url: %s", url)
+            log.debug("headers: %s", prepared_request.headers)
+            log.debug("params: %s", params)
+            log.debug("Settings: %s", settings)
 
         for response_json in _get_dynatrace_data(
-            session, prepared_request, settings, opt_helper
+            session, prepared_request, settings, opt_helper, counter=counter, resume=resume
         ):
             parsed_response = parse_dynatrace_response(response_json, endpoint)
 
-            if opt_helper:
-                opt_helper.log_debug(f"Parsed Response: {parsed_response}")
+            log.debug("Parsed Response: %s", parsed_response)
 
             if parsed_response:
                 yield parsed_response
 
 
+def is_retryable_error(error: Exception) -> bool:
+    """True for failures worth retrying the same request for: connection errors, timeouts and gateway errors."""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(error, requests.exceptions.SSLError):
+        return False
+    return isinstance(
+        error,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def get_page_retry_delay(attempt: int) -> float:
+    return min(DEFAULT_PAGE_RETRY_BACKOFF_SECONDS * 2 ** attempt, MAX_RATE_LIMIT_WAIT_SECONDS)
+
+
+def get_page_cursor_file(url, authorization=None) -> str:
+    """State file holding the resume point of the page chain started by a request URL and token."""
+    return get_state_file(PAGE_CURSOR_DIR, f"{url}\n{authorization or ''}")
+
+
+def load_page_cursor(path) -> Optional[str]:
+    cursor = read_json_state(path)
+    if not isinstance(cursor, dict) or not cursor.get("next_page_key"):
+        return None
+    if not time.time() - cursor.get("saved_at", 0) < PAGE_CURSOR_TTL_SECONDS:
+        return None
+    return cursor["next_page_key"]
+
+
+def save_page_cursor(path, next_page_key):
+    write_json_state(path, {"next_page_key": next_page_key, "saved_at": time.time()})
+
+
+def clear_page_cursor(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 def _get_dynatrace_data(
-    session, prepared_request: PreparedRequest, settings: dict, opt_helper
+    session, prepared_request: PreparedRequest, settings: dict, opt_helper, counter=None, resume=None
 ) -> json:
-    base_url = prepared_request.url.replace(prepared_request.path_url, "")
+    """Send a request and yield every page of its response.
+
+    Transient failures are retried in place. A request that still fails after its retries is logged and raised as
+    DynatraceCollectionError. Once the run deadline has passed no further page is requested and
+    RunDeadlineExceeded is raised.
+
+    Only the requests of a collection window keep their place in the chain: with resume False the nextPageKey is
+    saved once a page has been consumed, with resume True a replay of the same window continues after the last
+    page consumed before the failure. A chain abandoned by the caller starts over. With resume None, as for lists
+    and lookups that are always read whole, nothing is saved or resumed.
+    """
+    log = get_helper_log(opt_helper)
+    authorization = (prepared_request.headers or {}).get("Authorization")
+    rate_limiter = get_rate_limiter(prepared_request.url, opt_helper, authorization)
+    first_url = prepared_request.url
+    base_url = first_url.split("?")[0]
+    page_cursor_file = get_page_cursor_file(first_url, authorization) if resume is not None else None
+    resumed = load_page_cursor(page_cursor_file) if resume else None
+    if resumed:
+        log.info("correlation_id: %s, resuming pagination of %s", log.correlation_id, base_url)
+        prepared_request.prepare_url(base_url, {"nextPageKey": resumed})
+    deadline = get_run_deadline(opt_helper)
+    throttled_attempts = 0
+    failed_attempts = 0
     while True:
+        if deadline:
+            deadline.check(base_url)
         try:
-            response: Response = session.send(prepared_request, **settings)
+            rate_limiter.acquire()
+            response: Response = session.send(
+                prepared_request, **(deadline.limit(settings) if deadline else settings)
+            )
+            rate_limiter.update(response)
+            if response.status_code == 429 and throttled_attempts < MAX_RATE_LIMIT_RETRIES:
+                # Retry the same prepared request, pagination resumes from the same nextPageKey
+                delay = rate_limiter.throttled(response, throttled_attempts)
+                throttled_attempts += 1
+                log.warning(
+                    "correlation_id: %s, rate limited by Dynatrace, retry %s of %s in %.1f seconds: %s",
+                    log.correlation_id,
+                    throttled_attempts,
+                    MAX_RATE_LIMIT_RETRIES,
+                    delay,
+                    prepared_request.url,
+                )
+                continue
+            throttled_attempts = 0
             response.raise_for_status()  # raise HTTPError if status >=400
+            count_response(counter, response)
+            log.response_sample(response)
 
-            if opt_helper:
-                opt_helper.log_debug(f"Response: {response.text}")
+            # response.text decodes the whole body, only do it when debug is on
+            if log.debug_enabled:
+                log.debug("Response: %s", response.text)
 
             response_json: json = response.json()
 
-            if opt_helper:
-                opt_helper.log_debug(f"Parsed response: {response_json}")
+            failed_attempts = 0
+            resumed = None
 
-                # If totalCount is in the response, log it
-                if "totalCount" in response_json:
-                    opt_helper.log_info(
-                        f"correlation_id: {opt_helper.correlation_id}, "
-                        f'dynatrace_json_response_size: {response_json["totalCount"]}'
-                    )
+            log.debug("Parsed response: %s", response_json)
 
-            yield response_json
+            # If totalCount is in the response, log it
+            if "totalCount" in response_json:
+                log.info(
+                    "correlation_id: %s, dynatrace_json_response_size: %s",
+                    log.correlation_id,
+                    response_json["totalCount"],
+                )
+
+            try:
+                yield response_json
+            except GeneratorExit:
+                if page_cursor_file:
+                    clear_page_cursor(page_cursor_file)
+                raise
 
             if (
                 "nextPageKey" not in response_json
                 or response_json["nextPageKey"] is None
             ):
+                if page_cursor_file:
+                    clear_page_cursor(page_cursor_file)
                 break
 
+            if page_cursor_file:
+                save_page_cursor(page_cursor_file, response_json["nextPageKey"])
             # Remove all params except for nextPageKey
-            next_url = prepared_request.url.split("?")[0]
             prepared_request.prepare_url(
-                next_url, {"nextPageKey": response_json["nextPageKey"]}
+                base_url, {"nextPageKey": response_json["nextPageKey"]}
             )
 
-        except requests.exceptions.HTTPError as err:
-            if opt_helper:
-                # Log the status code and error message
-                opt_helper.log_error(
-                    f"correlation_id: {opt_helper.correlation_id}, HTTP Error: {err}"
+        except Exception as e:
+            if (
+                resumed
+                and isinstance(e, requests.exceptions.HTTPError)
+                and e.response is not None
+                and 400 <= e.response.status_code < 500
+                and e.response.status_code != 429
+            ):
+                # The saved page key was rejected, most likely expired, start the chain over
+                log.warning(
+                    "correlation_id: %s, saved page key rejected, restarting pagination: %s",
+                    log.correlation_id,
+                    e,
                 )
+                clear_page_cursor(page_cursor_file)
+                resumed = None
+                prepared_request.prepare_url(first_url, None)
+                continue
+            if failed_attempts < MAX_PAGE_RETRIES and is_retryable_error(e):
+                delay = get_page_retry_delay(failed_attempts)
+                failed_attempts += 1
+                log.warning(
+                    "correlation_id: %s, %s, retry %s of %s in %.1f seconds: %s",
+                    log.correlation_id,
+                    e,
+                    failed_attempts,
+                    MAX_PAGE_RETRIES,
+                    delay,
+                    prepared_request.url,
+                )
+                time.sleep(delay)
+                continue
+            if isinstance(e, requests.exceptions.HTTPError):
+                # Log the status code and error message
+                log.error("correlation_id: %s, HTTP Error: %s", log.correlation_id, e)
 
                 # If the server sent a response, log the response body
-                if err.response is not None:
-                    opt_helper.log_error(f"Details: {err.response.text}")
-            break
-
-        except Exception as e:
-            if opt_helper:
-                opt_helper.log_error(
-                    f"Unexpected error: {e}, correlation_id {opt_helper.correlation_id}"
-                )
-            break
+                if e.response is not None:
+                    log.error("Details: %s", e.response.text)
+            else:
+                log.error("Unexpected error: %s, correlation_id %s", e, log.correlation_id)
+            status_code = e.response.status_code if getattr(e, "response", None) is not None else None
+            raise DynatraceCollectionError(f"{base_url}: {e}", status_code) from e
 
 
 def parse_dynatrace_response(response: json, endpoint: Endpoint):
@@ -902,26 +2163,453 @@ def write_certificate_to_file(cert_file, certificate, helper=None):
         return False
 
 
-def get_ssl_certificate_verification(helper=None, user_certificate=None):
-    local_dir = os.path.abspath(
-        os.path.join(Path(__file__).resolve().parent.parent, "local")
+def get_local_state_dir(*parts) -> str:
+    """Return a directory under the add-on's local/ state directory, creating it if needed."""
+    state_dir = os.path.abspath(os.path.join(local_dir, *parts))
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def get_state_file(directory, key) -> str:
+    """Return the path of the JSON state file for a key (tenant, input, ...) in a state directory."""
+    key_hash = hashlib.sha1(str(key).encode("utf-8")).hexdigest()
+    return os.path.join(get_local_state_dir(directory), f"{key_hash}.json")
+
+
+def read_json_state(path, default=None):
+    """Read a JSON state file, returning the default when it is missing or unreadable."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json_state(path, data) -> bool:
+    """Atomically replace a JSON state file so concurrent readers never see a partial file."""
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    except OSError:
+        return False
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+        return True
+    except (OSError, TypeError, ValueError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+
+def lock_file(f, blocking=True) -> bool:
+    """Take an exclusive lock on an open file, by default blocking until it is free.
+
+    Returns False when locking is unavailable or, without blocking, when another process holds the lock.
+    """
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        if msvcrt:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            return True
+    except OSError:
+        pass
+    return False
+
+
+def unlock_file(f):
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        elif msvcrt:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    except OSError:
+        pass
+
+
+@contextmanager
+def locked_json_state(path):
+    """Hold an exclusive lock on a JSON state file shared between processes and yield its state as a dict.
+
+    Changes made to the dict are written back before the lock is released. Without a usable file lock the state is
+    still read and written, only without protection against concurrent updates.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "r+") as f:
+        locked = lock_file(f)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or "{}")
+            except ValueError:
+                state = {}
+            if not isinstance(state, dict):
+                state = {}
+            original = dict(state)
+            yield state
+            if state != original:
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+        finally:
+            if locked:
+                unlock_file(f)
+
+
+def parse_run_overlap_policy(value) -> str:
+    value = str(value or "").strip().lower()
+    return value if value in RUN_OVERLAP_POLICIES else DEFAULT_RUN_OVERLAP_POLICY
+
+
+def get_run_lock_key(helper) -> str:
+    return f"{getattr(helper, 'input_type', '')}|{helper.get_input_stanza_names()}"
+
+
+def count_run_overlap(path, outcome) -> dict:
+    """Count a skipped, waited or overlapped run of an input, returning all of its counts."""
+    with locked_json_state(path) as counts:
+        counts[outcome] = counts.get(outcome, 0) + 1
+        counts[f"last_{outcome}"] = time.time()
+        return dict(counts)
+
+
+@contextmanager
+def run_lock(helper, policy=None):
+    """Hold the input's run lock for the duration of a run, yielding whether the run should go ahead.
+
+    A lock still held by the previous run is handled by the run_overlap_policy setting: skip this run, wait up to
+    the run deadline for the lock, or take over a lock held for longer than RUN_LOCK_STALE_INTERVALS intervals and
+    skip otherwise. A run that waited has its deadline counted from the start of the wait, so it never runs into
+    the next one. Skipped, waited and overlapped runs are counted per input and logged with their totals.
+    A process that dies releases its lock, so only hung runs ever become stale.
+    """
+    if policy is None:
+        get_global_setting = getattr(helper, "get_global_setting", None)
+        policy = parse_run_overlap_policy(
+            get_global_setting("run_overlap_policy") if callable(get_global_setting) else None
+        )
+    key = get_run_lock_key(helper)
+    lock_path = get_state_file(RUN_LOCK_DIR, key)
+    interval_seconds = get_input_interval_seconds(helper)
+    started = time.monotonic()
+    owns_start = helper not in helper_run_starts
+    if owns_start:
+        helper_run_starts[helper] = started
+
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "r+") as f:
+        locked = lock_file(f, blocking=False)
+        outcome = None
+        if not locked and (fcntl or msvcrt):
+            if policy == RUN_OVERLAP_WAIT:
+                give_up = started + (interval_seconds or DEFAULT_RUN_LOCK_STALE_SECONDS) * RUN_DEADLINE_FRACTION
+                while not locked and time.monotonic() < give_up:
+                    time.sleep(RUN_LOCK_POLL_SECONDS)
+                    locked = lock_file(f, blocking=False)
+                outcome = "waited" if locked else "skipped"
+            else:
+                holder = read_json_state(lock_path, {}) or {}
+                held_seconds = time.time() - holder.get("started", time.time())
+                stale_seconds = (
+                    interval_seconds * RUN_LOCK_STALE_INTERVALS if interval_seconds else DEFAULT_RUN_LOCK_STALE_SECONDS
+                )
+                stale = policy == RUN_OVERLAP_TAKEOVER and held_seconds > stale_seconds
+                outcome = "overlapped" if stale else "skipped"
+
+        proceed = outcome != "skipped"
+        if outcome:
+            counts = count_run_overlap(get_state_file(RUN_LOCK_DIR, f"{key}|overlaps"), outcome)
+            log = get_helper_log(helper)
+            log.warning(
+                "correlation_id: %s, previous run still in progress, policy: %s, run %s, "
+                "skipped: %s, waited: %s, overlapped: %s runs so far, the interval may be too short",
+                log.correlation_id,
+                policy,
+                outcome,
+                counts.get("skipped", 0),
+                counts.get("waited", 0),
+                counts.get("overlapped", 0),
+            )
+        if locked:
+            f.seek(0)
+            f.truncate()
+            json.dump({"pid": os.getpid(), "started": time.time()}, f)
+            f.flush()
+        try:
+            yield proceed
+        finally:
+            if locked:
+                unlock_file(f)
+            if owns_start:
+                helper_run_starts.pop(helper, None)
+
+
+def is_daemon_mode_enabled() -> bool:
+    parser = configparser.ConfigParser(interpolation=None, strict=False)
+    try:
+        parser.read(os.path.join(local_dir, SETTINGS_CONF_FILE))
+    except configparser.Error:
+        return False
+    return is_truthy(parser.get("advanced", DAEMON_MODE_SETTING, fallback="0"))
+
+
+class StanzaHelper:
+    """Helper for one stanza of a single instance input, so collect_events runs unchanged in daemon mode.
+
+    Single instance helpers return every argument as a dict by stanza name, this helper picks the stanza's value,
+    tags its events with the stanza and gets a correlation_id per run. Everything else goes to the input's helper.
+    """
+
+    use_single_instance = False
+
+    def __init__(self, helper, stanza):
+        self.helper = helper
+        self.stanza = stanza
+        self.correlation_id = uuid4()
+
+    def get_arg(self, arg_name):
+        args = self.helper.get_arg(arg_name)
+        return args.get(self.stanza) if isinstance(args, dict) else args
+
+    def get_input_stanza_names(self):
+        return self.stanza
+
+    def new_event(self, *args, **kwargs):
+        event = self.helper.new_event(*args, **kwargs)
+        event.stanza = self.stanza
+        return event
+
+    def __getattr__(self, name):
+        return getattr(self.helper, name)
+
+
+class LockedEventWriter:
+    """Event writer shared by the stanzas a daemon runs concurrently, one event is written at a time."""
+
+    def __init__(self, ew):
+        self.ew = ew
+        self.lock = threading.Lock()
+
+    def write_event(self, event):
+        with self.lock:
+            self.ew.write_event(event)
+
+    def __getattr__(self, name):
+        return getattr(self.ew, name)
+
+
+def get_stanza_tenant(helper) -> str:
+    """Tenant a stanza collects from, stanzas without an account are scheduled as their own tenant."""
+    account = helper.get_arg("dynatrace_account")
+    if isinstance(account, dict) and account.get("username"):
+        return get_tenant_prefix(parse_url(account["username"]))
+    return f"stanza:{helper.get_input_stanza_names()}"
+
+
+def run_daemon(helper, ew, collect_events, stop_event=None, max_workers=DEFAULT_DAEMON_WORKERS):
+    """Run collect_events for every stanza of a single instance input on the stanza's interval until stopped.
+
+    A stanza is never run again before its previous run finished, ticks missed meanwhile are not made up, the
+    watermarks catch up on the time instead. Workers are shared fairly between the tenants of the stanzas, each
+    tenant runs at most MAX_TENANT_RUNS stanzas at once. Sessions are kept in the session registry between runs.
+    """
+    global session_registry
+    stanzas = helper.get_input_stanza_names()
+    stanzas = [stanzas] if isinstance(stanzas, str) else list(stanzas or [])
+    if not stanzas:
+        return
+    if session_registry is None:
+        session_registry = SessionRegistry()
+    stop_event = stop_event or threading.Event()
+    ew = LockedEventWriter(ew)
+    intervals = {
+        stanza: get_input_interval_seconds(StanzaHelper(helper, stanza)) or DEFAULT_DAEMON_INTERVAL_SECONDS
+        for stanza in stanzas
+    }
+    tenants = {stanza: get_stanza_tenant(StanzaHelper(helper, stanza)) for stanza in stanzas}
+    # Tenants in the order they were last given a worker, least recently served first
+    tenant_order = deque(dict.fromkeys(tenants.values()))
+    next_runs = dict.fromkeys(stanzas, time.monotonic())
+    running = {}
+    workers = max(1, min(max_workers, len(stanzas)))
+
+    log = get_helper_log(helper)
+    log.info(
+        "correlation_id: %s, daemon scheduling %s stanzas of %s tenants",
+        log.correlation_id,
+        len(stanzas),
+        len(tenant_order),
     )
-    os.makedirs(local_dir, exist_ok=True)
-    cert_file = os.path.join(local_dir, "cert.pem")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while not stop_event.is_set():
+            for stanza, future in list(running.items()):
+                if future.done():
+                    del running[stanza]
+                    if future.exception() is not None:
+                        log.error(
+                            "correlation_id: %s, daemon run of %s failed: %s",
+                            log.correlation_id,
+                            stanza,
+                            future.exception(),
+                        )
+            now = time.monotonic()
+            # Work is only submitted to free workers, so the choice of the next stanza is made here and not by the
+            # executor's queue: one due stanza per tenant at a time, the most overdue of the tenant first
+            submitted = True
+            while submitted and len(running) < workers:
+                submitted = False
+                for tenant in list(tenant_order):
+                    if len(running) >= workers:
+                        break
+                    if sum(tenants[stanza] == tenant for stanza in running) >= MAX_TENANT_RUNS:
+                        continue
+                    due = [
+                        stanza
+                        for stanza in stanzas
+                        if tenants[stanza] == tenant and stanza not in running and next_runs[stanza] <= now
+                    ]
+                    if not due:
+                        continue
+                    stanza = min(due, key=next_runs.get)
+                    next_runs[stanza] = now + intervals[stanza]
+                    running[stanza] = executor.submit(collect_events, StanzaHelper(helper, stanza), ew)
+                    tenant_order.remove(tenant)
+                    tenant_order.append(tenant)
+                    submitted = True
+            stop_event.wait(min(DAEMON_TICK_SECONDS, max(0.0, min(next_runs.values()) - time.monotonic())))
+
+
+def guard_run(collect_events):
+    """Decorate an input's collect_events so a run never overlaps its predecessor, see run_lock.
+
+    A single instance input, daemon mode, runs the decorated collect_events per stanza with run_daemon.
+    """
 
-    user_uploaded_certificate = user_certificate
-    if user_uploaded_certificate is None and helper:
-        user_uploaded_certificate = helper.get_global_setting("user_certificate")
+    @functools.wraps(collect_events)
+    def guarded_collect_events(helper, ew):
+        if getattr(helper, "use_single_instance", False) is True:
+            return run_daemon(helper, ew, guarded_collect_events)
+        with run_lock(helper) as proceed:
+            if proceed:
+                return collect_events(helper, ew)
 
-    # Update the certificate on disk if it doesn't exist or if the user uploaded a new certificate
-    if not os.path.isfile(cert_file) or (
-        user_uploaded_certificate
-        and open(cert_file, "r").read() != user_uploaded_certificate
-    ):
-        if user_uploaded_certificate:
-            if not write_certificate_to_file(
-                cert_file, user_uploaded_certificate, helper
-            ):
+    return guarded_collect_events
+
+
+def load_entity_type_cache(tenant) -> dict:
+    with locked_json_state(get_state_file(ENTITY_TYPE_CACHE_DIR, tenant)) as state:
+        return get_entity_type_cache(state, tenant)
+
+
+def get_entity_type_cache(state: dict, tenant) -> dict:
+    if state.get("tenant") != tenant:
+        return {"tenant": tenant, "listed_at": None, "types": {}}
+    return {"tenant": tenant, "listed_at": state.get("listed_at"), "types": dict(state.get("types") or {})}
+
+
+def is_cache_entry_fresh(cached_at, ttl=ENTITY_TYPE_CACHE_TTL_SECONDS) -> bool:
+    return cached_at is not None and 0 <= time.time() - cached_at < ttl
+
+
+def get_cached_entity_type_properties(
+    tenant, entity_type, ttl=ENTITY_TYPE_CACHE_TTL_SECONDS
+) -> Optional[list]:
+    """Return the cached property schema of an entity type, or None if missing or expired."""
+    entry = load_entity_type_cache(tenant)["types"].get(entity_type)
+    if entry and is_cache_entry_fresh(entry.get("cached_at"), ttl):
+        return entry.get("properties", [])
+    return None
+
+
+def get_cached_entity_types(tenant, ttl=ENTITY_TYPE_CACHE_TTL_SECONDS) -> Optional[list]:
+    """Return the cached entity type list of a tenant, or None if it was never listed or expired."""
+    cache = load_entity_type_cache(tenant)
+    if is_cache_entry_fresh(cache.get("listed_at"), ttl):
+        return list(cache["types"])
+    return None
+
+
+def cache_entity_type_properties(tenant, entity_type_properties: dict, complete=False):
+    """Store entity type property schemas. complete marks the cache as the full type list.
+
+    The cache is shared by every input of the tenant, the read-modify-write holds its file lock so the schemas other
+    inputs cached in the meantime are kept.
+    """
+    with locked_json_state(get_state_file(ENTITY_TYPE_CACHE_DIR, tenant)) as state:
+        cache = get_entity_type_cache(state, tenant)
+        cached_at = time.time()
+        if complete:
+            cache["types"] = {}
+            cache["listed_at"] = cached_at
+        for entity_type, properties in entity_type_properties.items():
+            cache["types"][entity_type] = {"properties": properties, "cached_at": cached_at}
+        state.update(cache)
+
+
+def invalidate_entity_type_cache(tenant, entity_type=None):
+    """Drop the cached schema of one entity type, or the whole cache of a tenant."""
+    cache_file = get_state_file(ENTITY_TYPE_CACHE_DIR, tenant)
+    if entity_type is None:
+        if os.path.isfile(cache_file):
+            os.remove(cache_file)
+        return
+    with locked_json_state(cache_file) as state:
+        cache = get_entity_type_cache(state, tenant)
+        if cache["types"].pop(entity_type, None) is not None:
+            cache["listed_at"] = None
+            state.update(cache)
+
+
+# CA bundle resolved per certificate content hash, the disk is checked once per certificate and process
+ssl_certificate_bundles = {}
+ssl_certificate_lock = threading.Lock()
+# Bundle resolved per helper, so the global setting is only read once per process
+helper_ssl_certificate_bundles = weakref.WeakKeyDictionary()
+
+
+def get_file_sha256(path) -> Optional[str]:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def resolve_ssl_certificate_bundle(user_certificate=None, helper=None) -> str:
+    """Return the CA bundle path for a user certificate, writing local/cert.pem only when it changed."""
+    certificate_hash = (
+        hashlib.sha256(user_certificate.encode("utf-8")).hexdigest()
+        if user_certificate
+        else None
+    )
+    with ssl_certificate_lock:
+        if certificate_hash in ssl_certificate_bundles:
+            return ssl_certificate_bundles[certificate_hash]
+
+        cert_file = os.path.join(get_local_state_dir(), "cert.pem")
+        # Update the certificate on disk if it doesn't exist or if the user uploaded a new certificate
+        if certificate_hash and get_file_sha256(cert_file) != certificate_hash:
+            if not write_certificate_to_file(cert_file, user_certificate, helper):
                 return cert_file
 
-    return cert_file if os.path.isfile(cert_file) else certifi.where()
+        bundle = cert_file if os.path.isfile(cert_file) else certifi.where()
+        ssl_certificate_bundles[certificate_hash] = bundle
+        return bundle
+
+
+def get_ssl_certificate_verification(helper=None, user_certificate=None):
+    if user_certificate is not None or helper is None:
+        return resolve_ssl_certificate_bundle(user_certificate, helper)
+
+    bundle = helper_ssl_certificate_bundles.get(helper)
+    if bundle is None:
+        bundle = resolve_ssl_certificate_bundle(
+            helper.get_global_setting("user_certificate"), helper
+        )
+        helper_ssl_certificate_bundles[helper] = bundle
+    return bundle
@@ -0,0 +1,147 @@
+"""Micro benchmarks for the util.py collection pipeline.
+
+Run from the tests directory:
+    PYTHONPATH=..:../package/bin python benchmark_util.py
+"""
+import json
+import timeit
+
+import requests
+from requests.models import Response
+
+import package.bin.util as util
+
+ENTITY_COUNT = 2000
+REQUEST_COUNT = 2000
+REPEAT = 5
+
+
+def make_entity(index):
+    return {
+        "entityId": f"PROCESS_GROUP_INSTANCE-{index:016X}",
+        "displayName": f"java-app-{index}",
+        "type": "PROCESS_GROUP_INSTANCE",
+        "firstSeenTms": 1690000000000,
+        "lastSeenTms": 1690000300000,
+        "properties": {
+            "softwareTechnologies": [
+                {"type": "JAVA", "edition": "OpenJDK", "version": "17.0.7"},
+                {"type": "TOMCAT", "edition": None, "version": "10.1.8"},
+            ],
+            "metadata": [{"key": "COMMAND_LINE_ARGS", "value": "-Xmx2g " * 20}],
+            "listenPorts": list(range(8080, 8090)),
+        },
+        "tags": [{"context": "CONTEXTLESS", "key": f"team-{index % 10}"}],
+        "toRelationships": {"runsOn": [{"id": f"HOST-{index:016X}", "type": "HOST"}]},
+        "fromRelationships": {"isInstanceOf": [{"id": "PROCESS_GROUP-1", "type": "PROCESS_GROUP"}]},
+    }
+
+
+def make_response(page):
+    response = Response()
+    response.status_code = 200
+    response._content = json.dumps({"entities": page}).encode("utf-8")
+    return response
+
+
+def baseline_initialize_counter():
+    """initialize_counter as it was before the session counters were sized from responses, unchanged."""
+    return {
+        "session_loop_count": 0,
+        "item_count": 0,
+        "result_count": 0,
+        "detail_count": 0,
+        "item_size": 0,
+        "result_size": 0,
+        "detail_size": 0,
+    }
+
+
+def baseline_process_main_results(result, counter):
+    """process_main_results as it was before the session counters were sized from responses, unchanged."""
+    if isinstance(result, list):
+        for item in result:
+            counter["item_count"] += 1
+            counter["item_size"] += len(json.dumps(item))
+            yield item
+    else:
+        counter["result_count"] += 1
+        counter["result_size"] += len(json.dumps(result))
+        yield result
+
+
+def baseline_pipeline(page, response):
+    """Records counted by the previous process_main_results, then serialized by the input for its events."""
+    counter = baseline_initialize_counter()
+    events = [json.dumps(item, sort_keys=True) for item in baseline_process_main_results(page, counter)]
+    return counter["item_size"], events
+
+
+def single_serialization_pipeline(page, response):
+    """Counters sized from the response, records serialized once for the event."""
+    counter = util.initialize_counter()
+    util.count_response(counter, response)
+    events = [json.dumps(item, sort_keys=True) for item in util.process_main_results(page, counter)]
+    return counter["response_size"], events
+
+
+def benchmark_session_counters():
+    page = [make_entity(index) for index in range(ENTITY_COUNT)]
+    response = make_response(page)
+
+    baseline = min(timeit.repeat(lambda: baseline_pipeline(page, response), number=1, repeat=REPEAT))
+    single = min(
+        timeit.repeat(lambda: single_serialization_pipeline(page, response), number=1, repeat=REPEAT)
+    )
+    print(f"session counters, {ENTITY_COUNT} entities")
+    print(f"  previous (serialize twice): {baseline * 1000:8.1f} ms")
+    print(f"  single serialization:       {single * 1000:8.1f} ms")
+    print(f"  saving:                     {(1 - single / baseline) * 100:8.1f} %")
+
+
+class ProxyHelper:
+    def _get_proxy_uri(self):
+        return None
+
+    def get_global_setting(self, name):
+        return None
+
+
+def legacy_request_preparation(session, prepared_params_list, helper):
+    """Proxy and environment settings resolved again for every URL."""
+    for url, params, endpoint in prepared_params_list:
+        prepared_request = util.prepare_dynatrace_request(session, url, params)
+        proxy_uri = helper._get_proxy_uri()
+        proxies = {"http": proxy_uri, "https": proxy_uri} if proxy_uri else {}
+        session.merge_environment_settings(prepared_request.url, proxies, None, True, None)
+
+
+def cached_request_preparation(session, prepared_params_list, helper):
+    """Settings resolved once and kept on the session."""
+    for url, params, endpoint in prepared_params_list:
+        prepared_request = util.prepare_dynatrace_request(session, url, params)
+        util.get_request_settings(session, prepared_request.url, helper, verify=True)
+
+
+def benchmark_request_preparation():
+    prepared_params_list = [
+        (f"https://tenant.example.com/api/v2/entities/HOST-{index:016X}", {}, util.Endpoint.ENTITY)
+        for index in range(REQUEST_COUNT)
+    ]
+    helper = ProxyHelper()
+
+    def run(preparation):
+        with requests.Session() as session:
+            preparation(session, prepared_params_list, helper)
+
+    legacy = min(timeit.repeat(lambda: run(legacy_request_preparation), number=1, repeat=REPEAT))
+    cached = min(timeit.repeat(lambda: run(cached_request_preparation), number=1, repeat=REPEAT))
+    print(f"request preparation, {REQUEST_COUNT} requests")
+    print(f"  legacy (per request):      {legacy * 1000:8.1f} ms")
+    print(f"  cached on the session:     {cached * 1000:8.1f} ms")
+    print(f"  saving:                    {(1 - cached / legacy) * 100:8.1f} %")
+
+
+if __name__ == "__main__":
+    benchmark_session_counters()
+    benchmark_request_preparation()
@@ -1,8 +1,12 @@
 import json
+import logging
 import os
 import pickle
 import re
 import sys
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -230,6 +234,12 @@ def manual_pickle_review():
 class TestUtil(unittest.TestCase):
     def setUp(self):
         self.spec = parse_open_api_spec(Path("dynatrace_oas_spec3.json"))
+        # Keep caches and checkpoints written by util out of the package's local/ directory
+        self.local_dir = tempfile.TemporaryDirectory()
+        local_dir_patcher = patch.object(util, "local_dir", self.local_dir.name)
+        local_dir_patcher.start()
+        self.addCleanup(local_dir_patcher.stop)
+        self.addCleanup(self.local_dir.cleanup)
 
     @staticmethod
     def generate_dynatrace_params():
@@ -456,6 +466,811 @@ class TestUtil(unittest.TestCase):
             # Validate the results
             assert results == page_responses
 
+    def test_execute_session_detail_workers_keep_order(self):
+        problem_ids = [f"P-{i}" for i in range(20)]
+
+        def side_effect(prepared_request, **kwargs):
+            response = Response()
+            response.status_code = 200
+            path = prepared_request.path_url.split("?")[0]
+            if path.endswith("/problems"):
+                content = {"problems": [{"problemId": pid} for pid in problem_ids]}
+            else:
+                problem_id = path.rsplit("/", 1)[-1]
+                # Finish later requests first to make sure ordering is not completion order
+                time.sleep(0.001 * (len(problem_ids) - problem_ids.index(problem_id)))
+                content = {"problemId": problem_id}
+            response._content = json.dumps(content).encode("utf-8")
+            return response
+
+        endpoint = (Endpoint.PROBLEMS, Endpoint.PROBLEM)
+        with patch("requests.Session.send", side_effect=side_effect):
+            serial = list(
+                util.execute_session(
+                    endpoint, "http://localhost:12345", "test_token", {"time": 0}, verify=False
+                )
+            )
+            parallel = list(
+                util.execute_session(
+                    endpoint,
+                    "http://localhost:12345",
+                    "test_token",
+                    {"time": 0},
+                    verify=False,
+                    max_workers=4,
+                )
+            )
+
+        self.assertEqual([p["problemId"] for p in serial], problem_ids)
+        self.assertEqual(serial, parallel)
+
+    def test_execute_session_entity_detail_batches(self):
+        entity_ids = [f"HOST-{i}" for i in range(5)]
+        requested_urls = []
+
+        def side_effect(prepared_request, **kwargs):
+            requested_urls.append(prepared_request.url)
+            response = Response()
+            response.status_code = 200
+            path = prepared_request.path_url.split("?")[0]
+            query = parse.parse_qs(parse.urlparse(prepared_request.url).query)
+            if path.endswith("/entityTypes/HOST"):
+                content = {"type": "HOST", "properties": [{"id": "osType"}]}
+            elif query["entitySelector"][0].startswith("entityId("):
+                self.assertIn("+properties.osType", query["fields"][0])
+                batch = re.findall(r'"([^"]+)"', query["entitySelector"][0])
+                # Return the batch reversed, the session must restore the requested order
+                content = {
+                    "entities": [
+                        {"entityId": entity_id, "type": "HOST"}
+                        for entity_id in reversed(batch)
+                    ]
+                }
+            else:
+                content = {
+                    "entities": [
+                        {"entityId": entity_id, "type": "HOST"} for entity_id in entity_ids
+                    ]
+                }
+            response._content = json.dumps(content).encode("utf-8")
+            return response
+
+        with patch("requests.Session.send", side_effect=side_effect):
+            entities = list(
+                util.execute_session(
+                    (Endpoint.ENTITIES, Endpoint.ENTITY),
+                    "http://localhost:12345",
+                    "test_token",
+                    {"time": 0},
+                    extra_params=["HOST"],
+                    verify=False,
+                    detail_batch_size=2,
+                )
+            )
+
+        self.assertEqual(entity_ids, [entity["entityId"] for entity in entities])
+        self.assertFalse(any("/entities/HOST-" in url for url in requested_urls))
+        # 1 list request, 1 entity type request and 3 batches of at most 2 entities
+        self.assertEqual(5, len(requested_urls))
+
+    def test_entity_type_cache(self):
+        tenant = "http://localhost:12345"
+        properties = [{"id": "osType"}, {"id": "bitness"}]
+        self.assertIsNone(util.get_cached_entity_type_properties(tenant, "HOST"))
+
+        util.cache_entity_type_properties(tenant, {"HOST": properties})
+        self.assertEqual(properties, util.get_cached_entity_type_properties(tenant, "HOST"))
+        self.assertIsNone(util.get_cached_entity_type_properties("http://other:1", "HOST"))
+        self.assertIsNone(util.get_cached_entity_type_properties(tenant, "HOST", ttl=0))
+        # Only a complete listing can serve the entity type list
+        self.assertIsNone(util.get_cached_entity_types(tenant))
+
+        util.cache_entity_type_properties(
+            tenant, {"HOST": properties, "SERVICE": []}, complete=True
+        )
+        self.assertEqual(["HOST", "SERVICE"], util.get_cached_entity_types(tenant))
+
+        util.invalidate_entity_type_cache(tenant, "SERVICE")
+        self.assertIsNone(util.get_cached_entity_type_properties(tenant, "SERVICE"))
+        self.assertIsNone(util.get_cached_entity_types(tenant))
+        self.assertEqual(properties, util.get_cached_entity_type_properties(tenant, "HOST"))
+
+        util.invalidate_entity_type_cache(tenant)
+        self.assertIsNone(util.get_cached_entity_type_properties(tenant, "HOST"))
+
+    def test_entity_type_cache_concurrent_inputs(self):
+        tenant = "http://localhost:12345"
+        now = time.time
+        other_input = []
+
+        def cached_at():
+            if not other_input:
+                # Another input caches a schema while this one is updating the shared cache
+                other_input.append(threading.Thread(
+                    target=util.cache_entity_type_properties, args=(tenant, {"SERVICE": []})))
+                other_input[0].start()
+                other_input[0].join(timeout=0.2)
+            return now()
+
+        with patch.object(util.time, "time", side_effect=cached_at):
+            util.cache_entity_type_properties(tenant, {"HOST": [{"id": "osType"}]})
+        other_input[0].join()
+
+        self.assertEqual([{"id": "osType"}], util.get_cached_entity_type_properties(tenant, "HOST"))
+        self.assertEqual([], util.get_cached_entity_type_properties(tenant, "SERVICE"))
+
+    def test_plan_time_windows(self):
+        minute = 60000
+        now = 1000 * minute
+        # First run looks back one collection interval
+        self.assertEqual([(995 * minute, now)], util.plan_time_windows(None, 5, 5, now=now))
+        # Later runs continue exactly at the watermark
+        self.assertEqual(
+            [(998 * minute, now)], util.plan_time_windows(998 * minute, 5, 5, now=now)
+        )
+        # After downtime the gap is collected in windows of at most one interval
+        self.assertEqual(
+            [(985 * minute, 990 * minute), (990 * minute, 995 * minute), (995 * minute, 998 * minute)],
+            util.plan_time_windows(985 * minute, 5, 5, now=now, settle_minutes=2),
+        )
+        # Catch up is bounded and a single window is returned when window_minutes is None
+        self.assertEqual(
+            [(940 * minute, now)],
+            util.plan_time_windows(1, 5, now=now, max_catch_up_minutes=60),
+        )
+        self.assertEqual([], util.plan_time_windows(now, 5, 5, now=now))
+        # A window left unfinished by a cut short run is replayed as it was
+        self.assertEqual(
+            [(990 * minute, 997 * minute), (997 * minute, now)],
+            util.plan_time_windows(990 * minute, 5, 5, now=now, pending_end=997 * minute),
+        )
+
+    def test_plan_time_windows_aligns_to_buckets(self):
+        minute = 60000
+        watermark = None
+        buckets = []
+        # Runs start at arbitrary milliseconds, Dynatrace widens from and to to whole one minute buckets
+        for now in (1000 * minute + 12345, 1005 * minute + 59999, 1011 * minute + 1, 1011 * minute + 30000,
+                    1042 * minute + 7):
+            for window_start, window_end in util.plan_time_windows(watermark, 5, 5, now=now, settle_minutes=2,
+                                                                   align_minutes=1):
+                self.assertEqual((0, 0), (window_start % minute, window_end % minute))
+                buckets.extend(range(window_start // minute, -(-window_end // minute)))
+                watermark = window_end
+        # Consecutive windows neither share a bucket nor leave one out
+        self.assertEqual(list(range(993, 1040)), buckets)
+        # Windows are at least one bucket long, an unaligned watermark is continued and aligned by its first window
+        self.assertEqual([(1, 5 * minute), (5 * minute, 10 * minute)],
+                         util.plan_time_windows(1, 5, 1, now=10 * minute, align_minutes=5))
+
+    def test_run_backfill_writes_in_order_and_resumes(self):
+        class CheckpointHelper(MockModularInput):
+            def __init__(self):
+                self.check_points = {}
+
+            def get_check_point(self, key):
+                return self.check_points.get(key)
+
+            def save_check_point(self, key, state):
+                self.check_points[key] = state
+
+        def make_response(status_code, body):
+            response = Response()
+            response.status_code = status_code
+            response._content = json.dumps(body).encode("utf-8")
+            return response
+
+        hour = 60 * 60000
+        helper = CheckpointHelper()
+        written = []
+        failing = [True]
+        sleep = time.sleep
+
+        def send(prepared_request, **kwargs):
+            chunk_start = int(parse.parse_qs(parse.urlparse(prepared_request.url).query)["from"][0])
+            # Later chunks answer first, they must still be written in order
+            sleep(0.002 * (10 - chunk_start // hour))
+            if chunk_start == 6 * hour and failing[0]:
+                return make_response(503, {})
+            return make_response(200, {"problems": [{"problemId": chunk_start}]})
+
+        def fetch_chunk(chunk_start, chunk_end):
+            return util.execute_session(Endpoint.PROBLEMS, "https://tenant.example.com", "token",
+                                        {"time": chunk_start, "end_time": chunk_end}, opt_helper=helper)
+
+        def write_chunk(problems):
+            written.extend(problem["problemId"] for problem in problems)
+
+        with patch.object(util.time, "sleep"), patch.object(requests.Session, "send", side_effect=send):
+            with self.assertRaises(util.DynatraceCollectionError):
+                util.run_backfill(helper, "backfill", 0, 10 * hour, fetch_chunk, write_chunk, max_workers=4)
+            self.assertEqual([index * hour for index in range(6)], written)
+            self.assertEqual({"end_time": 6 * hour}, helper.check_points["backfill"])
+
+            # The next run resumes with the failed chunk
+            failing[0] = False
+            chunks = util.run_backfill(helper, "backfill", 0, 10 * hour, fetch_chunk, write_chunk, max_workers=4)
+            self.assertEqual(4, chunks)
+            self.assertEqual([index * hour for index in range(10)], written)
+            self.assertEqual(0, util.run_backfill(helper, "backfill", 0, 10 * hour, fetch_chunk, write_chunk))
+
+        self.assertEqual(1704067200000, util.parse_backfill_time("2024-01-01T00:00:00Z"))
+        self.assertEqual(1704067200000, util.parse_backfill_time("2024-01-01T01:00:00+01:00"))
+        self.assertEqual(1704067200000, util.parse_backfill_time("1704067200000"))
+        self.assertIsNone(util.parse_backfill_time(" "))
+        with patch.object(helper, "get_arg", side_effect={"dynatrace_backfill_start": "2024-01-01T00:00:00Z",
+                                                          "dynatrace_backfill_end": "1704153600000"}.get):
+            self.assertEqual((1704067200000, 1704153600000), util.get_backfill_range(helper))
+        with patch.object(helper, "get_arg", side_effect={"dynatrace_backfill_start": "last tuesday"}.get):
+            self.assertIsNone(util.get_backfill_range(helper))
+        self.assertEqual(util.MAX_BACKFILL_WORKERS, util.parse_backfill_workers("64"))
+
+    def test_failed_window_keeps_watermark(self):
+        class CheckpointHelper(MockModularInput):
+            def __init__(self):
+                self.check_points = {}
+
+            def get_check_point(self, key):
+                return self.check_points.get(key)
+
+            def save_check_point(self, key, state):
+                self.check_points[key] = state
+
+        def make_response(status_code, body):
+            response = Response()
+            response.status_code = status_code
+            response._content = json.dumps(body).encode("utf-8")
+            return response
+
+        minute = 60000
+        helper = CheckpointHelper()
+        problems = []
+
+        def collect_window(window_start, window_end, resume, checkpoint):
+            problems.extend(util.execute_session(Endpoint.PROBLEMS, "https://tenant.example.com", "token",
+                                                 {"time": window_start, "end_time": window_end}, opt_helper=helper,
+                                                 resume=resume))
+
+        def send(prepared_request, **kwargs):
+            sent_urls.append(prepared_request.url)
+            return responses.pop(0)
+
+        windows = [(minute, 5 * minute), (5 * minute, 10 * minute)]
+        sent_urls = []
+        responses = [make_response(200, {"problems": [{"problemId": "P-1"}], "nextPageKey": "page-2"})]
+        responses += [make_response(503, {})] * (1 + util.MAX_PAGE_RETRIES)
+        with patch.object(util.time, "sleep"), patch.object(requests.Session, "send", side_effect=send):
+            self.assertFalse(util.collect_windows(helper, ["problems"], windows, collect_window))
+        self.assertEqual([], responses)
+        self.assertEqual({"end_time": minute, "pending_end": 5 * minute}, helper.check_points["problems"])
+
+        # The failed window is replayed from its last consumed page and only then the watermark moves
+        watermark, pending_end = util.get_window_state(helper, "problems")
+        windows = util.plan_time_windows(watermark, 5, 5, now=10 * minute, pending_end=pending_end)
+        responses = [make_response(200, {"problems": [{"problemId": "P-2"}]}),
+                     make_response(200, {"problems": [{"problemId": "P-3"}]})]
+        sent_urls.clear()
+        with patch.object(requests.Session, "send", side_effect=send):
+            self.assertTrue(util.collect_windows(helper, ["problems"], windows, collect_window, pending_end=pending_end))
+        self.assertIn("nextPageKey=page-2", sent_urls[0])
+        self.assertNotIn("nextPageKey", sent_urls[1])
+        self.assertEqual(["P-1", "P-2", "P-3"], [problem["problemId"] for problem in problems])
+        self.assertEqual({"end_time": 10 * minute}, helper.check_points["problems"])
+
+    def test_format_params_end_time(self):
+        params = Params({"time": 1, "end_time": 2, "metricSelector": "builtin:host.cpu.usage"})
+        self.assertEqual(
+            {"from": "1", "to": "2", "metricSelector": "builtin:host.cpu.usage"},
+            util.format_params(Endpoint.METRICS_QUERY, params),
+        )
+        self.assertEqual(
+            {"schedulingFrom": "1", "schedulingTo": "2"},
+            util.format_params(Endpoint.SYNTHETIC_TESTS_ON_DEMAND, Params({"time": 1, "end_time": 2})),
+        )
+        self.assertTrue(util.is_windowed_endpoint(Endpoint.PROBLEMS))
+        self.assertFalse(util.is_windowed_endpoint(Endpoint.SYNTHETIC_LOCATIONS))
+
+    def test_count_response(self):
+        counter = util.initialize_counter()
+        response = Response()
+        response.status_code = 200
+        response._content = b'{"entities": []}'
+        util.count_response(counter, response)
+        # A gzipped response's Content-Length is its compressed size, the decoded body is counted
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Content-Length"] = "5"
+        util.count_response(counter, response)
+        util.count_response(None, response)
+        self.assertEqual(2, counter["response_count"])
+        self.assertEqual(2 * len(response._content), counter["response_size"])
+
+    def test_rate_limited_pages_are_retried_in_place(self):
+        util.rate_limiters.clear()
+        self.addCleanup(util.rate_limiters.clear)
+
+        def make_response(status_code, body, headers=None):
+            response = Response()
+            response.status_code = status_code
+            response._content = json.dumps(body).encode("utf-8")
+            response.headers.update(headers or {})
+            return response
+
+        responses = [
+            make_response(200, {"entities": [{"entityId": "HOST-1"}], "nextPageKey": "page-2"}),
+            make_response(429, {"error": {"code": 429}}, {"Retry-After": "0"}),
+            make_response(200, {"entities": [{"entityId": "HOST-2"}]},
+                          {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "0"}),
+        ]
+        sent_urls = []
+
+        def send(prepared_request, **kwargs):
+            sent_urls.append(prepared_request.url)
+            return responses.pop(0)
+
+        with requests.Session() as session, patch.object(session, "send", side_effect=send):
+            prepared_request = util.prepare_dynatrace_request(
+                session, "https://tenant.example.com/api/v2/entities", {"entitySelector": 'type("HOST")'})
+            pages = list(util._get_dynatrace_data(session, prepared_request, {}, MockModularInput()))
+
+        self.assertEqual([["HOST-1"], ["HOST-2"]], [[e["entityId"] for e in page["entities"]] for page in pages])
+        self.assertEqual(3, len(sent_urls))
+        self.assertIn("nextPageKey=page-2", sent_urls[1])
+        self.assertEqual(sent_urls[1], sent_urls[2])
+
+    def test_failed_pages_are_retried_and_resumed(self):
+        def make_response(status_code, body):
+            response = Response()
+            response.status_code = status_code
+            response._content = json.dumps(body).encode("utf-8")
+            return response
+
+        def page(entity_id, next_page_key=None):
+            return make_response(200, {"entities": [{"entityId": entity_id}], "nextPageKey": next_page_key})
+
+        url = "https://tenant.example.com/api/v2/entities"
+        params = {"entitySelector": 'type("HOST")'}
+        sent_urls = []
+
+        def collect(responses, resume=False):
+            def send(prepared_request, **kwargs):
+                sent_urls.append(prepared_request.url)
+                response = responses.pop(0)
+                if isinstance(response, Exception):
+                    raise response
+                return response
+
+            with requests.Session() as session, patch.object(session, "send", side_effect=send):
+                prepared_request = util.prepare_dynatrace_request(session, url, params)
+                entities = []
+                try:
+                    for page in util._get_dynatrace_data(session, prepared_request, {}, MockModularInput(),
+                                                         resume=resume):
+                        entities.append([e["entityId"] for e in page["entities"]])
+                except util.DynatraceCollectionError as e:
+                    entities.append(e.status_code)
+                return entities
+
+        with patch.object(util.time, "sleep") as sleep:
+            # Transient failures are retried on the same page, a client error fails the chain
+            entities = collect([
+                page("HOST-1", "page-2"),
+                make_response(502, {}),
+                requests.exceptions.ConnectionError("reset"),
+                page("HOST-2", "page-3"),
+                make_response(404, {}),
+            ])
+            self.assertEqual([["HOST-1"], ["HOST-2"], 404], entities)
+            self.assertEqual([1, 2], [c.args[0] for c in sleep.call_args_list])
+            self.assertEqual(sent_urls[1], sent_urls[3])
+
+            # Lists read without a window never resume a chain
+            sent_urls.clear()
+            self.assertEqual([["HOST-1"]], collect([page("HOST-1")], resume=None))
+            self.assertNotIn("nextPageKey", sent_urls[0])
+
+            # The replay of the failed window resumes after the last consumed page
+            sent_urls.clear()
+            self.assertEqual([["HOST-3"]], collect([page("HOST-3")], resume=True))
+            self.assertIn("nextPageKey=page-3", sent_urls[0])
+
+            # A completed chain starts over, as does a chain whose saved key is rejected
+            sent_urls.clear()
+            self.assertEqual([["HOST-1"]], collect([page("HOST-1")], resume=True))
+            self.assertNotIn("nextPageKey", sent_urls[0])
+            collect([page("HOST-1", "page-2"), make_response(500, {})] + [make_response(500, {})] * 3)
+            sent_urls.clear()
+            self.assertEqual([["HOST-1"]], collect([make_response(400, {}), page("HOST-1")], resume=True))
+            self.assertIn("nextPageKey=page-2", sent_urls[0])
+            self.assertNotIn("nextPageKey", sent_urls[1])
+
+    def test_run_deadline(self):
+        class IntervalHelper(MockModularInput):
+            def get_arg(self, name):
+                return {"interval": "300", "dynatrace_collection_interval": "1"}.get(name)
+
+        helper = IntervalHelper()
+        deadline = util.start_run_deadline(helper)
+        self.assertIs(deadline, util.get_run_deadline(helper))
+        self.assertAlmostEqual(300 * util.RUN_DEADLINE_FRACTION, deadline.remaining(), delta=1)
+        self.assertEqual((util.DEFAULT_CONNECT_TIMEOUT_SECONDS, 120), util.get_request_timeout(Endpoint.METRICS_QUERY))
+        self.assertEqual(util.get_request_timeout(Endpoint.METRICS_QUERY), util.get_send_timeout(helper, Endpoint.METRICS_QUERY))
+
+        # Reads are capped at the time left, and no request is sent once it is gone
+        deadline.deadline = time.monotonic() + 5
+        self.assertAlmostEqual(5, util.get_send_timeout(helper)[1], delta=1)
+        deadline.deadline = time.monotonic() - 1
+        self.assertEqual(util.MIN_READ_TIMEOUT_SECONDS, deadline.limit({})["timeout"][1])
+        self.assertFalse(deadline.cut_short)
+        with self.assertRaises(util.RunDeadlineExceeded):
+            util.get_send_timeout(helper)
+        self.assertTrue(deadline.cut_short)
+
+        # Pagination stops before the next page and keeps its resume point
+        response = Response()
+        response.status_code = 200
+        response._content = b'{"entities": [], "nextPageKey": "page-2"}'
+        url = "https://tenant.example.com/api/v2/entities"
+        deadline.deadline = time.monotonic() + 60
+        with requests.Session() as session, patch.object(session, "send", return_value=response) as send:
+            prepared_request = util.prepare_dynatrace_request(session, url, {"entitySelector": 'type("HOST")'})
+            cursor_file = util.get_page_cursor_file(prepared_request.url)
+            pages = util._get_dynatrace_data(session, prepared_request, {}, helper, resume=False)
+            next(pages)
+            deadline.deadline = time.monotonic() - 1
+            with self.assertRaises(util.RunDeadlineExceeded):
+                next(pages)
+        send.assert_called_once()
+        self.assertLessEqual(send.call_args.kwargs["timeout"][1], 60)
+        self.assertEqual("page-2", util.load_page_cursor(cursor_file))
+
+    def test_run_lock(self):
+        class InputHelper(MockModularInput):
+            input_type = "dynatrace_api_v2"
+
+            def get_input_stanza_names(self):
+                return "overlap"
+
+            def get_arg(self, name):
+                return "300" if name == "interval" else None
+
+        helper = InputHelper()
+        runs = []
+        collect_events = util.guard_run(lambda helper, ew: runs.append(helper))
+        with util.run_lock(helper, util.RUN_OVERLAP_SKIP) as proceed:
+            self.assertTrue(proceed)
+            # The next run finds the lock held and skips, takes over only once the holder is stale
+            with util.run_lock(helper, util.RUN_OVERLAP_SKIP) as proceed:
+                self.assertFalse(proceed)
+            with util.run_lock(helper, util.RUN_OVERLAP_TAKEOVER) as proceed:
+                self.assertFalse(proceed)
+            with patch.object(util.time, "time", return_value=time.time() + 601):
+                with util.run_lock(helper, util.RUN_OVERLAP_TAKEOVER) as proceed:
+                    self.assertTrue(proceed)
+            with patch.object(util.time, "sleep"), patch.object(util.time, "monotonic", side_effect=[0, 0, 1000]):
+                with util.run_lock(helper, util.RUN_OVERLAP_WAIT) as proceed:
+                    self.assertFalse(proceed)
+            collect_events(helper, None)
+            self.assertEqual([], runs)
+        collect_events(helper, None)
+        self.assertEqual([helper], runs)
+
+        counts = util.read_json_state(util.get_state_file(util.RUN_LOCK_DIR, f"{util.get_run_lock_key(helper)}|overlaps"))
+        self.assertEqual((4, 1), (counts["skipped"], counts["overlapped"]))
+        self.assertEqual(util.RUN_OVERLAP_WAIT, util.parse_run_overlap_policy("Wait"))
+        self.assertEqual(util.DEFAULT_RUN_OVERLAP_POLICY, util.parse_run_overlap_policy("never"))
+
+        # A run that waited for the lock keeps only what is left of its deadline
+        clock = [1000.0]
+        lock_results = iter([False])
+        with patch.object(util.time, "monotonic", side_effect=lambda: clock[0]), patch.object(
+                util.time, "sleep", side_effect=lambda seconds: clock.__setitem__(0, clock[0] + 200)
+        ), patch.object(util, "lock_file", side_effect=lambda f, blocking=True: next(lock_results, True)):
+            with util.run_lock(helper, util.RUN_OVERLAP_WAIT) as proceed:
+                self.assertTrue(proceed)
+                self.assertEqual(300 * util.RUN_DEADLINE_FRACTION - 200, util.start_run_deadline(helper).remaining())
+            self.assertEqual(300 * util.RUN_DEADLINE_FRACTION, util.start_run_deadline(helper).remaining())
+
+    def test_run_daemon(self):
+        class Event:
+            stanza = None
+
+        class SingleInstanceHelper(MockModularInput):
+            use_single_instance = True
+            input_type = "dynatrace_api_v2"
+
+            def get_input_stanza_names(self):
+                return ["first", "second"]
+
+            def get_arg(self, name):
+                return {"first": "60", "second": "3600"} if name == "interval" else {"first": "a", "second": "b"}
+
+            def new_event(self, *args, **kwargs):
+                return Event()
+
+        stop_event = threading.Event()
+        written = []
+        runs = []
+
+        class Writer:
+            def write_event(self, event):
+                written.append(event.stanza)
+
+        @util.guard_run
+        def collect_events(helper, ew):
+            runs.append((helper.get_input_stanza_names(), helper.get_arg("dynatrace_account"), helper.correlation_id))
+            ew.write_event(helper.new_event(data="{}"))
+            if len(runs) == 2:
+                stop_event.set()
+
+        self.addCleanup(setattr, util, "session_registry", None)
+        util.run_daemon(SingleInstanceHelper(), Writer(), collect_events, stop_event=stop_event)
+        self.assertEqual({("first", "a"), ("second", "b")}, {run[:2] for run in runs})
+        self.assertNotEqual(runs[0][2], runs[1][2])
+        self.assertEqual({"first", "second"}, set(written))
+
+        # Daemon runs reuse their sessions and connection pools
+        with util.dynatrace_session("https://tenant.example.com", "token") as session:
+            util.mount_connection_pool(session, 8)
+            adapter = session.get_adapter("https://")
+        with util.dynatrace_session("https://tenant.example.com", "token") as reused:
+            self.assertIs(session, reused)
+            util.mount_connection_pool(reused, 4)
+            self.assertIs(adapter, reused.get_adapter("https://"))
+            # Every session to a tenant shares its bounded pool
+            tenant_adapter = reused.get_adapter("https://tenant.example.com/api/v2/entities")
+            self.assertIs(util.get_tenant_adapter("https://tenant.example.com"), tenant_adapter)
+            self.assertEqual(util.MAX_TENANT_CONNECTIONS, tenant_adapter._pool_maxsize)
+            self.assertTrue(tenant_adapter._pool_block)
+            with util.dynatrace_session("https://tenant.example.com", "other token") as other:
+                self.assertIs(tenant_adapter, other.get_adapter("https://tenant.example.com/api/v2/problems"))
+        util.session_registry = None
+        with util.dynatrace_session("https://tenant.example.com", "token") as fresh:
+            self.assertIsNot(session, fresh)
+
+    def test_run_daemon_shares_workers_between_tenants(self):
+        class MultiTenantHelper(MockModularInput):
+            use_single_instance = True
+
+            def get_input_stanza_names(self):
+                return ["slow-1", "slow-2", "slow-3", "fast"]
+
+            def get_arg(self, name):
+                if name == "dynatrace_account":
+                    return {stanza: {"username": "fast.example.com" if stanza == "fast" else "slow.example.com"}
+                            for stanza in self.get_input_stanza_names()}
+                return dict.fromkeys(self.get_input_stanza_names(), "3600")
+
+        stop_event = threading.Event()
+        release = threading.Event()
+        lock = threading.Lock()
+        started = []
+
+        def collect_events(helper, ew):
+            with lock:
+                started.append(helper.get_input_stanza_names())
+                if len(started) == 2:
+                    release.set()
+                if len(started) == 4:
+                    stop_event.set()
+            release.wait(5)
+
+        self.addCleanup(setattr, util, "session_registry", None)
+        util.run_daemon(MultiTenantHelper(), None, collect_events, stop_event=stop_event, max_workers=2)
+        # The tenant with one stanza gets a worker before the second stanza of the busy tenant
+        self.assertIn("fast", started[:2])
+        self.assertEqual(4, len(started))
+        self.assertEqual("https://slow.example.com/", util.get_stanza_tenant(util.StanzaHelper(MultiTenantHelper(), "slow-1")))
+
+    def test_rate_limiter(self):
+        self.assertEqual(30, util.parse_retry_after("30"))
+        self.assertIsNone(util.parse_retry_after("soon"))
+        self.assertAlmostEqual(10, util.parse_rate_limit_reset(str(int((time.time() + 10) * 1e6))), delta=1)
+        self.assertAlmostEqual(10, util.parse_rate_limit_reset(str(int((time.time() + 10) * 1e3))), delta=1)
+        self.assertEqual(5, util.parse_rate_limit_reset("5"))
+
+        rate_limiter = util.RateLimiter(requests_per_minute=600)
+        # The burst is served immediately, then requests are paced at 10 per second
+        with patch.object(util.time, "sleep") as sleep:
+            for _ in range(100):
+                self.assertEqual(0, rate_limiter.acquire())
+            sleep.assert_not_called()
+            sleep.side_effect = lambda seconds: setattr(rate_limiter, "tokens", 1)
+            self.assertGreater(rate_limiter.acquire(), 0)
+
+        self.assertEqual(util.MAX_RATE_LIMIT_WAIT_SECONDS, rate_limiter.pause(3600))
+
+        # A limiter kept by the daemon applies a changed setting once it expires, its pause stays
+        class RateHelper(MockModularInput):
+            requests_per_minute = "600"
+
+            def get_global_setting(self, name):
+                return self.requests_per_minute
+
+        url = "https://rate.example.com/api/v2/entities"
+        helper = RateHelper()
+        with patch.dict(util.rate_limiters, clear=True):
+            rate_limiter = util.get_rate_limiter(url, helper)
+            rate_limiter.pause(30)
+            helper.requests_per_minute = "60"
+            self.assertEqual(10, util.get_rate_limiter(url, helper).rate)
+            rate_limiter.settings_loaded -= util.RUNTIME_SETTINGS_TTL_SECONDS
+            self.assertIs(rate_limiter, util.get_rate_limiter(url, helper))
+            self.assertEqual(1, rate_limiter.rate)
+            self.assertEqual(10, rate_limiter.capacity)
+            self.assertGreater(rate_limiter.blocked_until, time.monotonic())
+        response = Response()
+        response.headers["Retry-After"] = "2"
+        self.assertEqual(2, util.RateLimiter().throttled(response, 0))
+        self.assertEqual(4, util.RateLimiter().throttled(Response(), 2))
+
+    def test_shared_rate_budget(self):
+        util.rate_limiters.clear()
+        self.addCleanup(util.rate_limiters.clear)
+        url = "https://tenant.example.com/api/v2/entities"
+        first = util.get_rate_limiter(url, None, "Api-Token first")
+        self.assertIs(first, util.get_rate_limiter(url, None, "Api-Token first"))
+        self.assertIsNot(first, util.get_rate_limiter(url, None, "Api-Token second"))
+        self.assertNotIn("first", first.shared_budget.path)
+
+        # Two processes using the same tenant token draw from one budget of ten seconds worth of requests
+        path = util.get_state_file(util.RATE_LIMIT_STATE_DIR, "shared")
+        limiters = [util.RateLimiter(60, util.SharedRateBudget(path, 60)) for _ in range(2)]
+        with patch.object(util.time, "sleep") as sleep:
+            for i in range(10):
+                self.assertEqual(0, limiters[i % 2].acquire())
+            sleep.side_effect = lambda seconds: util.write_json_state(path, {"tokens": 1, "updated": time.time()})
+            self.assertGreater(limiters[0].acquire(), 0)
+            sleep.assert_called_once()
+
+        # A pause taken by one process holds the other
+        unlimited = [util.RateLimiter(0, util.SharedRateBudget(path, 0)) for _ in range(2)]
+        unlimited[0].pause(5)
+        with patch.object(util.time, "sleep") as sleep:
+            sleep.side_effect = lambda seconds: util.write_json_state(path, {})
+            self.assertGreater(unlimited[1].acquire(), 4)
+
+    def test_helper_log_is_lazy(self):
+        class LeveledHelper(MockModularInput):
+            def __init__(self, level):
+                self.logger = logging.getLogger(f"test_helper_log_{level}")
+                self.logger.setLevel(level)
+                self.messages = []
+
+            def log_debug(self, msg, *args, **kwargs):
+                self.messages.append(msg)
+
+        class Unformattable:
+            def __str__(self):
+                raise AssertionError("debug message formatted while debug is disabled")
+
+        info_helper = LeveledHelper(logging.INFO)
+        log = util.get_helper_log(info_helper)
+        self.assertIs(log, util.get_helper_log(info_helper))
+        self.assertFalse(log.debug_enabled)
+        log.debug("value: %s", Unformattable())
+        self.assertEqual([], info_helper.messages)
+
+        debug_helper = LeveledHelper(logging.DEBUG)
+        util.get_helper_log(debug_helper).debug("value: %s", 1)
+        self.assertEqual(["value: 1"], debug_helper.messages)
+
+    def test_helper_log_response_sample(self):
+        messages = []
+
+        class SampleHelper(MockModularInput):
+            correlation_id = "test"
+
+            def get_global_setting(self, name):
+                return "4" if name == "response_log_bytes" else None
+
+            def log_info(self, msg, *args, **kwargs):
+                messages.append(msg)
+
+        response = Response()
+        response.status_code = 200
+        response.url = "http://localhost:12345/api/v2/problems"
+        response._content = b'{"problems": []}'
+        util.get_helper_log(SampleHelper()).response_sample(response)
+        self.assertEqual(1, len(messages))
+        self.assertTrue(messages[0].endswith('{"pr'))
+
+    def test_ssl_certificate_verification_resolved_once(self):
+        certificate = "-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n"
+        util.ssl_certificate_bundles.clear()
+        self.addCleanup(util.ssl_certificate_bundles.clear)
+
+        class CertificateHelper(MockModularInput):
+            setting_reads = 0
+
+            def get_global_setting(self, name):
+                CertificateHelper.setting_reads += 1
+                return certificate
+
+        helper = CertificateHelper()
+        with patch.object(
+                util, "write_certificate_to_file", wraps=util.write_certificate_to_file
+        ) as write_certificate:
+            bundle = util.get_ssl_certificate_verification(helper)
+            for _ in range(10):
+                self.assertEqual(bundle, util.get_ssl_certificate_verification(helper))
+            self.assertEqual(1, write_certificate.call_count)
+            self.assertEqual(1, CertificateHelper.setting_reads)
+
+            # A new process with the same certificate on disk must not rewrite it
+            util.ssl_certificate_bundles.clear()
+            self.assertEqual(bundle, util.get_ssl_certificate_verification(user_certificate=certificate))
+            self.assertEqual(1, write_certificate.call_count)
+
+        with open(bundle) as f:
+            self.assertEqual(certificate, f.read())
+
+    def test_request_settings_resolved_once_per_session(self):
+        class ProxyHelper(MockModularInput):
+            proxy_lookups = 0
+
+            def _get_proxy_uri(self):
+                ProxyHelper.proxy_lookups += 1
+                return "http://proxy.example.com:3128"
+
+        prepared_params_list = [
+            ("https://tenant.example.com/api/v2/entities", {"entitySelector": f'type("{t}")'}, Endpoint.ENTITIES)
+            for t in ("HOST", "SERVICE", "PROCESS_GROUP")
+        ]
+        with requests.Session() as session, patch.object(
+                session, "merge_environment_settings", wraps=session.merge_environment_settings
+        ) as merge_settings, patch.object(
+            util, "_get_dynatrace_data", return_value=iter([])
+        ) as get_data:
+            list(util.get_dynatrace_data(session, prepared_params_list, ProxyHelper(), verify=True))
+            list(util.get_dynatrace_data(session, prepared_params_list, ProxyHelper(), verify=True))
+
+            # A session kept by the daemon picks up a changed proxy once the settings expire
+            session.dynatrace_request_settings_loaded -= util.RUNTIME_SETTINGS_TTL_SECONDS
+            list(util.get_dynatrace_data(session, prepared_params_list[:1], ProxyHelper(), verify=True))
+
+        self.assertEqual(2, ProxyHelper.proxy_lookups)
+        self.assertEqual(2, merge_settings.call_count)
+        self.assertEqual(7, get_data.call_count)
+        settings = get_data.call_args[0][2]
+        self.assertEqual("http://proxy.example.com:3128", settings["proxies"]["https"])
+        self.assertTrue(settings["verify"])
+
+    def test_prefetch_is_bounded(self):
+        produced = []
+
+        def pages():
+            for index in range(100):
+                produced.append(index)
+                yield index
+
+        stream = util.prefetch(pages(), buffer_size=2)
+        consumed = []
+        for page in stream:
+            consumed.append(page)
+            time.sleep(0.01)
+            # The producer runs at most the buffer plus the page being handed over ahead
+            self.assertLessEqual(len(produced), len(consumed) + 3)
+            if len(consumed) == 5:
+                break
+        stream.close()
+        self.assertEqual([0, 1, 2, 3, 4], consumed)
+        time.sleep(0.3)
+        self.assertLessEqual(len(produced), 8)
+
+        def failing_pages():
+            yield 1
+            raise requests.exceptions.ConnectionError("connection reset")
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            list(util.prefetch(failing_pages()))
+
+    def test_parse_detail_workers(self):
+        self.assertEqual(util.DEFAULT_DETAIL_WORKERS, util.parse_detail_workers(None))
+        self.assertEqual(util.DEFAULT_DETAIL_WORKERS, util.parse_detail_workers("abc"))
+        self.assertEqual(8, util.parse_detail_workers("8"))
+        self.assertEqual(1, util.parse_detail_workers("0"))
+        self.assertEqual(util.MAX_DETAIL_WORKERS, util.parse_detail_workers("1000"))
+
     def test_prepare_dynatrace_params(self):
         print()
         print("test_prepare_dynatrace_params() called")
@@ -672,7 +1487,7 @@ class TestUtil(unittest.TestCase):
             }
         )
         expected_params = {
-            "fields": "unit,aggregationTypes",
+            "fields": "unit,aggregationTypes,entityType",
             "writtenSince": time,
             "pageSize": "10",
             "metricKey": "builtin:host.cpu.usage:merge(0):avg",
@@ -1155,6 +1970,402 @@ class TestMetricsUtil(unittest.TestCase):
                     for key in example_data:
                         self.assertIn(key, example_data.keys())
 
+    def test_build_metric_measurements(self):
+        def series(dimension_map, values):
+            return {"dimensionMap": dimension_map, "dimensions": list(dimension_map.values()),
+                    "timestamps": [1000, 2000], "values": values}
+
+        metric_data = {
+            "resolution": "1m",
+            "result": [
+                {"metricId": "builtin:host.cpu.usage", "data": [series({"dt.entity.host": "HOST-1"}, [10.0, None])]},
+                {"metricId": "builtin:host.cpu.idle", "data": [series({"dt.entity.host": "HOST-1"}, [90.0, 80.0])]},
+                {"metricId": "builtin:host.mem.used", "data": [series({"dt.entity.host": "HOST-1"}, [5.0, 6.0])]},
+            ],
+        }
+        mapping = {
+            "builtin:host.cpu.usage": ("Percent", ["auto", "avg"]),
+            "builtin:host.cpu.idle": ("Percent", ["auto", "avg"]),
+            "builtin:host.mem.used": ("Byte", ["auto", "avg"]),
+        }
+        measurements = list(dt_metrics.build_metric_measurements([metric_data], mapping, "tenant"))
+
+        self.assertEqual(4, len(measurements))
+        percent_first, percent_second, bytes_first, bytes_second = measurements
+        self.assertEqual(
+            {"dt.entity.host": "HOST-1", "timestamp": 1000, "dynatraceTenant": "tenant", "resolution": "1m",
+             "unit": "Percent", "aggregation_types": "auto,avg",
+             "metric_name:builtin:host.cpu.usage": 10.0, "metric_name:builtin:host.cpu.idle": 90.0},
+            percent_first,
+        )
+        # Null datapoints are skipped rather than written as measurements
+        self.assertNotIn("metric_name:builtin:host.cpu.usage", percent_second)
+        self.assertEqual(80.0, percent_second["metric_name:builtin:host.cpu.idle"])
+        self.assertEqual("Byte", bytes_first["unit"])
+        self.assertEqual(6.0, bytes_second["metric_name:builtin:host.mem.used"])
+
+        self.assertEqual("metrics", dt_metrics.parse_output_mode(" Metrics "))
+        self.assertEqual("events", dt_metrics.parse_output_mode(None))
+        self.assertEqual("events", dt_metrics.parse_output_mode("unknown"))
+
+    def test_build_series_events(self):
+        metric_data = {
+            "resolution": "1m",
+            "result": [{"metricId": "builtin:host.cpu.usage", "data": [
+                {"dimensionMap": {"dt.entity.host": "HOST-1"}, "dimensions": ["HOST-1"],
+                 "timestamps": [60000, 120000, 180000], "values": [1.0, None, 3.0]},
+                {"dimensionMap": {"dt.entity.host": "HOST-2"}, "dimensions": ["HOST-2"],
+                 "timestamps": [], "values": []},
+            ]}],
+        }
+        mapping = {"builtin:host.cpu.usage": ("Percent", ["avg"])}
+        events = list(dt_metrics.build_series_events(metric_data, mapping, "tenant"))
+
+        self.assertEqual(1, len(events))
+        self.assertEqual(
+            {"timestamp": 60000, "metric_id": "builtin:host.cpu.usage", "unit": "Percent", "aggregation_types": ["avg"],
+             "dynatraceTenant": "tenant", "resolution": "1m", "dimensions": ["HOST-1"],
+             "dimension_map": {"dt.entity.host": "HOST-1"}, "timestamps": [60000, 120000, 180000],
+             "values": [1.0, None, 3.0]},
+            events[0],
+        )
+        datapoint_events = list(dt_metrics.build_datapoint_events(metric_data, mapping, "tenant"))
+        self.assertEqual(3, len(datapoint_events))
+        self.assertLess(len(json.dumps(events)), len(json.dumps(datapoint_events)))
+
+        estimate = dt_metrics.estimate_metric_selectors(["builtin:host.cpu.usage"], {}, 60, "tenant", "series")
+        self.assertEqual(1, estimate["events"])
+        self.assertEqual(60, estimate["selectors"][0]["datapoints"])
+
+    def test_drop_null_datapoints(self):
+        metric_data = {
+            "resolution": "1m",
+            "result": [{"metricId": "builtin:host.cpu.usage", "data": [
+                {"dimensionMap": {"dt.entity.host": "HOST-1"}, "dimensions": ["HOST-1"],
+                 "timestamps": [60000, 120000, 180000, 240000], "values": [1.0, None, float("nan"), 4.0]},
+            ]}],
+        }
+        mapping = {"builtin:host.cpu.usage": ("Percent", ["avg"])}
+
+        counter = {"dropped_count": 0}
+        events = list(dt_metrics.build_datapoint_events(metric_data, mapping, "tenant", drop_null=True, counter=counter))
+        self.assertEqual([1.0, 4.0], [event["value"] for event in events])
+        self.assertEqual(2, counter["dropped_count"])
+
+        counter = {"dropped_count": 0}
+        series_event, = dt_metrics.build_series_events(metric_data, mapping, "tenant", drop_null=True, counter=counter)
+        self.assertEqual([60000, 240000], series_event["timestamps"])
+        self.assertEqual([1.0, 4.0], series_event["values"])
+        self.assertEqual(2, counter["dropped_count"])
+
+        counter = {}
+        measurements = list(dt_metrics.build_metric_measurements([metric_data], mapping, "tenant", counter=counter))
+        self.assertEqual(2, len(measurements))
+        self.assertEqual(2, counter["dropped_count"])
+
+        counter = {}
+        data_points = list(dt_metrics.flatten_and_zip_timeseries(metric_data, drop_null=True, counter=counter))
+        self.assertEqual([1.0, 4.0], [data_point["value"] for data_point in data_points])
+        self.assertEqual(4, len(list(dt_metrics.flatten_and_zip_timeseries(metric_data))))
+
+        self.assertEqual(4, len(list(dt_metrics.build_datapoint_events(metric_data, mapping, "tenant"))))
+        self.assertTrue(dt_metrics.parse_drop_null_values(None))
+        self.assertTrue(dt_metrics.parse_drop_null_values("1"))
+        self.assertFalse(dt_metrics.parse_drop_null_values("0"))
+
+    def test_plan_metric_query_windows(self):
+        hour = 60 * 60 * 1000
+        now = 1000 * 24 * hour
+
+        self.assertEqual(("1m", [(now - 5 * 60000, now)]),
+                         dt_metrics.plan_metric_query_windows(now - 5 * 60000, now, now=now))
+        # A configured resolution is kept, an unknown one falls back to auto
+        self.assertEqual("5m", dt_metrics.plan_metric_query_windows(now - hour, now, "5m", now=now)[0])
+        self.assertEqual("1m", dt_metrics.plan_metric_query_windows(now - hour, now, "auto", now=now)[0])
+        # Data older than the 1 minute retention is only available at coarser resolutions
+        self.assertEqual("5m", dt_metrics.plan_metric_query_windows(now - 20 * 24 * hour, now, now=now)[0])
+        self.assertEqual("1h", dt_metrics.plan_metric_query_windows(now - 60 * 24 * hour, now, now=now)[0])
+
+        # 6 hours at 1m exceed 120 datapoints per series, split at aligned 2 hour boundaries
+        start = now - 6 * hour - 30 * 60000
+        resolution, sub_windows = dt_metrics.plan_metric_query_windows(start, now, now=now)
+        self.assertEqual("1m", resolution)
+        self.assertEqual([(start, now - 6 * hour), (now - 6 * hour, now - 4 * hour), (now - 4 * hour, now - 2 * hour),
+                          (now - 2 * hour, now)], sub_windows)
+
+        # Unaligned windows are floored to whole buckets, consecutive windows neither share nor skip one
+        buckets = []
+        for window_start, window_end in ((now - hour + 1234, now - 30 * 60000 - 1), (now - 30 * 60000 - 1, now - 30 * 60000),
+                                         (now - 30 * 60000, now - 7 * 60000 + 59999)):
+            resolution, sub_windows = dt_metrics.plan_metric_query_windows(window_start, window_end, "5m", now=now)
+            for sub_start, sub_end in sub_windows:
+                self.assertEqual((0, 0), (sub_start % (5 * 60000), sub_end % (5 * 60000)))
+                buckets.extend(range(sub_start // (5 * 60000), sub_end // (5 * 60000)))
+        self.assertEqual(list(range((now - hour) // (5 * 60000), (now - 10 * 60000) // (5 * 60000))), buckets)
+        self.assertEqual(("5m", []), dt_metrics.plan_metric_query_windows(now - 60000, now - 1, "5m", now=now))
+
+    def test_query_metric_selector_windows_keeps_order(self):
+        def execute_session(endpoint, tenant, api_token, params, extra_params=None, **kwargs):
+            # Later windows answer first
+            time.sleep(0.01 * (5 - params["time"]))
+            return iter([{"resolution": params["resolution"], "result": [], "window": params["time"], "page": page}
+                         for page in range(2)])
+
+        sub_windows = [(index, index + 1) for index in range(5)]
+        with patch.object(dt_metrics.util, "execute_session", side_effect=execute_session):
+            pages = list(dt_metrics.query_metric_selector_windows("tenant", "token", sub_windows, "1m", ["a"],
+                                                                  opt_helper=MockModularInput(), max_workers=3))
+        self.assertEqual([(window, page) for window in range(5) for page in range(2)],
+                         [(page["window"], page["page"]) for page in pages])
+        self.assertEqual({"1m"}, {page["resolution"] for page in pages})
+
+    def test_pack_metric_selectors(self):
+        self.assertEqual(
+            ['builtin:host.cpu.usage:filter(and(eq("os","linux"),in("dt.entity.host",entitySelector("type(~"HOST~")"))))',
+             'builtin:host.mem.used:avg'],
+            dt_metrics.split_metric_selector(
+                'builtin:host.cpu.usage:filter(and(eq("os","linux"),in("dt.entity.host",entitySelector("type(~"HOST~")")))),'
+                ' builtin:host.mem.used:avg'),
+        )
+        selectors = [f"builtin:metric.{index}" for index in range(25)]
+        groups = dt_metrics.pack_metric_selectors(selectors)
+        self.assertEqual([10, 10, 5], [len(group) for group in groups])
+        self.assertEqual(selectors, [selector for group in groups for selector in group])
+
+        # A selector that already lists several metrics counts towards the limit with each of them
+        groups = dt_metrics.pack_metric_selectors(["a,b,c,d,e,f,g,h,i", "j,k", "l"])
+        self.assertEqual([["a,b,c,d,e,f,g,h,i"], ["j,k", "l"]], groups)
+
+    def test_query_metric_selector_group_splits_truncated_groups(self):
+        queried = []
+
+        def execute_session(endpoint, tenant, api_token, params, extra_params=None, **kwargs):
+            selector = extra_params[0]
+            queried.append(selector)
+            if selector == "a,b,c,d":
+                return iter([{"resolution": "1m", "warnings": ["The result was truncated to 1000 series."], "result": []}])
+            if selector == "a,b":
+                # One of the selectors was rejected, the whole request failed
+                return iter([])
+            return iter([{"resolution": "1m", "result": [{"metricId": selector, "data": []}]}])
+
+        with patch.object(dt_metrics.util, "execute_session", side_effect=execute_session):
+            metric_data_list = list(dt_metrics.query_metric_selector_group(
+                "tenant", "token", {"time": 1, "end_time": 2}, ["a", "b", "c", "d"], opt_helper=MockModularInput()))
+
+        self.assertEqual(["a,b,c,d", "a,b", "a", "b", "c,d"], queried)
+        self.assertEqual(["a", "b", "c,d"], [md["result"][0]["metricId"] for md in metric_data_list])
+
+    def test_query_metric_selector_group_prefetches_without_page_keys(self):
+        def execute_session(endpoint, tenant, api_token, params, extra_params=None, **kwargs):
+            yield {"resolution": "1m", "result": [{"metricId": extra_params[0], "data": []}]}
+
+        for resume, prefetched in ((None, True), (False, False), (True, False)):
+            with patch.object(dt_metrics.util, "execute_session", side_effect=execute_session), \
+                    patch.object(dt_metrics.util, "prefetch", side_effect=lambda pages, size: pages) as prefetch:
+                metric_data_list = list(dt_metrics.query_metric_selector_group(
+                    "tenant", "token", {"time": 1, "end_time": 2}, ["a"], opt_helper=MockModularInput(),
+                    resume=resume))
+            self.assertEqual(["a"], [md["result"][0]["metricId"] for md in metric_data_list])
+            # Saved page keys must not get ahead of the written pages
+            self.assertEqual(prefetched, prefetch.called)
+
+    def test_query_metric_selector_group_shards_truncated_selector(self):
+        entity_ids = [f"CLOUD_APPLICATION_INSTANCE-{index}" for index in range(5)]
+        queried_shards = []
+
+        def execute_session(endpoint, tenant, api_token, params, extra_params=None, **kwargs):
+            # metrics_util uses the top level util module, compare endpoints by name
+            if endpoint.name == "ENTITIES":
+                self.assertEqual(["CLOUD_APPLICATION_INSTANCE"], extra_params)
+                return iter([{"entityId": entity_id} for entity_id in entity_ids])
+            entity_selector = params.get("entitySelector")
+            warnings = []
+            if entity_selector is None or entity_selector.count(",") >= 2:
+                # More than two entities per query exceeds the series limit
+                warnings = ["The result was truncated to 1000 series."]
+            else:
+                queried_shards.append(entity_selector)
+            # A selector merging the entities away returns series without their dimension
+            dimension_map = {} if ":merge" in extra_params[0] else {"dt.entity.cloud_application_instance": "X"}
+            return iter([{"resolution": "1m", "warnings": warnings,
+                          "result": [{"metricId": "builtin:kubernetes.pods",
+                                      "data": [{"dimensionMap": dimension_map, "entitySelector": entity_selector}]}]}])
+
+        def query(metric_selector):
+            with patch.object(dt_metrics.util, "execute_session", side_effect=execute_session):
+                return list(dt_metrics.query_metric_selector_group(
+                    "tenant", "token", {"time": 1, "end_time": 2}, [metric_selector],
+                    opt_helper=MockModularInput(),
+                    metric_entity_types={"builtin:kubernetes.pods": "CLOUD_APPLICATION_INSTANCE"}))
+
+        metric_data_list = query("builtin:kubernetes.pods")
+        merged = [md["result"][0]["data"][0]["entitySelector"] for md in metric_data_list]
+        self.assertEqual(sorted(queried_shards), sorted(merged))
+        self.assertEqual(
+            entity_ids,
+            [entity_id for selector in merged for entity_id in json.loads("[" + selector[len("entityId("):-1] + "]")],
+        )
+
+        # Shards of an aggregate across entities would each be a partial aggregate, the truncated result is kept
+        queried_shards.clear()
+        metric_data_list = query('builtin:kubernetes.pods:merge("dt.entity.cloud_application_instance")')
+        self.assertEqual([], queried_shards)
+        self.assertEqual(1, len(metric_data_list))
+        self.assertTrue(metric_data_list[0]["warnings"])
+
+        catalog = {"descriptors": {"builtin:kubernetes.pods": {"entityType": ["CLOUD_APPLICATION_INSTANCE"]},
+                                   "builtin:tenant.dbu": {"entityType": []}}}
+        self.assertEqual({"builtin:kubernetes.pods": "CLOUD_APPLICATION_INSTANCE"},
+                         dt_metrics.get_metric_entity_types(catalog))
+
+    def test_failed_sub_window_is_replayed_once(self):
+        class CheckpointHelper(MockModularInput):
+            def __init__(self):
+                self.check_points = {}
+
+            def get_check_point(self, key):
+                return self.check_points.get(key)
+
+            def save_check_point(self, key, state):
+                self.check_points[key] = state
+
+        def make_response(status_code, body):
+            response = Response()
+            response.status_code = status_code
+            response._content = json.dumps(body).encode("utf-8")
+            return response
+
+        minute = 60000
+        failing = [True]
+
+        def send(prepared_request, **kwargs):
+            query = parse.parse_qs(parse.urlparse(prepared_request.url).query)
+            page_key = query.get("nextPageKey", [None])[0]
+            start = int(query["from"][0]) if "from" in query else int(page_key.split("-")[0])
+            if page_key is None and start == 10 * minute:
+                # The second sub-window has two pages, the second one fails until the replay
+                return make_response(200, {"resolution": "1m", "nextPageKey": f"{start}-2",
+                                           "result": [{"metricId": "m", "data": [{"timestamps": [1]}]}]})
+            if page_key is not None and failing[0]:
+                return make_response(503, {})
+            timestamp = 2 if page_key else 0 if start == 0 else 1
+            return make_response(200, {"resolution": "1m", "result": [{"metricId": "m", "data": [{"timestamps": [timestamp]}]}]})
+
+        helper = CheckpointHelper()
+        written = []
+
+        def collect_window(window_start, window_end, resume, checkpoint):
+            sub_windows = [(window_start, 10 * minute), (10 * minute, window_end)] if window_start < 10 * minute \
+                else [(window_start, window_end)]
+            for metric_data in dt_metrics.query_metric_selector_windows(
+                    "https://tenant.example.com", "token", sub_windows, "1m", ["m"], opt_helper=helper,
+                    resume=resume, sub_window_done=checkpoint, max_workers=2):
+                written.append(metric_data["result"][0]["data"][0]["timestamps"])
+
+        with tempfile.TemporaryDirectory() as local_dir, patch.object(dt_metrics.util, "local_dir", local_dir), \
+                patch.object(dt_metrics.util.time, "sleep"), patch.object(requests.Session, "send", side_effect=send):
+            windows = [(0, 20 * minute)]
+            self.assertFalse(dt_metrics.util.collect_windows(helper, ["m"], windows, collect_window))
+            self.assertEqual({"end_time": 10 * minute, "pending_end": 20 * minute}, helper.check_points["m"])
+
+            # The replay skips the written sub-window and collects the failed one from its first page
+            failing[0] = False
+            watermark, pending_end = dt_metrics.util.get_window_state(helper, "m")
+            windows = dt_metrics.util.plan_time_windows(watermark, 20, now=20 * minute, pending_end=pending_end)
+            self.assertTrue(dt_metrics.util.collect_windows(helper, ["m"], windows, collect_window,
+                                                            pending_end=pending_end))
+        self.assertEqual([[0], [1], [2]], written)
+        self.assertEqual({"end_time": 20 * minute}, helper.check_points["m"])
+
+    def test_estimate_metric_selectors(self):
+        descriptors = {
+            "builtin:host.cpu.usage": {
+                "metricId": "builtin:host.cpu.usage", "unit": "Percent", "aggregationTypes": ["auto", "avg"],
+                "dimensionDefinitions": [{"key": "dt.entity.host", "name": "Host"}],
+                "dimensionCardinalities": [{"key": "dt.entity.host", "estimate": 250, "relative": 0.0}],
+            },
+            "builtin:kubernetes.pods": {
+                "metricId": "builtin:kubernetes.pods", "unit": "Count",
+                "dimensionDefinitions": [{"key": "k8s.namespace.name"}, {"key": "k8s.pod.name"}],
+                "dimensionCardinalities": [{"key": "k8s.namespace.name", "estimate": 40, "relative": 0.0},
+                                           {"key": "k8s.pod.name", "estimate": 4000, "relative": 0.0}],
+            },
+        }
+        metric_selectors = [
+            "builtin:host.cpu.usage:merge(0):avg",
+            "builtin:host.cpu.usage:sort(value(max,descending)):limit(10),builtin:kubernetes.pods",
+            "builtin:kubernetes.pods:splitBy():sum",
+            "custom.metric",
+        ]
+        estimate = dt_metrics.estimate_metric_selectors(metric_selectors, descriptors, 5, "tenant")
+
+        self.assertEqual([1, 10 + 4000, 1, 1], [e["series"] for e in estimate["selectors"]])
+        self.assertEqual([5, 20050, 5, 5], [e["events"] for e in estimate["selectors"]])
+        self.assertEqual([False, True, False, False], [e["truncation_expected"] for e in estimate["selectors"]])
+        self.assertEqual(["custom.metric"], estimate["selectors"][3]["unresolved"])
+        self.assertEqual(2, estimate["requests"])
+        self.assertEqual(20065, estimate["events"])
+
+        # Merged dimensions no longer split series, named ones are kept
+        pods = descriptors["builtin:kubernetes.pods"]
+        self.assertEqual(4000, dt_metrics.estimate_selector_series("builtin:kubernetes.pods", pods))
+        self.assertEqual(40, dt_metrics.estimate_selector_series('builtin:kubernetes.pods:merge("k8s.pod.name")', pods))
+        self.assertEqual(40, dt_metrics.estimate_selector_series("builtin:kubernetes.pods:merge(1)", pods))
+        self.assertEqual(40, dt_metrics.estimate_selector_series("builtin:kubernetes.pods:splitBy(k8s.namespace.name)", pods))
+        self.assertEqual(1, dt_metrics.estimate_selector_series("builtin:kubernetes.pods:merge(0,1)", pods))
+        self.assertTrue(all(e["bytes"] > e["events"] * 100 for e in estimate["selectors"]))
+
+    def test_metric_descriptor_catalog_incremental(self):
+        tenant = "http://localhost:12345"
+        selectors = ["builtin:host.cpu.usage", "builtin:host.cpu.idle"]
+        requested_params = []
+
+        def fake_execute_session(endpoint, tenant, api_token, params, extra_params=None, **kwargs):
+            requested_params.append(dict(params))
+            metric_id = "builtin:host.cpu.idle" if params else "builtin:host.cpu.usage"
+            return [{"metrics": [{"metricId": metric_id, "unit": "Percent", "aggregationTypes": ["avg"]}]}]
+
+        # metrics_util imports util from package/bin, patch that module rather than package.bin.util
+        with tempfile.TemporaryDirectory() as local_dir, patch.object(
+                dt_metrics.util, "local_dir", local_dir
+        ), patch.object(dt_metrics.util, "execute_session", side_effect=fake_execute_session):
+            dt_metrics.refresh_metric_descriptor_catalog(tenant, "test_token", selectors)
+            catalog = dt_metrics.refresh_metric_descriptor_catalog(tenant, "test_token", selectors)
+            reloaded = dt_metrics.load_metric_descriptor_catalog(tenant)
+
+        # First run is a full fetch, the second only asks for metrics written since the first
+        self.assertEqual({}, requested_params[0])
+        self.assertIn("time", requested_params[1])
+        self.assertEqual(
+            {
+                "builtin:host.cpu.usage": ("Percent", ["avg"]),
+                "builtin:host.cpu.idle": ("Percent", ["avg"]),
+            },
+            dt_metrics.get_metric_descriptor_mapping(catalog),
+        )
+        self.assertEqual(catalog, reloaded)
+
+    def test_metric_descriptor_catalog_concurrent_inputs(self):
+        tenant = "http://localhost:12345"
+
+        def fake_execute_session(endpoint, tenant, api_token, params, extra_params=None, **kwargs):
+            if extra_params == ["builtin:host.cpu.usage"]:
+                # Another input refreshes the shared catalog while this one is fetching
+                dt_metrics.refresh_metric_descriptor_catalog(tenant, "test_token", ["builtin:host.cpu.idle"])
+            return [{"metrics": [{"metricId": extra_params[0], "unit": "Percent", "aggregationTypes": ["avg"]}]}]
+
+        with tempfile.TemporaryDirectory() as local_dir, patch.object(
+                dt_metrics.util, "local_dir", local_dir
+        ), patch.object(dt_metrics.util, "execute_session", side_effect=fake_execute_session):
+            dt_metrics.refresh_metric_descriptor_catalog(tenant, "test_token", ["builtin:host.cpu.usage"])
+            reloaded = dt_metrics.load_metric_descriptor_catalog(tenant)
+
+        # Neither input dropped the other's descriptors or writtenSince watermark
+        self.assertEqual({"builtin:host.cpu.usage", "builtin:host.cpu.idle"}, set(reloaded["descriptors"]))
+        self.assertEqual({dt_metrics.get_metric_selectors_key(["builtin:host.cpu.usage"]),
+                          dt_metrics.get_metric_selectors_key(["builtin:host.cpu.idle"])}, set(reloaded["watermarks"]))
+
     def test_live_metric_execute_session(self):
         print()
         metric_selectors_from_file = """builtin:host.cpu.iowait